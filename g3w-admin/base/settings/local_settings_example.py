@@ -41,7 +41,7 @@ QGIS_AUTH_PASSWORD = 'my_secret_password'
 # ===============================
 # follow settings work if 'caching' module is in 'G3WADMIN_LOCAL_MORE_APPS'
 TILESTACHE_CACHE_NAME = 'default'
-TILESTACHE_CACHE_TYPE = 'Disk'  # or 'Memcache'
+TILESTACHE_CACHE_TYPE = 'Disk'  # or 'Memcache' or 'Mbtiles'
 TILESTACHE_CACHE_DISK_PATH = '/tmp/tilestache_cache/'
 TILESTACHE_CACHE_TOKEN = '1234567'
 
@@ -19,3 +19,38 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "base.settings")
 
 application = get_wsgi_application()
+
+
+def prewarm_qgis_projects():
+    """Load the projects of G3WADMIN_PREWARM_PROJECTS into the QGIS Server
+    project cache of the worker, before it accepts requests"""
+
+    from django.conf import settings
+    from django.db import connections
+
+    selection = getattr(settings, 'G3WADMIN_PREWARM_PROJECTS', None)
+    if not selection:
+        return
+
+    from qdjango.utils.prewarm import prewarm_projects
+
+    # Do not use the DB connections inherited from the master process
+    connections.close_all()
+
+    prewarm_projects(selection)
+
+    # Do not share the DB connections opened while pre-warming
+    connections.close_all()
+
+
+try:
+    import uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    pass
+else:
+    if uwsgi.opt.get('lazy-apps') or uwsgi.opt.get('lazy'):
+        # The application is loaded by each worker after the fork
+        prewarm_qgis_projects()
+    else:
+        postfork(prewarm_qgis_projects)
@@ -1,8 +1,10 @@
 from django.conf.urls import url
-from .views import TileStacheTileApiView
+from .views import TileStacheTileApiView, WMTSCapabilitiesView
 
 
 urlpatterns = [
     url(r'^api/(?P<layer_name>[-\w]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+).(?P<extension>\w+)$',
-        TileStacheTileApiView.as_view(), name='caching-api-tile')
+        TileStacheTileApiView.as_view(), name='caching-api-tile'),
+    url(r'^api/(?P<layer_name>[-\w]+)/wmts/?$',
+        WMTSCapabilitiesView.as_view(), name='caching-api-wmts')
 ]
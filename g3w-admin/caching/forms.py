@@ -10,6 +10,17 @@ class ActiveCachingLayerForm(G3WRequestFormMixin, G3WProjectFormMixin, forms.For
 
     active = forms.BooleanField(label=_('Active'), required=False)
     reset_layer_cache_url = forms.CharField(required=False, widget=forms.HiddenInput)
+    max_age = forms.IntegerField(label=_('Browser cache max age (seconds)'), required=False, min_value=0,
+                                 help_text=_('Leave empty for the default value'))
+
+    encoding = forms.ChoiceField(label=_('Tile encoding'), required=False, choices=(
+        ('', _('Default')),
+        ('png', _('PNG')),
+        ('png8', _('PNG 8 bit (256 colors)')),
+        ('jpeg', _('JPEG (opaque layers)')),
+        ('webp', _('WebP')),
+        ('auto', _('Automatic: JPEG for opaque tiles, else PNG 8 bit')),
+    ))
 
     as_base_layer = forms.BooleanField(label=_('Save as base layer'), required=False)
     base_layer_title = forms.CharField(label=_('Base layer title'), required=False)
@@ -29,6 +40,8 @@ class ActiveCachingLayerForm(G3WRequestFormMixin, G3WProjectFormMixin, forms.For
                     Div(
                         'active',
                         'reset_layer_cache_url',
+                        'max_age',
+                        'encoding',
                         css_class='col-md-3'
                     ),
                     Div(
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from caching.utils.seeding import seed_layer
+
+
+class Command(BaseCommand):
+    """
+    This command pre-renders the tiles of a caching layer.
+    """
+
+    help = 'Seed the tile cache of a caching layer over a bbox (default: project extent) and a zoom range'
+
+    def add_arguments(self, parser):
+
+        parser.add_argument('layer_key_name', help='Caching layer key, i.e. qdjango12')
+        parser.add_argument('--bbox', dest='bbox', default=None,
+                            help='xmin,ymin,xmax,ymax in the caching grid CRS, default to project extent')
+        parser.add_argument('--zooms', dest='zooms', nargs=2, type=int, default=[0, 10],
+                            metavar=('MIN', 'MAX'), help='Zoom range')
+        parser.add_argument('--processes', dest='processes', type=int, default=None,
+                            help='Number of rendering processes')
+        parser.add_argument('--no-skip-existing', dest='skip_existing', action='store_false',
+                            help='Render the tiles which are already in the cache')
+        parser.add_argument('--no-resume', dest='resume', action='store_false',
+                            help='Do not resume an interrupted seeding')
+        parser.add_argument('--swap', dest='swap', action='store_true',
+                            help='Seed a new cache file which replaces the current one when completed (MBTiles cache)')
+        parser.add_argument('--async', dest='run_async', action='store_true',
+                            help='Run the seeding as an asynchronous Huey task')
+
+    def handle(self, *args, **options):
+
+        bbox = None
+        if options['bbox']:
+            try:
+                bbox = [float(c) for c in options['bbox'].split(',')]
+                assert len(bbox) == 4
+            except (ValueError, AssertionError):
+                raise CommandError('Invalid bbox: {}'.format(options['bbox']))
+
+        zooms = list(range(options['zooms'][0], options['zooms'][1] + 1))
+
+        if options['run_async']:
+            from caching.tasks import seed_caching_layer_task
+            result = seed_caching_layer_task(options['layer_key_name'], bbox, zooms, options['processes'],
+                                             options['skip_existing'], swap=options['swap'])
+            self.stdout.write(self.style.SUCCESS('Seeding task queued: {}'.format(result.id)))
+            return
+
+        def progress(stats):
+            self.stdout.write('{done}/{total} tiles ({rendered} rendered, {skipped} skipped, {failed} failed), '
+                              '{tiles_per_second:.1f} tiles/s'.format(**stats))
+
+        try:
+            stats = seed_layer(options['layer_key_name'], bbox=bbox, zooms=zooms, processes=options['processes'],
+                               skip_existing=options['skip_existing'], resume=options['resume'],
+                               swap=options['swap'], progress=progress)
+        except (KeyError, IndexError):
+            raise CommandError('Caching layer not found: {}'.format(options['layer_key_name']))
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        self.stdout.write(self.style.SUCCESS(
+            'Seeding completed: {rendered} rendered, {skipped} skipped, {failed} failed, '
+            '{tiles_per_second:.1f} tiles/s'.format(**stats)))
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.18 on 2021-04-19 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caching', '0004_g3wcachinglayer_baselayer_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='g3wcachinglayer',
+            name='max_age',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.18 on 2021-04-21 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('caching', '0005_g3wcachinglayer_max_age'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='g3wcachinglayer',
+            name='encoding',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+    ]
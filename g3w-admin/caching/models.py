@@ -2,6 +2,11 @@ from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
 from core.models import BaseLayer
 import json
+import re
+
+
+# Key of a caching layer: the app name followed by the layer pk, i.e. 'qdjango12'
+CACHING_LAYER_KEY_RE = re.compile(r'^(?P<app_name>\D+)(?P<layer_id>\d+)$')
 
 
 class G3WCachingLayer(models.Model):
@@ -14,9 +19,29 @@ class G3WCachingLayer(models.Model):
     # pk of baselayer_id created by cached layer
     baselayer_id = models.IntegerField(null=True, blank=True)
 
+    # Seconds the tiles can be cached by browsers and proxies, None for TILESTACHE_CACHE_MAX_AGE
+    max_age = models.IntegerField(null=True, blank=True)
+
+    # Tile encoding, see caching.utils.encoding, empty for TILESTACHE_CACHE_ENCODING
+    encoding = models.CharField(max_length=10, blank=True, default='')
+
     def __str__(self):
         return "{}{}".format(self.app_name, self.layer_id)
 
+    @classmethod
+    def get_by_key(cls, key):
+        """
+        Return the caching layer from its key, the string representation of the instance
+        :param key: caching layer key, i.e. 'qdjango12'
+        :raises G3WCachingLayer.DoesNotExist: if the key is not valid or no caching layer matches it
+        :return: G3WCachingLayer instance
+        """
+
+        match = CACHING_LAYER_KEY_RE.match(key)
+        if match is None:
+            raise cls.DoesNotExist('Invalid caching layer key: {}'.format(key))
+        return cls.objects.get(app_name=match.group('app_name'), layer_id=int(match.group('layer_id')))
+
     @property
     def base_layer(self):
         """ Return baselayer instace if exists """
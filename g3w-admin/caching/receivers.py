@@ -3,11 +3,11 @@ from django.template import loader
 from django.dispatch import receiver
 from django.conf import settings
 from django.db.models.signals import pre_delete, post_save
-from core.signals import load_layer_actions, after_serialized_project_layer
+from core.signals import load_layer_actions, after_serialized_project_layer, post_commit_maplayer
 from qdjango.signals import reading_layer_model
 from qdjango.models import Layer
 from caching.models import G3WCachingLayer
-from caching.utils import get_config
+from caching.utils import get_config, bump_config_generation
 
 @receiver(load_layer_actions)
 def caching_layer_action(sender, **kwargs):
@@ -84,6 +84,7 @@ def pre_delete_layer(sender, **kwargs):
         if sender._meta.object_name == 'Layer':
             try:
                 G3WCachingLayer.objects.get(app_name=app_name, layer_id=kwargs['instance'].pk).delete()
+                bump_config_generation()
             except:
                 pass
 
@@ -104,9 +105,44 @@ def post_save_layer(sender, **kwargs):
                 layer_key_name = '{}{}'.format(sender._meta.app_label, kwargs['instance'].pk)
                 if layer_key_name in tilestache_cfg.config.layers:
                     tilestache_cfg.erase_cache_layer(layer_key_name)
+
+                    # Layer dict (i.e. extent) may be changed: rebuild the config of all processes
+                    bump_config_generation()
             except:
                 pass
 
+@receiver(post_commit_maplayer)
+def post_commit_layer(sender, **kwargs):
+    """
+    Remove the cached tiles changed by an editing commit, for every caching layer
+    with the same datasource of the edited layer.
+    :param sender:
+    :param kwargs:
+    :return:
+    """
+
+    layer = kwargs['layer']
+    extents = kwargs.get('extents')
+    if not isinstance(layer, Layer):
+        return
+
+    tilestache_cfg = get_config()
+    layer_key_names = []
+    for l in Layer.objects.filter(datasource=layer.datasource):
+        layer_key_name = '{}{}'.format(l._meta.app_label, l.pk)
+        if layer_key_name in tilestache_cfg.config.layers:
+            layer_key_names.append(layer_key_name)
+
+    for layer_key_name in layer_key_names:
+        if extents is None:
+            # Changes are unknown
+            tilestache_cfg.erase_cache_layer(layer_key_name)
+        elif extents:
+            from caching.tasks import invalidate_caching_layer_tiles_task
+            invalidate_caching_layer_tiles_task(layer_key_name, extents, kwargs.get('crs'),
+                                                getattr(settings, 'TILESTACHE_INVALIDATION_RESEED', False))
+
+
 @receiver(reading_layer_model)
 def get_tms_services(sender, **kwargs):
     """
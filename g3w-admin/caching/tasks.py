@@ -0,0 +1,99 @@
+# coding=utf-8
+""""Huey tasks for caching
+
+.. note:: This program is free software; you can redistribute it and/or modify
+          it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-15'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+from huey_monitor.tqdm import ProcessInfo
+
+from core.utils.tasks import db_task
+from .utils.invalidation import invalidate_tiles
+from .utils.seeding import seed_layer
+from .utils.stats import set_layer_size
+
+
+@db_task(context=True)
+def seed_caching_layer_task(layer_key_name, bbox, zooms, processes, skip_existing, task, swap=False):
+    """Seed a caching layer asynchronously, see caching.utils.seeding.seed_layer
+
+    Returns: the seeding stats dict (total, done, rendered, skipped, failed, tiles_per_second)
+
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :type layer_key_name: str
+    :param bbox: optional (xmin, ymin, xmax, ymax) in the caching grid CRS, defaults to the project extent
+    :type bbox: list, None
+    :param zooms: zoom levels
+    :type zooms: list
+    :param processes: number of rendering processes
+    :type processes: int
+    :param skip_existing: do not render the tiles which are already in the cache
+    :type skip_existing: bool
+    :param swap: seed a new cache file which replaces the current one when completed
+    :type swap: bool
+    :rtype: dict
+    """
+
+    process_info = ProcessInfo(
+        task,
+        desc='Seeding caching layer {}'.format(layer_key_name)
+    )
+
+    reported = None
+
+    def progress(stats):
+
+        nonlocal reported
+        if reported is None:
+            process_info.update_total(stats['total'])
+            reported = 0
+        process_info.update(n=stats['done'] - reported)
+        reported = stats['done']
+
+    return seed_layer(layer_key_name, bbox=bbox, zooms=zooms, processes=processes,
+                      skip_existing=skip_existing, swap=swap, progress=progress)
+
+
+@db_task()
+def invalidate_caching_layer_tiles_task(layer_key_name, bboxes, crs, reseed=False):
+    """Remove the cached tiles of a caching layer which intersect the bboxes,
+    see caching.utils.invalidation.invalidate_tiles
+
+    Returns: the number of removed tiles, None if the whole layer cache has been reset
+
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :type layer_key_name: str
+    :param bboxes: list of (xmin, ymin, xmax, ymax)
+    :type bboxes: list
+    :param crs: CRS auth id of the bboxes, i.e. 'EPSG:4326'
+    :type crs: str
+    :param reseed: render the removed tiles again
+    :type reseed: bool
+    :rtype: int, None
+    """
+
+    return invalidate_tiles(layer_key_name, bboxes, crs, reseed=reseed)
+
+
+@db_task()
+def compute_caching_layer_size_task(layer_key_name):
+    """Compute the storage size of the cached tiles of a caching layer and store it,
+    see caching.utils.stats.get_layer_size
+
+    Returns: the size in bytes, None if not available for the cache type
+
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :type layer_key_name: str
+    :rtype: int, None
+    """
+
+    from .utils import get_config
+
+    size = get_config().cache_layer_size(layer_key_name)
+    set_layer_size(layer_key_name, size)
+    return size
@@ -11,15 +11,17 @@ __date__ = '2020-05-15'
 __copyright__ = 'Copyright 2015 - 2020, Gis3w'
 
 
+from django.conf import settings
 from django.test.client import Client
 from django.test.testcases import LiveServerTestCase
-from django.test import override_settings
+from django.test import override_settings, SimpleTestCase, TestCase
+from django.core.cache import caches
 from django.core.management import call_command
 from django.urls import reverse
 from django.core.files import File
 from django.core.exceptions import ObjectDoesNotExist
 from guardian.shortcuts import assign_perm
-from caching.utils import get_config, TilestacheConfig
+from caching.utils import get_config, get_config_generation, bump_config_generation, TilestacheConfig
 from usersmanage.tests.utils import setup_testing_user, teardown_testing_users
 from qdjango.utils.data import QgisProject
 from qdjango.tests.base import QGS_FILE
@@ -27,7 +29,25 @@ from core.models import Group as CoreGroup, G3WSpatialRefSys
 from .base import CURRENT_PATH, TEST_BASE_PATH
 from qdjango.models import Layer
 from caching.models import G3WCachingLayer
+from caching.utils.cache import get_layer_generation, bump_layer_generation, layer_generation
+from caching.utils.mbtiles import MBTilesCache
+from caching.utils.projections import CustomXYZGridProjection, TileMatrixSet
+from caching.utils.invalidation import get_invalidation_coordinates, invalidate_tiles
+from caching.utils.encoding import EncodingProvider, sniff_mimetype
+from caching.utils.stats import (flush_stats, get_layer_stats, reset_layer_stats, get_layer_size,
+                                 reset_layer_size, claim_layer_size_refresh)
+from caching.tasks import compute_caching_layer_size_task
+from caching.utils.seeding import (count_seed_coordinates, get_seed_coordinates, get_caching_layer_extent,
+                                   seed_layer, _chunks)
+from core.signals import post_commit_maplayer
+from ModestMaps.Core import Coordinate
+from io import BytesIO
+from PIL import Image
+import os
+import re
 import requests
+import sqlite3
+import tempfile
 
 @override_settings(
     TILESTACHE_CACHE_NAME='default',
@@ -86,6 +106,7 @@ class CachingAPITests(LiveServerTestCase):
 
         # init tilestache
         TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
 
         url = reverse('caching-api-tile', args=[f'qdjango{layer.pk}', 0, 0, 0, 'png'])
         #url = f'{self.live_server_url}{url}'
@@ -97,7 +118,513 @@ class CachingAPITests(LiveServerTestCase):
 
         client.logout()
 
+    def test_tile_cache_validators(self):
+        """Testing ETag, Cache-Control and 304 responses of tiles"""
+
+        client = Client()
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk, max_age=600)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+
+        url = reverse('caching-api-tile', args=[str(cachinglayer), 0, 0, 0, 'png'])
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Cache-Control'], 'public, max-age=600')
+        etag = res['ETag']
+        self.assertTrue(etag.startswith('"{}-'.format(get_layer_generation(str(cachinglayer)))))
+
+        res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res['ETag'], etag)
+        self.assertEqual(len(res.content), 0)
+
+        # Last-Modified from the time the tile was written
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        last_modified = res['Last-Modified']
+        res = client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(res.status_code, 304)
+
+        # A layer cache reset changes the validator
+        get_config().erase_cache_layer(str(cachinglayer))
+        res = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res['ETag'], etag)
+
+        cachinglayer.delete()
+
+    def test_tile_stats(self):
+        """Testing tile cache statistics"""
+
+        client = Client()
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+        layer_key_name = str(cachinglayer)
+        get_config().erase_cache_layer(layer_key_name)
+        reset_layer_stats(layer_key_name)
+
+        url = reverse('caching-api-tile', args=[layer_key_name, 0, 0, 0, 'png'])
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        size = len(res.content)
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        flush_stats()
+
+        stats = get_layer_stats(layer_key_name)
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['hit_ratio'], 50.0)
+        self.assertEqual(stats['bytes'], 2 * size)
+        self.assertIsNotNone(stats['avg_render_ms'])
+        self.assertTrue(get_config().cache_layer_size(layer_key_name) >= size)
+
+        # The size is computed by a background task (immediate mode in tests) and stored
+        reset_layer_size(layer_key_name)
+        self.assertEqual(get_layer_size(layer_key_name), (None, None))
+        self.assertTrue(claim_layer_size_refresh(layer_key_name))
+        # Claimed until computed
+        self.assertFalse(claim_layer_size_refresh(layer_key_name))
+        compute_caching_layer_size_task(layer_key_name)
+        self.assertTrue(get_layer_size(layer_key_name)[0] >= size)
+        self.assertFalse(claim_layer_size_refresh(layer_key_name))
+
+        cachinglayer.delete()
+
+    def test_qgis_provider(self):
+        """Testing in-process QGIS Server provider"""
+
+        client = Client()
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        assign_perm('view_project', self.anonymoususer, self.project.instance)
+
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+
+        layer_dict = get_config().config_dict['layers'][str(cachinglayer)]
+        self.assertEqual(layer_dict['provider']['class'], 'qdjango.cache:QgisServerProvider')
+        self.assertEqual(layer_dict['provider']['kwargs']['project_id'], self.project.instance.pk)
+        self.assertNotIn('g3wsuite_caching_token', layer_dict['provider']['kwargs']['query'])
+
+        url = reverse('caching-api-tile', args=[f'qdjango{layer.pk}', 0, 0, 0, 'png'])
+        self.assertTrue(client.login(username=self.test_admin1.username, password=self.test_admin1.username))
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'image/png')
+        client.logout()
+
+        cachinglayer.delete()
+
+    @override_settings(TILESTACHE_CACHE_PROVIDER='url template')
+    def test_url_template_provider(self):
+        """Testing 'url template' provider"""
+
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+
+        layer_dict = get_config().config_dict['layers'][str(cachinglayer)]
+        self.assertEqual(layer_dict['provider']['name'], 'url template')
+        self.assertIn('g3wsuite_caching_token=1234567', layer_dict['provider']['template'])
+
+        cachinglayer.delete()
+
+    def test_config_generation(self):
+        """Testing per process tilestache config"""
+
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        config = get_config()
+
+        # Config is built once per generation
+        self.assertIs(get_config(), config)
+
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        self.assertNotIn(str(cachinglayer), get_config().config.layers)
+
+        generation = get_config_generation()
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+        self.assertEqual(get_config_generation(), generation + 1)
+        self.assertIsNot(get_config(), config)
+        self.assertIn(str(cachinglayer), get_config().config.layers)
+
+        # Tile hits do not query the database
+        get_config()
+        url = reverse('caching-api-tile', args=[str(cachinglayer), 0, 0, 0, 'png'])
+        client = Client()
+        client.get(url)
+        with self.assertNumQueries(0):
+            res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+
+        # Layer save rebuilds the config
+        layer.save()
+        self.assertEqual(get_config_generation(), generation + 2)
+
+        cachinglayer.delete()
+
+    def test_seed_coordinates(self):
+        """Testing seeding grid coordinates"""
+
+        projection = CustomXYZGridProjection('EPSG:3003')
+
+        # One tile at zoom 14 (resolution 2)
+        bbox = (1024, 1024, 1536, 1536)
+        coords = list(get_seed_coordinates(projection, bbox, [14]))
+        self.assertEqual(len(coords), 1)
+        self.assertEqual(count_seed_coordinates(projection, bbox, [14]), 1)
+        zoom, column, row = coords[0]
+        ul = projection.coordinateProj(Coordinate(row, column, zoom))
+        self.assertEqual((ul.x, ul.y), (1024, 1536))
+
+        # Four tiles at the next zoom level
+        self.assertEqual(count_seed_coordinates(projection, bbox, [14, 15]), 5)
+
+        # Tiles of a 2x2 metatile are yielded together and never split between chunks
+        bbox = (0, 0, 1536, 1536)
+        coords = list(get_seed_coordinates(projection, bbox, [15], (2, 2)))
+        self.assertEqual(len(coords), count_seed_coordinates(projection, bbox, [15]))
+        metatiles = [(column // 2, row // 2) for zoom, column, row in coords]
+        self.assertEqual(len(set(metatiles)), len([m for i, m in enumerate(metatiles) if i == 0 or m != metatiles[i - 1]]))
+        seen = set()
+        for chunk in _chunks(coords, 3, (2, 2)):
+            chunk_metatiles = set((column // 2, row // 2) for zoom, column, row in chunk)
+            self.assertFalse(chunk_metatiles & seen)
+            seen.update(chunk_metatiles)
+
+    def test_grid_projection(self):
+        """Testing custom tile grids and tile matrix sets"""
+
+        # Legacy grid when it covers the extent
+        projection = CustomXYZGridProjection('EPSG:3003', (1024, 1024, 1536, 1536))
+        self.assertEqual(projection.resolutions[0], 2**15)
+        ul = projection.coordinateProj(Coordinate(0, 0, 0))
+        self.assertEqual((ul.x, ul.y), (0, 256 * 2**15))
+
+        # Fitted grid for geographic CRSs: zoom 0 is a single tile covering the extent
+        extent = (6.5, 36.5, 18.6, 47.1)
+        projection = CustomXYZGridProjection('EPSG:4258', extent, True)
+        self.assertEqual(count_seed_coordinates(projection, extent, [0]), 1)
+        self.assertEqual(count_seed_coordinates(projection, extent, [1]), 4)
+        ul = projection.coordinateProj(Coordinate(0, 0, 0))
+        self.assertTrue(ul.x <= extent[0] and ul.y >= extent[3])
+
+        # Round trip
+        point = projection.coordinateProj(Coordinate(3, 5, 4))
+        coord = projection.projCoordinate(point).zoomTo(4)
+        self.assertAlmostEqual(coord.row, 3)
+        self.assertAlmostEqual(coord.column, 5)
+
+        # Tile matrices of the fitted grid
+        tms = TileMatrixSet(projection, extent, 111319.49)
+        matrices = tms.matrices()
+        self.assertEqual(len(matrices), len(projection.resolutions))
+        self.assertEqual(matrices[0]['identifier'], '0')
+        self.assertEqual((matrices[0]['matrix_width'], matrices[0]['matrix_height']), (1, 1))
+        self.assertEqual((matrices[1]['matrix_width'], matrices[1]['matrix_height']), (2, 2))
+        self.assertAlmostEqual(matrices[0]['scale_denominator'] / matrices[1]['scale_denominator'], 2)
+        self.assertEqual(matrices[0]['top_left'], (ul.x, ul.y))
+
+    def test_wmts_capabilities(self):
+        """Testing WMTS GetCapabilities of a caching layer"""
+
+        client = Client()
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+
+        res = client.get(reverse('caching-api-wmts', args=[str(cachinglayer)]))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Type'], 'application/xml')
+        content = res.content.decode()
+        self.assertIn('<TileMatrixSet>', content)
+        self.assertIn('urn:ogc:def:crs:EPSG::4326', content)
+        self.assertIn('{TileMatrix}/{TileCol}/{TileRow}.png', content)
+        self.assertIn('<Format>image/png</Format>', content)
+        self.assertIn('<ResourceURL format="image/png"', content)
+
+        # Formats of the layer encoding
+        for encoding, mimetypes in (('jpeg', ['image/jpeg']), ('webp', ['image/webp']),
+                                    ('auto', ['image/jpeg', 'image/png'])):
+            cachinglayer.encoding = encoding
+            cachinglayer.save()
+            content = client.get(reverse('caching-api-wmts', args=[str(cachinglayer)])).content.decode()
+            self.assertEqual(re.findall(r'<Format>(.*?)</Format>', content), mimetypes)
+            self.assertEqual(re.findall(r'<ResourceURL format="(.*?)"', content), mimetypes)
+
+        res = client.get(reverse('caching-api-wmts', args=['qdjango0']))
+        self.assertEqual(res.status_code, 404)
+
+        # Caching layers are looked up by key
+        self.assertEqual(G3WCachingLayer.get_by_key(str(cachinglayer)), cachinglayer)
+        for key in ('qdjango0', 'qdjango', '12', 'qdjango12x'):
+            with self.assertRaises(G3WCachingLayer.DoesNotExist):
+                G3WCachingLayer.get_by_key(key)
+
+        cachinglayer.delete()
+
+    def test_invalidation_coordinates(self):
+        """Testing invalidation grid coordinates"""
+
+        projection = CustomXYZGridProjection('EPSG:3003')
+        bboxes = [(1100, 1100, 1200, 1200)]
+
+        # Resolution 2 at zoom 14: 100 pixels buffer spans the tiles around
+        self.assertEqual(len(get_invalidation_coordinates(projection, bboxes, [14], 0)), 1)
+        self.assertEqual(len(get_invalidation_coordinates(projection, bboxes, [14], 32)), 1)
+        self.assertEqual(len(get_invalidation_coordinates(projection, bboxes, [14], 100)), 4)
+
+        # Same bbox twice
+        self.assertEqual(len(get_invalidation_coordinates(projection, bboxes * 2, [14], 0)), 1)
+
+    def test_invalidate_tiles(self):
+        """Testing partial tile invalidation after editing"""
+
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+        get_config().erase_cache_layer(str(cachinglayer))
+
+        zooms = [0, 1, 2, 3]
+        stats = seed_layer(str(cachinglayer), zooms=zooms, processes=1)
+        self.assertGreater(stats['total'], 1)
+
+        # Small bbox in the middle of the project extent
+        xmin, ymin, xmax, ymax = get_caching_layer_extent(str(cachinglayer))
+        x, y = (xmin + xmax) / 2, (ymin + ymax) / 2
+        removed = invalidate_tiles(str(cachinglayer), [(x, y, x + 1, y + 1)], zooms=zooms)
+        self.assertGreater(removed, 0)
+        self.assertLess(removed, stats['total'])
+
+        stats = seed_layer(str(cachinglayer), zooms=zooms, processes=1)
+        self.assertEqual(stats['rendered'], removed)
+
+        # Editing commits invalidate the tiles through the Huey task (immediate mode in tests)
+        crs = get_config().config.layers[str(cachinglayer)].projection.srs
+        generation = get_layer_generation(str(cachinglayer))
+        post_commit_maplayer.send(self, layer=layer, user=self.test_admin1, extents=[(x, y, x + 1, y + 1)], crs=crs)
+        self.assertEqual(get_layer_generation(str(cachinglayer)), generation)
+        stats = seed_layer(str(cachinglayer), zooms=zooms, processes=1)
+        self.assertEqual(stats['rendered'], removed)
+
+        # Unknown changes reset the whole layer cache
+        post_commit_maplayer.send(self, layer=layer, user=self.test_admin1)
+        self.assertEqual(get_layer_generation(str(cachinglayer)), generation + 1)
+
+        cachinglayer.delete()
+
+    def test_seed_layer(self):
+        """Testing caching layer seeding"""
+
+        layer = Layer.objects.get(project=self.project.instance, qgs_layer_id='spatialite_points20190604101052075')
+        cachinglayer = G3WCachingLayer.objects.create(app_name='qdjango', layer_id=layer.pk)
+        TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
+        get_config().erase_cache_layer(str(cachinglayer))
+
+        progress = []
+        stats = seed_layer(str(cachinglayer), zooms=[0, 1], processes=1, progress=progress.append)
+        self.assertGreater(stats['total'], 0)
+        self.assertEqual(stats['done'], stats['total'])
+        self.assertEqual(stats['rendered'], stats['total'])
+        self.assertEqual(stats['failed'], 0)
+        self.assertEqual(progress[-1]['done'], stats['total'])
+
+        # Existing tiles are skipped
+        stats = seed_layer(str(cachinglayer), zooms=[0, 1], processes=1)
+        self.assertEqual(stats['skipped'], stats['total'])
+
+        # Reset bumps the layer cache generation: tiles are rendered again
+        generation = get_layer_generation(str(cachinglayer))
+        get_config().erase_cache_layer(str(cachinglayer))
+        self.assertEqual(get_layer_generation(str(cachinglayer)), generation + 1)
+        stats = seed_layer(str(cachinglayer), zooms=[0, 1], processes=1)
+        self.assertEqual(stats['rendered'], stats['total'])
+
+        cachinglayer.delete()
+
     @classmethod
     def tearDownClass(cls):
         teardown_testing_users(cls)
         super().tearDownClass()
+
+
+@override_settings(TILESTACHE_CACHE_NAME='default')
+class LayerGenerationTests(TestCase):
+    """Test the caching layer generations"""
+
+    def test_layer_generation(self):
+
+        generation = get_layer_generation('generation_test')
+        self.assertEqual(bump_layer_generation('generation_test'), generation + 1)
+
+        # Stored in the database: not lost when the cache is cleared
+        caches[getattr(settings, 'TILESTACHE_CACHE_NAME', 'mced')].clear()
+        self.assertEqual(get_layer_generation('generation_test'), generation + 1)
+
+        # Read once for the whole block
+        with layer_generation('generation_test') as pinned:
+            self.assertEqual(pinned, generation + 1)
+            bump_layer_generation('generation_test')
+            with self.assertNumQueries(0):
+                self.assertEqual(get_layer_generation('generation_test'), pinned)
+        self.assertEqual(get_layer_generation('generation_test'), generation + 2)
+
+
+class MBTilesCacheTests(TestCase):
+    """Test the MBTiles tile cache"""
+
+    class Layer(object):
+
+        stale_lock_timeout = 1
+
+        def name(self):
+            return 'mbtiles_test'
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = MBTilesCache(self.tmp_dir.name)
+        self.layer = self.Layer()
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def test_read_save(self):
+
+        coord = Coordinate(1, 2, 3)
+        self.assertIsNone(self.cache.read(self.layer, coord, 'PNG'))
+        self.cache.save(b'tile', self.layer, coord, 'PNG')
+        self.assertEqual(self.cache.read(self.layer, coord, 'PNG'), b'tile')
+
+        # Rows are stored bottom up
+        db = sqlite3.connect(self.cache.filename('mbtiles_test'))
+        self.assertEqual(db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall(), [(3, 2, 6)])
+        self.assertEqual(db.execute("SELECT value FROM metadata WHERE name='format'").fetchone(), ('png', ))
+        self.assertEqual(db.execute('PRAGMA journal_mode').fetchone(), ('wal', ))
+        db.close()
+
+        self.cache.remove(self.layer, coord, 'PNG')
+        self.assertIsNone(self.cache.read(self.layer, coord, 'PNG'))
+
+        self.cache.lock(self.layer, coord, 'PNG')
+        self.cache.unlock(self.layer, coord, 'PNG')
+
+    def test_batch(self):
+
+        self.cache.begin_batch(10)
+        for column in range(3):
+            self.cache.save(b'tile', self.layer, Coordinate(0, column, 2), 'PNG')
+
+        # Not written yet
+        self.assertFalse(os.path.exists(self.cache.filename('mbtiles_test')))
+
+        self.cache.end_batch()
+        db = sqlite3.connect(self.cache.filename('mbtiles_test'))
+        self.assertEqual(db.execute('SELECT count(*) FROM tiles').fetchone(), (3, ))
+        db.close()
+
+    def test_swap(self):
+
+        coord = Coordinate(0, 0, 0)
+        self.cache.save(b'old', self.layer, coord, 'PNG')
+        old_filename = self.cache.filename('mbtiles_test')
+
+        seeder = MBTilesCache(self.tmp_dir.name)
+        seeder.begin_swap('mbtiles_test', reset=True)
+        seeder.save(b'new', self.layer, coord, 'PNG')
+        self.assertEqual(self.cache.read(self.layer, coord, 'PNG'), b'old')
+
+        generation = get_layer_generation('mbtiles_test')
+        self.assertEqual(seeder.commit_swap('mbtiles_test'), generation + 1)
+        self.assertFalse(os.path.exists(seeder.filename('mbtiles_test', swap=True)))
+        self.assertFalse(os.path.exists(old_filename))
+        self.assertEqual(self.cache.read(self.layer, coord, 'PNG'), b'new')
+
+    def test_swap_generations(self):
+
+        coord = Coordinate(0, 0, 0)
+        self.cache.save(b'old', self.layer, coord, 'PNG')
+        generation = get_layer_generation('mbtiles_test')
+        current_filename = self.cache.filename('mbtiles_test')
+
+        # The generation is in the database: clearing the cache does not make
+        # the garbage collection remove the current file
+        caches[getattr(settings, 'TILESTACHE_CACHE_NAME', 'mced')].clear()
+        self.cache.collect_garbage('mbtiles_test')
+        self.assertTrue(os.path.exists(current_filename))
+
+        # Files of the following generations are kept
+        self.cache.collect_garbage('mbtiles_test', generation - 1)
+        self.assertTrue(os.path.exists(current_filename))
+
+        # A file left by an interrupted swap is never served
+        stale_filename = os.path.join(self.tmp_dir.name, 'mbtiles_test', 'g{}.mbtiles'.format(generation + 1))
+        with open(stale_filename, 'wb') as f:
+            f.write(b'stale')
+
+        seeder = MBTilesCache(self.tmp_dir.name)
+        seeder.begin_swap('mbtiles_test', reset=True)
+        seeder.save(b'new', self.layer, coord, 'PNG')
+        self.assertEqual(seeder.commit_swap('mbtiles_test'), generation + 1)
+        self.assertEqual(get_layer_generation('mbtiles_test'), generation + 1)
+        self.assertEqual(self.cache.read(self.layer, coord, 'PNG'), b'new')
+        self.assertFalse(os.path.exists(current_filename))
+
+        # A reset while seeding: the swapped file becomes the generation after it
+        seeder.begin_swap('mbtiles_test', reset=True)
+        seeder.save(b'newer', self.layer, coord, 'PNG')
+        seeder.flush()
+        bump_layer_generation('mbtiles_test')
+        self.assertEqual(seeder.commit_swap('mbtiles_test'), generation + 3)
+        self.assertEqual(self.cache.read(self.layer, coord, 'PNG'), b'newer')
+
+
+class TileEncodingTests(SimpleTestCase):
+    """Test the adaptive tile encoding"""
+
+    class Provider(object):
+
+        def __init__(self, image):
+            self.image = image
+
+        def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+            return self.image
+
+    def _encode(self, image, encoding, box=None):
+
+        tile = EncodingProvider(self.Provider(image), encoding).renderArea(512, 512, 'EPSG:3857', 0, 0, 1, 1, 0)
+        if box is not None:
+            tile = tile.crop(box)
+        out = BytesIO()
+        tile.save(out, 'PNG')
+        return out.getvalue()
+
+    def test_encodings(self):
+
+        opaque = Image.new('RGBA', (512, 512), (10, 200, 30, 255))
+        transparent = opaque.copy()
+        transparent.putpixel((300, 300), (0, 0, 0, 0))
+
+        self.assertEqual(sniff_mimetype(self._encode(opaque, 'jpeg')), 'image/jpeg')
+        self.assertEqual(sniff_mimetype(self._encode(opaque, 'webp')), 'image/webp')
+
+        content = self._encode(transparent, 'png8')
+        self.assertEqual(sniff_mimetype(content), 'image/png')
+        image = Image.open(BytesIO(content))
+        self.assertEqual(image.mode, 'P')
+        self.assertEqual(image.convert('RGBA').getpixel((300, 300))[3], 0)
+
+        # Automatic selection, metatiles are encoded tile by tile
+        self.assertEqual(sniff_mimetype(self._encode(transparent, 'auto')), 'image/png')
+        self.assertEqual(sniff_mimetype(self._encode(transparent, 'auto', (0, 0, 256, 256))), 'image/jpeg')
+        self.assertEqual(Image.open(BytesIO(self._encode(transparent, 'auto', (0, 0, 256, 256)))).size, (256, 256))
@@ -8,16 +8,34 @@ from caching.models import G3WCachingLayer
 from django.apps import apps
 from django.core.cache import cache, caches
 from .cache import CACHE_CLASSES
+from .encoding import EncodingProvider
+from .stats import StatsCache, reset_layer_size
 import shutil
 import os
 import fcntl
 import logging
+import threading
 import time
 
 logger = logging.getLogger('g3wadmin.debug')
 
 TILESTACHE_CACHE_BUFFER_SIZE = getattr(settings, 'TILESTACHE_CACHE_BUFFER_SIZE', None)
 
+# Metatile size in tiles: a single render request for rows x columns tiles
+TILESTACHE_CACHE_METATILE_ROWS = getattr(settings, 'TILESTACHE_CACHE_METATILE_ROWS', 1)
+TILESTACHE_CACHE_METATILE_COLUMNS = getattr(settings, 'TILESTACHE_CACHE_METATILE_COLUMNS', 1)
+
+# Seconds a metatile lock is waited for before it is considered stale,
+# must be longer than the rendering time of a metatile
+TILESTACHE_CACHE_STALE_LOCK_TIMEOUT = getattr(settings, 'TILESTACHE_CACHE_STALE_LOCK_TIMEOUT', 60)
+
+# Default seconds the tiles can be cached by browsers and proxies, per caching layer
+# with G3WCachingLayer.max_age: tiles are revalidated with their ETag after expiry
+TILESTACHE_CACHE_MAX_AGE = getattr(settings, 'TILESTACHE_CACHE_MAX_AGE', 0)
+
+# Default tile encoding of the caching layers, see caching.utils.encoding
+TILESTACHE_CACHE_ENCODING = getattr(settings, 'TILESTACHE_CACHE_ENCODING', 'png')
+
 LAYER_CLASSES = dict()
 
 for app_name in settings.G3WADMIN_PROJECT_APPS:
@@ -28,21 +46,64 @@ for app_name in settings.G3WADMIN_PROJECT_APPS:
         continue
 
 
+CONFIG_GENERATION_KEY = 'tilestache_cfg_gen'
+
+_CONFIG = None
+_CONFIG_GENERATION = None
+_CONFIG_LOCK = threading.Lock()
+
+
+def get_config_generation():
+    """
+    Return the shared generation of the tilestache config
+    :return: int
+    """
+
+    return caches[TilestacheConfig.cache_name].get(CONFIG_GENERATION_KEY, 0)
+
+
+def bump_config_generation():
+    """
+    Bump the shared generation of the tilestache config: every process rebuilds its config on next access
+    :return: None
+    """
+
+    cache = caches[TilestacheConfig.cache_name]
+    try:
+        cache.incr(CONFIG_GENERATION_KEY)
+    except ValueError:
+        cache.set(CONFIG_GENERATION_KEY, 1, None)
+
+
 def get_config():
     """
-    Get global config tilestache object
+    Get global config tilestache object, the object is built once per process
+    and rebuilt only when the shared config generation changes
     :return:
     """
 
+    global _CONFIG, _CONFIG_GENERATION
 
-    # si prova con dict
-    current_cfg = TilestacheConfig.get_cache_config_dict()
-    if current_cfg:
-        return TilestacheConfig(config_dict=current_cfg)
-    else:
-        cfg = TilestacheConfig()
-        TilestacheConfig.set_cache_config_dict(cfg.config_dict)
-        return cfg
+    generation = get_config_generation()
+    if _CONFIG is not None and _CONFIG_GENERATION == generation:
+        return _CONFIG
+
+    with _CONFIG_LOCK:
+        if _CONFIG is not None and _CONFIG_GENERATION == generation:
+            return _CONFIG
+
+        # si prova con dict
+        current_cfg = TilestacheConfig.get_cache_config_dict()
+        if current_cfg:
+            cfg = TilestacheConfig(config_dict=current_cfg)
+        else:
+            cfg = TilestacheConfig()
+            TilestacheConfig.set_cache_config_dict(cfg.config_dict)
+
+        _CONFIG, _CONFIG_GENERATION = cfg, generation
+        logger.debug('Tilestache config built, generation {}'.format(generation))
+
+    return cfg
 
 
 class TilestacheConfig(object):
@@ -64,6 +125,11 @@ class TilestacheConfig(object):
             self.init_cache()
             self.config_dict.update({'cache': self.cache.cache_dict})
         self.config = parseConfig(self.config_dict)
+
+        # Cache hits of the tile API, see caching.utils.stats
+        self.config.cache = StatsCache(self.config.cache)
+        for layer_key_name, layer in self.config.layers.items():
+            self.wrap_layer(layer, self.config_dict['layers'][layer_key_name])
         try:
             self.init_layers()
         except:
@@ -93,8 +159,26 @@ class TilestacheConfig(object):
 
         layer_dict = LAYER_CLASSES[caching_layer.app_name](caching_layer, layer_key_name).layer_dict
 
+        # Metatiles are rendered by a single process: the others wait for the
+        # cache lock of the metatile and read the tiles from the cache
+        metatile = dict()
         if TILESTACHE_CACHE_BUFFER_SIZE is not None:
-            layer_dict["metatile"] = { "buffer": TILESTACHE_CACHE_BUFFER_SIZE }
+            metatile["buffer"] = TILESTACHE_CACHE_BUFFER_SIZE
+        if TILESTACHE_CACHE_METATILE_ROWS > 1 or TILESTACHE_CACHE_METATILE_COLUMNS > 1:
+            metatile["rows"] = TILESTACHE_CACHE_METATILE_ROWS
+            metatile["columns"] = TILESTACHE_CACHE_METATILE_COLUMNS
+        if metatile:
+            layer_dict["metatile"] = metatile
+
+        layer_dict["stale lock timeout"] = TILESTACHE_CACHE_STALE_LOCK_TIMEOUT
+
+        # Cache-Control and Expires headers of the tile responses
+        max_age = caching_layer.max_age if caching_layer.max_age is not None else TILESTACHE_CACHE_MAX_AGE
+        if max_age is not None:
+            layer_dict["maximum cache age"] = max_age
+
+        # Not a TileStache option, applied by wrap_layer()
+        layer_dict["encoding"] = caching_layer.encoding or TILESTACHE_CACHE_ENCODING
 
         # add layer_dict to config_dict
         if 'layers' not in self.config_dict:
@@ -110,8 +194,22 @@ class TilestacheConfig(object):
         :param layer_dict:
         :return:
         """
-        self.config.layers[layer_key_name] = _parseConfigLayer(self.build_layer_dict(caching_layer, layer_key_name),
-                                                               self.config, dirpath='.')
+        layer_dict = self.build_layer_dict(caching_layer, layer_key_name)
+        self.config.layers[layer_key_name] = self.wrap_layer(_parseConfigLayer(layer_dict, self.config, dirpath='.'),
+                                                             layer_dict)
+
+    def wrap_layer(self, layer, layer_dict):
+        """
+        Apply the g3wsuite options of a layer dict to a TileStache layer
+        :param layer: TileStache layer
+        :param layer_dict: layer config dict
+        :return: the layer
+        """
+
+        encoding = layer_dict.get('encoding', 'png')
+        if encoding != 'png':
+            layer.provider = EncodingProvider(layer.provider, encoding)
+        return layer
 
     def remove_layer(self, layer_key_name):
         """
@@ -129,6 +227,16 @@ class TilestacheConfig(object):
         """
 
         self.cache.reset_cache_layer(layer_key_name)
+        reset_layer_size(layer_key_name)
+
+    def cache_layer_size(self, layer_key_name):
+        """
+        Storage size of the cached tiles of a layer
+        :param layer_key_name:
+        :return: size in bytes, None if not available for the cache type
+        """
+
+        return self.cache.layer_size(layer_key_name) if hasattr(self.cache, 'layer_size') else None
 
     def set_cache_hash(self, cid):
         cache.set(self.cache_key, cid, None)
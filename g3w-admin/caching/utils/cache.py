@@ -1,9 +1,158 @@
+from contextlib import contextmanager
 from django.conf import settings
-from django.core.cache import caches
-
-#todo: rewrite for python3 memcached cache.
-#from memcached_stats import MemcachedStats
+from TileStache.Caches import Disk
+from TileStache.Memcache import Cache as Memcache
+from core.models import CacheGeneration
+import logging
+import os
 import shutil
+import threading
+
+logger = logging.getLogger('g3wadmin.debug')
+
+LAYER_GENERATION_KEY = 'tilestache_layer_gen_{}'
+
+# Layer generations read once for the tile request handled by the thread
+_local = threading.local()
+
+
+def get_layer_generation(layer_key_name):
+    """
+    Return the current cache generation of a caching layer, the generation is stored in the
+    database so that every process sees the same value and it is never evicted
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: int
+    """
+
+    generations = getattr(_local, 'generations', {})
+    if layer_key_name in generations:
+        return generations[layer_key_name]
+    return CacheGeneration.get_value(LAYER_GENERATION_KEY.format(layer_key_name))
+
+
+def bump_layer_generation(layer_key_name):
+    """
+    Bump the cache generation of a caching layer: tiles of the previous generations are no longer reachable
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: the new generation
+    """
+
+    return CacheGeneration.bump(LAYER_GENERATION_KEY.format(layer_key_name))
+
+
+def set_layer_generation(layer_key_name, expected, generation):
+    """
+    Set the cache generation of a caching layer if it is still the expected one (compare and swap)
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param expected: the generation read by the caller
+    :param generation: the new generation
+    :return: True if the generation has been set, False if it has been changed in the meantime
+    """
+
+    return CacheGeneration.compare_and_set(LAYER_GENERATION_KEY.format(layer_key_name), expected, generation)
+
+
+@contextmanager
+def layer_generation(layer_key_name):
+    """
+    Read the cache generation of a caching layer once and use it for all the cache
+    operations of the block in this thread, i.e. lock, read and save of a tile request
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: the generation
+    """
+
+    generations = getattr(_local, 'generations', None)
+    if generations is None:
+        generations = _local.generations = {}
+    if layer_key_name in generations:
+        # Nested block: keep the generation of the outer one
+        yield generations[layer_key_name]
+        return
+
+    generations[layer_key_name] = get_layer_generation(layer_key_name)
+    try:
+        yield generations[layer_key_name]
+    finally:
+        generations.pop(layer_key_name, None)
+
+
+def directory_size(path):
+    """
+    Return the size in bytes of the files in a directory tree
+    :param path: directory path
+    :return: int
+    """
+
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # Removed in the meantime, i.e. by a garbage collection
+                pass
+    return size
+
+
+class GenerationLayer(object):
+    """
+    TileStache layer proxy whose name includes the layer cache generation,
+    TileStache caches use the layer name to build tile keys and paths.
+    """
+
+    def __init__(self, layer):
+        self._layer = layer
+        self._name = '{}/g{}'.format(layer.name(), get_layer_generation(layer.name()))
+
+    def name(self):
+        return self._name
+
+    def __getattr__(self, attr):
+        return getattr(self._layer, attr)
+
+
+class LayerGenerationMixin(object):
+    """
+    Mixin for TileStache caches: tiles are stored under the current generation of the layer
+    """
+
+    def lock(self, layer, coord, format):
+        return super().lock(GenerationLayer(layer), coord, format)
+
+    def unlock(self, layer, coord, format):
+        return super().unlock(GenerationLayer(layer), coord, format)
+
+    def remove(self, layer, coord, format):
+        return super().remove(GenerationLayer(layer), coord, format)
+
+    def read(self, layer, coord, format):
+        return super().read(GenerationLayer(layer), coord, format)
+
+    def save(self, body, layer, coord, format):
+        return super().save(body, GenerationLayer(layer), coord, format)
+
+
+class GenerationDiskCache(LayerGenerationMixin, Disk):
+    """
+    TileStache Disk cache with layer generations: {path}/{layer}/g{generation}/{z}/...
+    """
+
+    def mtime(self, layer, coord, format):
+        """
+        Return the time a cached tile was written
+        :return: timestamp, None if the tile is not cached
+        """
+
+        try:
+            return os.path.getmtime(self._fullpath(GenerationLayer(layer), coord, format))
+        except OSError:
+            return None
+
+
+class GenerationMemcache(LayerGenerationMixin, Memcache):
+    """
+    TileStache Memcache cache with layer generations: {prefix}/{revision}/{layer}/g{generation}/{z}/...
+    """
 
 
 class TilestacheCache(object):
@@ -21,6 +170,14 @@ class TilestacheCache(object):
     def reset_cache_layer(self, layer_key_name):
         pass
 
+    def layer_size(self, layer_key_name):
+        """
+        Return the storage size of the cached tiles of a layer
+        :param layer_key_name: caching layer key, i.e. 'qdjango12'
+        :return: size in bytes, None if not available for the cache type
+        """
+        return None
+
 
 class TilestacheCacheTest(object):
 
@@ -54,13 +211,69 @@ class TilestacheCacheDisk(TilestacheCache):
 
     def _init_cache_dict(self):
         self.cache_dict = {
-            'name': 'Disk',
-            'path': getattr(settings, 'TILESTACHE_CACHE_DISK_PATH', '/tmp/tilestache_g3wsuite'),
-            'umask': getattr(settings, 'TILESTACHE_CACHE_DISK_UMASK', '0000')
+            'class': 'caching.utils.cache:GenerationDiskCache',
+            'kwargs': {
+                'path': getattr(settings, 'TILESTACHE_CACHE_DISK_PATH', '/tmp/tilestache_g3wsuite'),
+                'umask': int(getattr(settings, 'TILESTACHE_CACHE_DISK_UMASK', '0000'), 8)
+            }
+        }
+
+    def _collect_garbage(self, layer_key_name, generation):
+        """
+        Remove the tiles of the previous generations of a layer
+        """
+
+        layer_path = os.path.join(self.cache_dict['kwargs']['path'], layer_key_name)
+        current = 'g{}'.format(generation)
+        try:
+            entries = os.listdir(layer_path)
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            if entry != current:
+                shutil.rmtree(os.path.join(layer_path, entry), ignore_errors=True)
+        logger.debug('Tile cache of {} previous generations removed'.format(layer_key_name))
+
+    def reset_cache_layer(self, layer_key_name):
+
+        generation = bump_layer_generation(layer_key_name)
+
+        # Old tiles are no longer reachable: remove them in background
+        threading.Thread(target=self._collect_garbage, args=(layer_key_name, generation), daemon=True).start()
+
+    def layer_size(self, layer_key_name):
+
+        return directory_size(os.path.join(self.cache_dict['kwargs']['path'], layer_key_name))
+
+
+class TilestacheCacheMbtiles(TilestacheCache):
+    """
+    Class to manage tilestache of MBTiles type: a single SQLite file for each layer
+    """
+
+    def _init_cache_dict(self):
+        self.cache_dict = {
+            'class': 'caching.utils.mbtiles:MBTilesCache',
+            'kwargs': {
+                'path': getattr(settings, 'TILESTACHE_CACHE_MBTILES_PATH', '/tmp/tilestache_g3wsuite_mbtiles'),
+                'umask': int(getattr(settings, 'TILESTACHE_CACHE_DISK_UMASK', '0000'), 8)
+            }
         }
 
     def reset_cache_layer(self, layer_key_name):
-        shutil.rmtree("{}/{}".format(self.cache_dict['path'], layer_key_name), ignore_errors=True)
+
+        from .mbtiles import MBTilesCache
+
+        generation = bump_layer_generation(layer_key_name)
+
+        # The file of the previous generation is no longer reachable: remove it in background
+        cache = MBTilesCache(**self.cache_dict['kwargs'])
+        threading.Thread(target=cache.collect_garbage, args=(layer_key_name, generation), daemon=True).start()
+
+    def layer_size(self, layer_key_name):
+
+        return directory_size(os.path.join(self.cache_dict['kwargs']['path'], layer_key_name))
 
 
 class TilestacheCacheMemcache(TilestacheCache):
@@ -80,29 +293,25 @@ class TilestacheCacheMemcache(TilestacheCache):
 
         location = self._get_location()
         self.cache_dict = {
-            "name": "Memcache",
-            "servers": location if isinstance(location, list) else [location],
-            "revision": 0,
-            "key prefix": self.memcache_key_prefix
+            "class": "caching.utils.cache:GenerationMemcache",
+            "kwargs": {
+                "servers": location if isinstance(location, list) else [location],
+                "revision": 0,
+                "key_prefix": self.memcache_key_prefix
+            }
         }
 
     def reset_cache_layer(self, layer_key_name):
 
-        cache = caches[self.cache_name]
-        location = self._get_location()
-        location = location[0] if isinstance(location, list) else location
-        location = location.split(':')
-        mem = MemcachedStats(location[0], location [1])
-        keys = mem.keys()
-
-        for key in keys:
-            if key.startswith('{}/{}/{}'.format(self.memcache_key_prefix, '0', layer_key_name)):
-                cache.delete(key)
+        # Tiles of the previous generations are no longer reachable and are
+        # evicted by memcached
+        bump_layer_generation(layer_key_name)
 
 
 CACHE_CLASSES = {
         'Disk': TilestacheCacheDisk,
         'Memcache': TilestacheCacheMemcache,
+        'Mbtiles': TilestacheCacheMbtiles,
         'Test': TilestacheCacheTest,
         'S3': TilestacheCacheS3
     }
\ No newline at end of file
@@ -0,0 +1,150 @@
+# coding=utf-8
+""""Adaptive tile encoding for caching layers
+
+Providers render 32-bit PNG images, the encoding of a caching layer is applied
+when TileStache encodes the tiles, i.e. once before they are written to the
+cache (metatiles are encoded tile by tile):
+
+- ``png``: 32-bit PNG (TileStache default)
+- ``png8``: paletted PNG, quantised to 256 colors, transparency is kept
+- ``jpeg``: JPEG, transparent pixels are flattened on white
+- ``webp``: WebP, transparency is kept
+- ``auto``: JPEG for opaque tiles and PNG8 for tiles with transparent pixels
+
+The tile URL extension does not change: the content type of the tiles is
+detected from the tile data, see :func:`sniff_mimetype`.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-21'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+from django.conf import settings
+
+ENCODINGS = ('png', 'png8', 'jpeg', 'webp', 'auto')
+
+# Mime types of the tiles of each encoding, 'auto' mixes JPEG and PNG tiles
+ENCODING_MIMETYPES = {
+    'png': ('image/png',),
+    'png8': ('image/png',),
+    'jpeg': ('image/jpeg',),
+    'webp': ('image/webp',),
+    'auto': ('image/jpeg', 'image/png'),
+}
+
+# Quality of the lossy encodings (JPEG and WebP)
+TILESTACHE_CACHE_JPEG_QUALITY = getattr(settings, 'TILESTACHE_CACHE_JPEG_QUALITY', 85)
+TILESTACHE_CACHE_WEBP_QUALITY = getattr(settings, 'TILESTACHE_CACHE_WEBP_QUALITY', 80)
+
+
+def sniff_mimetype(content):
+    """
+    Return the mime type of an encoded tile from its magic bytes
+    :param content: tile data
+    :type content: bytes
+    :return: mime type, None if unknown
+    """
+
+    if content[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if content[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def is_opaque(image):
+    """
+    Return True if the image has no transparent pixels
+    :param image: PIL image
+    :rtype: bool
+    """
+
+    if image.mode in ('RGBA', 'LA'):
+        return image.getchannel('A').getextrema()[0] == 255
+    if image.mode == 'P':
+        return 'transparency' not in image.info
+    return True
+
+
+def encode_image(image, out, encoding):
+    """
+    Encode a PIL image
+    :param image: PIL image
+    :param out: file-like object
+    :param encoding: one of ENCODINGS but 'png'
+    :return: None
+    """
+
+    from PIL import Image
+
+    if encoding == 'auto':
+        encoding = 'jpeg' if is_opaque(image) else 'png8'
+
+    if encoding == 'png8':
+        # Fast octree is the only quantisation method of RGBA images
+        fastoctree = getattr(Image, 'Quantize', Image).FASTOCTREE
+        image = image.convert('RGBA').quantize(colors=256, method=fastoctree)
+        image.save(out, 'PNG', optimize=True)
+
+    elif encoding == 'jpeg':
+        if image.mode != 'RGB':
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        image.save(out, 'JPEG', quality=TILESTACHE_CACHE_JPEG_QUALITY, optimize=True)
+
+    elif encoding == 'webp':
+        image.save(out, 'WEBP', quality=TILESTACHE_CACHE_WEBP_QUALITY)
+
+    else:
+        raise ValueError('Unknown tile encoding: {}'.format(encoding))
+
+
+class EncodedImage(object):
+    """
+    PIL image proxy whose save() applies the encoding of the caching layer
+    instead of the format of the tile URL extension
+
+    :param image: PIL image
+    :param encoding: one of ENCODINGS but 'png'
+    """
+
+    def __init__(self, image, encoding):
+        self.image = image
+        self.encoding = encoding
+
+    def crop(self, box):
+        """Metatiles are cropped in tiles before encoding"""
+        return EncodedImage(self.image.crop(box), self.encoding)
+
+    def save(self, out, format=None, **kwargs):
+        encode_image(self.image, out, self.encoding)
+
+    def __getattr__(self, attr):
+        return getattr(self.image, attr)
+
+
+class EncodingProvider(object):
+    """
+    TileStache provider proxy, the rendered images are encoded with the encoding of the caching layer
+
+    :param provider: TileStache provider
+    :param encoding: one of ENCODINGS but 'png'
+    """
+
+    def __init__(self, provider, encoding):
+        self.provider = provider
+        self.encoding = encoding
+
+    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+        return EncodedImage(self.provider.renderArea(width, height, srs, xmin, ymin, xmax, ymax, zoom),
+                            self.encoding)
+
+    def __getattr__(self, attr):
+        return getattr(self.provider, attr)
@@ -0,0 +1,146 @@
+# coding=utf-8
+""""Partial tile invalidation for caching layers
+
+Editing commits record the bounding boxes of the changed geometries: only the
+cached tiles intersecting those bounding boxes are removed, at every zoom
+level, instead of resetting the whole cache of the layer.
+
+Bounding boxes are padded by a number of pixels at each zoom level, to cover
+the symbols and labels drawn around the geometries. When the tiles to remove
+are too many the whole layer cache is reset instead.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-17'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import logging
+
+from django.conf import settings
+from ModestMaps.Core import Coordinate
+
+from .cache import layer_generation
+from .seeding import count_seed_coordinates, get_seed_coordinates, seed_tiles
+
+logger = logging.getLogger('g3wadmin.debug')
+
+# Highest zoom level whose tiles are invalidated
+INVALIDATION_MAX_ZOOM = getattr(settings, 'TILESTACHE_INVALIDATION_MAX_ZOOM', 20)
+
+# Pixels added around the changed geometries, for symbols and labels
+INVALIDATION_PIXEL_BUFFER = getattr(settings, 'TILESTACHE_INVALIDATION_PIXEL_BUFFER', 32)
+
+# Max number of tiles removed one by one, over this the whole layer cache is reset
+INVALIDATION_MAX_TILES = getattr(settings, 'TILESTACHE_INVALIDATION_MAX_TILES', 10000)
+
+
+def transform_bboxes(bboxes, src_crs, dst_crs):
+    """
+    Transform bounding boxes between two CRSs
+    :param bboxes: list of (xmin, ymin, xmax, ymax)
+    :param src_crs: source CRS auth id, i.e. 'EPSG:4326'
+    :param dst_crs: destination CRS auth id
+    :return: list of (xmin, ymin, xmax, ymax)
+    """
+
+    from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransform,
+                           QgsProject, QgsRectangle)
+
+    src = QgsCoordinateReferenceSystem(src_crs)
+    dst = QgsCoordinateReferenceSystem(dst_crs)
+    if src == dst:
+        return [tuple(bbox) for bbox in bboxes]
+
+    transform = QgsCoordinateTransform(src, dst, QgsProject.instance())
+    transformed = []
+    for bbox in bboxes:
+        rect = transform.transformBoundingBox(QgsRectangle(*bbox))
+        transformed.append((rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()))
+    return transformed
+
+
+def _pixel_size(projection, zoom):
+    """Return the size of a pixel at zoom, in the projection units"""
+
+    ul = projection.coordinateProj(Coordinate(0, 0, zoom))
+    ur = projection.coordinateProj(Coordinate(0, 1, zoom))
+    return abs(ur.x - ul.x) / getattr(projection, 'tilesize', 256)
+
+
+def get_invalidation_coordinates(projection, bboxes, zooms, pixel_buffer=INVALIDATION_PIXEL_BUFFER):
+    """
+    Return the coordinates of the tiles intersecting the padded bboxes
+    :param projection: TileStache layer projection
+    :param bboxes: list of (xmin, ymin, xmax, ymax) in the projection CRS
+    :param zooms: zoom levels
+    :param pixel_buffer: padding in pixels at each zoom level
+    :return: set of (zoom, column, row) tuples
+    """
+
+    coordinates = set()
+    for zoom in zooms:
+        pad = pixel_buffer * _pixel_size(projection, zoom)
+        for xmin, ymin, xmax, ymax in bboxes:
+            coordinates.update(get_seed_coordinates(projection, (xmin - pad, ymin - pad, xmax + pad, ymax + pad),
+                                                    [zoom]))
+    return coordinates
+
+
+def count_invalidation_coordinates(projection, bboxes, zooms, pixel_buffer=INVALIDATION_PIXEL_BUFFER):
+    """
+    Return an upper bound of the number of tiles intersecting the padded bboxes
+    :return: int
+    """
+
+    total = 0
+    for zoom in zooms:
+        pad = pixel_buffer * _pixel_size(projection, zoom)
+        for xmin, ymin, xmax, ymax in bboxes:
+            total += count_seed_coordinates(projection, (xmin - pad, ymin - pad, xmax + pad, ymax + pad), [zoom])
+    return total
+
+
+def invalidate_tiles(layer_key_name, bboxes, crs=None, zooms=None, extension='png', reseed=False):
+    """
+    Remove the cached tiles of a caching layer which intersect the bboxes
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param bboxes: list of (xmin, ymin, xmax, ymax)
+    :param crs: CRS auth id of the bboxes, defaults to the caching grid CRS
+    :param zooms: zoom levels, defaults to 0 - TILESTACHE_INVALIDATION_MAX_ZOOM
+    :param extension: tile format extension
+    :param reseed: render the removed tiles again
+    :return: number of removed tiles, None if the whole layer cache has been reset
+    """
+
+    from caching.utils import get_config
+
+    tilestache_cfg = get_config()
+    config = tilestache_cfg.config
+    layer = config.layers[layer_key_name]
+    mimetype, tile_format = layer.getTypeByExtension(extension)
+
+    if crs is not None:
+        bboxes = transform_bboxes(bboxes, crs, layer.projection.srs)
+    if zooms is None:
+        zooms = range(0, INVALIDATION_MAX_ZOOM + 1)
+
+    if count_invalidation_coordinates(layer.projection, bboxes, zooms) > INVALIDATION_MAX_TILES:
+        logger.debug('Too many tiles to invalidate for {}: resetting the layer cache'.format(layer_key_name))
+        tilestache_cfg.erase_cache_layer(layer_key_name)
+        return None
+
+    coordinates = get_invalidation_coordinates(layer.projection, bboxes, zooms)
+    with layer_generation(layer_key_name):
+        for zoom, column, row in coordinates:
+            config.cache.remove(layer, Coordinate(row, column, zoom), tile_format)
+
+    logger.debug('{} tiles invalidated for {}'.format(len(coordinates), layer_key_name))
+
+    if reseed:
+        seed_tiles(layer_key_name, sorted(coordinates), extension)
+
+    return len(coordinates)
@@ -0,0 +1,349 @@
+# coding=utf-8
+""""MBTiles tile cache for TileStache
+
+Every caching layer is stored in a single MBTiles (SQLite) file for each cache
+generation of the layer, instead of one file per tile as the Disk cache does:
+
+    {path}/{layer}/g{generation}.mbtiles
+
+Files are opened in WAL mode, so that tiles can be read while other processes
+write. Tile writes can be batched in a single transaction during seeding and a
+layer can be seeded into a new file (``{path}/{layer}/seed.mbtiles``) which
+becomes the next generation of the layer when the seeding is completed.
+
+File names are never reused: a reset or a swap bumps the layer generation
+(stored in the database) and the files of the previous generations are removed
+in background, this way a SQLite file is never replaced under an open connection.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-16'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import errno
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from .cache import get_layer_generation, set_layer_generation
+
+logger = logging.getLogger('g3wadmin.debug')
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS metadata (name text, value text)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)',
+    'CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)',
+)
+
+FORMATS = {
+    'PNG': 'png',
+    'JPEG': 'jpg',
+    'JPG': 'jpg',
+    'WEBP': 'webp',
+}
+
+SEED_FILENAME = 'seed.mbtiles'
+
+# Files of the layer generations, with their WAL and shared memory files
+GENERATION_FILENAME_RE = re.compile(r'^g(\d+)\.mbtiles(-wal|-shm)?$')
+
+
+class MBTilesCache(object):
+    """
+    TileStache cache storing each layer in a MBTiles file
+
+    :param path: directory of the MBTiles files
+    :param umask: umask for the created files and directories
+    :param batch_size: number of tiles written in a single transaction, 1 to write each tile immediately
+    """
+
+    def __init__(self, path, umask=0o022, batch_size=1):
+
+        self.path = path
+        self.umask = umask
+        self.batch_size = batch_size
+        self._local = threading.local()
+
+        # Layers seeded into a new file in this process
+        self._swapping = set()
+
+    def filename(self, layer_name, swap=None):
+        """
+        Return the MBTiles file of the current generation of a layer
+        :param layer_name: TileStache layer name
+        :param swap: return the file of the seeding in progress, defaults to True if
+                     a swap seeding of the layer is in progress in this process
+        """
+
+        if swap or (swap is None and layer_name in self._swapping):
+            return os.path.join(self.path, layer_name, SEED_FILENAME)
+        return os.path.join(self.path, layer_name, 'g{}.mbtiles'.format(get_layer_generation(layer_name)))
+
+    def _connections(self):
+
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+            self._local.pending = {}
+        return self._local.connections
+
+    def _close(self, filename):
+
+        db = self._connections().pop(filename, None)
+        if db is not None:
+            db.close()
+
+    def _connect(self, filename, create=True):
+        """
+        Return a connection to a MBTiles file
+        :param create: create the file if it does not exist, else return None
+        """
+
+        connections = self._connections()
+        db = connections.get(filename)
+        if db is not None:
+            return db
+
+        if not create and not os.path.exists(filename):
+            return None
+
+        # Connections to the previous generations of the layer are no longer needed
+        layer_path = os.path.dirname(filename)
+        for other in [f for f in connections if os.path.dirname(f) == layer_path and
+                      os.path.basename(f) != SEED_FILENAME]:
+            self._close(other)
+
+        umask_old = os.umask(self.umask)
+        try:
+            os.makedirs(layer_path, exist_ok=True)
+            db = sqlite3.connect(filename, timeout=30)
+        finally:
+            os.umask(umask_old)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+
+        connections[filename] = db
+        return db
+
+    def _remove_files(self, filename, suffixes=('', '-wal', '-shm')):
+        """Remove a MBTiles file with its WAL and shared memory files"""
+
+        for suffix in suffixes:
+            try:
+                os.remove(filename + suffix)
+            except FileNotFoundError:
+                pass
+
+    def _tile_row(self, coord):
+        """MBTiles rows are numbered from the bottom (TMS)"""
+
+        return 2 ** coord.zoom - 1 - coord.row
+
+    def _lock_path(self, layer, coord):
+
+        return os.path.join(self.path, layer.name(), 'locks',
+                            '{}-{}-{}'.format(coord.zoom, coord.column, coord.row))
+
+    def lock(self, layer, coord, format):
+        """Acquire a cache lock for this tile, as the TileStache Disk cache does"""
+
+        path = self._lock_path(layer, coord)
+        due = time.time() + layer.stale_lock_timeout
+        umask_old = os.umask(self.umask)
+        try:
+            while True:
+                try:
+                    os.makedirs(path)
+                    break
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST:
+                        raise
+                    if time.time() > due:
+                        # Stale lock, take it over
+                        break
+                    time.sleep(.2)
+        finally:
+            os.umask(umask_old)
+
+    def unlock(self, layer, coord, format):
+        """Release a cache lock for this tile"""
+
+        try:
+            os.rmdir(self._lock_path(layer, coord))
+        except OSError:
+            pass
+
+    def remove(self, layer, coord, format):
+        """Remove a cached tile"""
+
+        self.flush()
+        db = self._connect(self.filename(layer.name()), create=False)
+        if db is None:
+            return
+        with db:
+            db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                       (coord.zoom, coord.column, self._tile_row(coord)))
+
+    def read(self, layer, coord, format):
+        """Read a cached tile, return None on cache miss"""
+
+        filename = self.filename(layer.name())
+        if filename in getattr(self._local, 'pending', {}):
+            self.flush()
+
+        db = self._connect(filename, create=False)
+        if db is None:
+            return None
+        row = db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                         (coord.zoom, coord.column, self._tile_row(coord))).fetchone()
+        return bytes(row[0]) if row else None
+
+    def mtime(self, layer, coord, format):
+        """
+        Return the last time the MBTiles file of the layer was written, tiles have no
+        timestamp of their own: the tile was written at this time or before
+        :return: timestamp, None if the file does not exist
+        """
+
+        filename = self.filename(layer.name())
+        mtimes = []
+        for path in (filename, filename + '-wal'):
+            try:
+                mtimes.append(os.path.getmtime(path))
+            except OSError:
+                pass
+        return max(mtimes) if mtimes else None
+
+    def save(self, body, layer, coord, format):
+        """Save a cached tile, tiles are written in batches of batch_size tiles"""
+
+        filename = self.filename(layer.name())
+        self._connections()
+        pending = self._local.pending.setdefault(filename, {'format': format.upper(), 'tiles': []})
+        pending['tiles'].append((coord.zoom, coord.column, self._tile_row(coord), sqlite3.Binary(body)))
+
+        if len(pending['tiles']) >= getattr(self._local, 'batch_size', self.batch_size):
+            self.flush()
+
+    def flush(self):
+        """Write the pending tiles of this thread"""
+
+        pending = getattr(self._local, 'pending', {})
+        while pending:
+            filename, batch = pending.popitem()
+            db = self._connect(filename)
+            with db:
+                db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)',
+                           ('format', FORMATS.get(batch['format'], batch['format'].lower())))
+                db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', batch['tiles'])
+
+    def begin_batch(self, batch_size):
+        """Write tiles in batches of batch_size tiles in this thread, i.e. while seeding"""
+
+        self._connections()
+        self._local.batch_size = batch_size
+
+    def end_batch(self):
+        """Write the pending tiles and go back to the default batch size"""
+
+        self.flush()
+        self._local.__dict__.pop('batch_size', None)
+
+    def begin_swap(self, layer_name, reset=False):
+        """
+        Write the tiles of the layer to a new file in this process, the current
+        generation is still served until commit_swap() is called
+        :param layer_name: TileStache layer name
+        :param reset: remove the new file if it exists, False to resume an interrupted seeding
+        """
+
+        if reset:
+            filename = self.filename(layer_name, swap=True)
+            self._close(filename)
+            self._remove_files(filename)
+        self._swapping.add(layer_name)
+
+    def abort_swap(self, layer_name):
+        """Go back to the current generation of the layer in this process,
+        the new file is kept to resume the seeding"""
+
+        self.flush()
+        self._swapping.discard(layer_name)
+        self._close(self.filename(layer_name, swap=True))
+
+    def commit_swap(self, layer_name):
+        """Make the new file the next generation of the layer
+        :return: the new generation
+        """
+
+        self.flush()
+        self._swapping.discard(layer_name)
+        seed_filename = self.filename(layer_name, swap=True)
+
+        # Merge the WAL into the database before renaming it
+        db = self._connect(seed_filename)
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._close(seed_filename)
+
+        # The file is linked (never replaced) to the name of the next generation, then the
+        # generation is bumped only if it has not been changed in the meantime (compare and swap)
+        layer_path = os.path.join(self.path, layer_name)
+        while True:
+            generation = get_layer_generation(layer_name)
+            new_generation = generation + 1
+            new_filename = os.path.join(layer_path, 'g{}.mbtiles'.format(new_generation))
+            if not os.path.exists(new_filename):
+                # A stale WAL would be applied to the new file
+                self._remove_files(new_filename, suffixes=('-wal', '-shm'))
+            try:
+                os.link(seed_filename, new_filename)
+            except FileExistsError:
+                if get_layer_generation(layer_name) == generation:
+                    # Left by an interrupted swap, nobody uses it
+                    self._remove_files(new_filename)
+                continue
+            if set_layer_generation(layer_name, generation, new_generation):
+                break
+            # The layer has been reset in the meantime: try again with the new generation
+            if get_layer_generation(layer_name) < new_generation:
+                self._remove_files(new_filename)
+
+        self._remove_files(seed_filename)
+
+        logger.debug('MBTiles file of layer {} swapped, generation {}'.format(layer_name, new_generation))
+        self.collect_garbage(layer_name, new_generation)
+        return new_generation
+
+    def collect_garbage(self, layer_name, generation=None):
+        """Remove the files of the previous generations of a layer
+        :param layer_name: TileStache layer name
+        :param generation: the current generation, files of this and of the following
+                           generations are kept, defaults to the current one
+        """
+
+        if generation is None:
+            generation = get_layer_generation(layer_name)
+
+        layer_path = os.path.join(self.path, layer_name)
+        try:
+            entries = os.listdir(layer_path)
+        except FileNotFoundError:
+            return
+
+        for entry in entries:
+            match = GENERATION_FILENAME_RE.match(entry)
+            if match and int(match.group(1)) < generation:
+                try:
+                    os.remove(os.path.join(layer_path, entry))
+                except FileNotFoundError:
+                    pass
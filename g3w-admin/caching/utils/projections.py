@@ -1,13 +1,44 @@
+import math
 import re
 from ModestMaps.Core import Point, Coordinate
 from TileStache.Geography import SphericalMercator, WGS84
 
+# Number of zoom levels of the custom grids
+GRID_ZOOM_LEVELS = 25
+
+# Legacy grid: power of two resolutions from 2^15 to 2^-9 map units per pixel,
+# origin in (0, 0): it covers [0, tilesize * 2^15] on both axes
+LEGACY_RESOLUTIONS = [2**(x+1) for x in list(reversed(range(15)))] + [1.0/2**x for x in range(10)]
+
+
 class CustomGridProjection():
-    def __init__(self, xyz, srs):
+    """
+    Tile grid for the CRSs without a standard TileStache projection.
+
+    The legacy grid (fixed resolutions, origin in 0, 0) is used when it covers
+    the extent: the grid of the existing caches and clients does not change.
+    Otherwise, i.e. for geographic CRSs or extents with negative coordinates,
+    the grid is fitted to the extent: zoom level 0 is a single tile covering
+    the extent, with a power of two resolution in map units.
+
+    :param xyz: True for XYZ (rows from top) grids, False for TMS
+    :param srs: CRS, i.e. 'EPSG:3003'
+    :param extent: (xmin, ymin, xmax, ymax) to be covered by the grid, in the CRS units
+    :param geographic: True if the CRS units are degrees
+    :param tilesize: tile size in pixels
+    """
+
+    def __init__(self, xyz, srs, extent=None, geographic=False, tilesize=256):
         self.xyz = xyz
         self.srs = self.normalizeSrs(srs)
-        self.tilesize = 256
-        self.resolutions = [2**(x+1) for x in list(reversed(range(15)))] + [1.0/2**x for x in range(10)]
+        self.tilesize = tilesize
+
+        if extent is None or (not geographic and self._legacyCovers(extent)):
+            self.resolutions = LEGACY_RESOLUTIONS
+            self.left = 0.0
+            self.top = self.tilesize * self.resolutions[0]
+        else:
+            self.resolutions, self.left, self.top = self._fitGrid(extent)
 
         self.standardProjections = {
             'EPSG:3857': SphericalMercator(),
@@ -18,18 +49,48 @@ class CustomGridProjection():
 
         standardProjection = self.standardProjections.get(self.srs, None)
         self.coordinateProj = standardProjection.coordinateProj if standardProjection else self._coordinateProj
+        self.projCoordinate = standardProjection.projCoordinate if standardProjection else self._projCoordinate
+
+    def _legacyCovers(self, extent):
+        xmin, ymin, xmax, ymax = extent
+        size = self.tilesize * LEGACY_RESOLUTIONS[0]
+        return xmin >= 0 and ymin >= 0 and xmax <= size and ymax <= size
+
+    def _fitGrid(self, extent):
+        """Return resolutions, left and top of the smallest grid with a single tile covering the extent"""
+        xmin, ymin, xmax, ymax = extent
+        span = max(xmax - xmin, ymax - ymin, 1e-9)
+        resolution = 2.0 ** math.ceil(math.log2(span / self.tilesize))
+        while True:
+            # Origin snapped to a quarter of the tile span: the grid is stable for small extent changes
+            tile_span = self.tilesize * resolution
+            snap = tile_span / 4
+            left = math.floor(xmin / snap) * snap
+            top = math.ceil(ymax / snap) * snap
+            if left + tile_span >= xmax and top - tile_span <= ymin:
+                break
+            resolution *= 2
+        return [resolution / 2**x for x in range(GRID_ZOOM_LEVELS)], left, top
 
     def _coordinateProj(self, coord):
-        tile_meters = self.tilesize * self.resolutions[coord.zoom]
-        row = (2**coord.zoom - coord.row) if self.xyz else coord.row
-        px = coord.column * tile_meters
-        py = row * tile_meters
-        print(px, py)
-        return Point(px,py)
+        tile_span = self.tilesize * self.resolutions[coord.zoom]
+        px = self.left + coord.column * tile_span
+        if self.xyz:
+            py = self.top - coord.row * tile_span
+        else:
+            py = self.top - self.tilesize * self.resolutions[0] + coord.row * tile_span
+        return Point(px, py)
+
+    def _projCoordinate(self, point):
+        """Inverse of _coordinateProj: returns the (fractional) Coordinate at zoom 0 of a point"""
+        tile_span = self.tilesize * self.resolutions[0]
+        column = (point.x - self.left) / tile_span
+        row = (self.top - point.y) / tile_span if self.xyz else (point.y - self.top) / tile_span + 1
+        return Coordinate(row, column, 0)
 
     def normalizeSrs(self,srs):
         if isinstance(srs, (int, float)):
-            return 'EPSG:' + srs
+            return 'EPSG:{}'.format(int(srs))
         codes = re.findall(r'\d+', srs)
         if len(codes) > 0:
             return 'EPSG:{}'.format(codes[0])
@@ -37,9 +98,65 @@ class CustomGridProjection():
 
 
 class CustomXYZGridProjection(CustomGridProjection):
-    def __init__(self, srs):
-        CustomGridProjection.__init__(self, True, srs)
+    def __init__(self, srs, extent=None, geographic=False, tilesize=256):
+        CustomGridProjection.__init__(self, True, srs, extent, geographic, tilesize)
 
 class CustomTMSGridProjection(CustomGridProjection):
-    def __init__(self, srs):
-        CustomGridProjection.__init__(self, False, srs)
\ No newline at end of file
+    def __init__(self, srs, extent=None, geographic=False, tilesize=256):
+        CustomGridProjection.__init__(self, False, srs, extent, geographic, tilesize)
+
+
+class TileMatrixSet(object):
+    """
+    WMTS tile matrix set of a TileStache layer projection (XYZ grids only):
+    the tile matrices are computed from the same projection which serves the tiles.
+
+    :param projection: TileStache layer projection
+    :param extent: (xmin, ymin, xmax, ymax) of the layer, in the projection CRS
+    :param meters_per_unit: meters per CRS unit, for the scale denominators
+    :param zooms: zoom levels, defaults to the grid zoom levels (custom grids) or 0 - 20
+    :param tilesize: tile size in pixels
+    """
+
+    # WMTS standardized rendering pixel size in meters
+    PIXEL_SIZE = 0.00028
+
+    def __init__(self, projection, extent, meters_per_unit=1.0, zooms=None, tilesize=256):
+
+        self.projection = projection
+        self.extent = extent
+        self.meters_per_unit = meters_per_unit
+        self.tilesize = getattr(projection, 'tilesize', tilesize)
+        if zooms is None:
+            zooms = range(0, len(projection.resolutions) if hasattr(projection, 'resolutions') else 21)
+        self.zooms = zooms
+
+    def matrix(self, zoom):
+        """
+        Return the tile matrix of a zoom level
+        :return: dict with identifier, scale_denominator, top_left (x, y), tile_width,
+                 tile_height, matrix_width and matrix_height
+        """
+
+        top_left = self.projection.coordinateProj(Coordinate(0, 0, zoom))
+        next_column = self.projection.coordinateProj(Coordinate(0, 1, zoom))
+        resolution = abs(next_column.x - top_left.x) / self.tilesize
+
+        # Tiles from the grid origin to the bottom right corner of the extent
+        xmin, ymin, xmax, ymax = self.extent
+        bottom_right = self.projection.projCoordinate(Point(xmax, ymin)).zoomTo(zoom)
+
+        return {
+            'identifier': str(zoom),
+            'scale_denominator': resolution * self.meters_per_unit / self.PIXEL_SIZE,
+            'top_left': (top_left.x, top_left.y),
+            'tile_width': self.tilesize,
+            'tile_height': self.tilesize,
+            'matrix_width': max(int(math.ceil(bottom_right.column)), 1),
+            'matrix_height': max(int(math.ceil(bottom_right.row)), 1),
+        }
+
+    def matrices(self):
+        """Return the tile matrices of all the zoom levels"""
+
+        return [self.matrix(zoom) for zoom in self.zooms]
@@ -0,0 +1,342 @@
+# coding=utf-8
+""""Tile seeding for caching layers
+
+Pre-renders the tiles of a caching layer over a bbox (defaults to the project
+extent) and a zoom range, on the caching layer grid. Tiles are rendered by a
+pool of processes, tiles already in the cache are skipped and an interrupted
+seeding can be resumed from its last completed chunk of tiles.
+
+Caches which support it (MBTiles) write the tiles of a chunk in a single
+transaction and can seed a new file which replaces the current one at the end.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-15'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import time
+
+from django.conf import settings
+from ModestMaps.Core import Coordinate, Point
+
+from .cache import layer_generation
+
+logger = logging.getLogger('g3wadmin.debug')
+
+# Directory of the seeding state files, used to resume an interrupted seeding
+SEED_STATE_DIR = getattr(settings, 'TILESTACHE_SEED_STATE_DIR', '/tmp/tilestache_g3wsuite_seed')
+
+# Number of tiles sent to a seeding process at once
+SEED_CHUNK_SIZE = getattr(settings, 'TILESTACHE_SEED_CHUNK_SIZE', 64)
+
+
+def get_caching_layer_extent(layer_key_name):
+    """
+    Return the extent of the project of a caching layer, in the caching grid CRS
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :raises G3WCachingLayer.DoesNotExist: if no caching layer matches the key
+    :return: (xmin, ymin, xmax, ymax)
+    """
+
+    from caching.models import G3WCachingLayer
+
+    caching_layer = G3WCachingLayer.get_by_key(layer_key_name)
+    cache_module = __import__('{}.cache'.format(caching_layer.app_name))
+    return getattr(cache_module.cache, 'get_layer_extent')(caching_layer.layer_id)
+
+
+def _zoom_range(projection, bbox, zoom):
+    """Return the (rows, columns) ranges of the tiles covering the bbox at zoom"""
+
+    xmin, ymin, xmax, ymax = bbox
+    ul = projection.projCoordinate(Point(xmin, ymax)).zoomTo(zoom)
+    lr = projection.projCoordinate(Point(xmax, ymin)).zoomTo(zoom)
+
+    rows = range(int(math.floor(min(ul.row, lr.row))), int(math.ceil(max(ul.row, lr.row))))
+    columns = range(int(math.floor(min(ul.column, lr.column))), int(math.ceil(max(ul.column, lr.column))))
+    return rows, columns
+
+
+def count_seed_coordinates(projection, bbox, zooms):
+    """
+    Return the number of tiles covering the bbox for the zoom levels
+    :param projection: TileStache layer projection
+    :param bbox: (xmin, ymin, xmax, ymax) in the projection CRS
+    :param zooms: zoom levels
+    :return: int
+    """
+
+    total = 0
+    for zoom in zooms:
+        rows, columns = _zoom_range(projection, bbox, zoom)
+        total += len(rows) * len(columns)
+    return total
+
+
+def get_seed_coordinates(projection, bbox, zooms, metatile=(1, 1)):
+    """
+    Yield the coordinates of the tiles covering the bbox for the zoom levels
+    :param projection: TileStache layer projection
+    :param bbox: (xmin, ymin, xmax, ymax) in the projection CRS
+    :param zooms: zoom levels
+    :param metatile: (rows, columns) of the layer metatiles, the tiles of a metatile are yielded
+                     together so that they are seeded by the same process
+    :return: generator of (zoom, column, row) tuples
+    """
+
+    meta_rows, meta_columns = metatile
+    for zoom in zooms:
+        rows, columns = _zoom_range(projection, bbox, zoom)
+        if not rows or not columns:
+            continue
+        for meta_row in range(rows.start - rows.start % meta_rows, rows.stop, meta_rows):
+            for meta_column in range(columns.start - columns.start % meta_columns, columns.stop, meta_columns):
+                for row in range(max(meta_row, rows.start), min(meta_row + meta_rows, rows.stop)):
+                    for column in range(max(meta_column, columns.start), min(meta_column + meta_columns, columns.stop)):
+                        yield zoom, column, row
+
+
+def _chunks(coordinates, size, metatile=(1, 1)):
+    """Split the coordinates in chunks of at least size tiles, a chunk never splits a metatile"""
+
+    meta_rows, meta_columns = metatile
+    chunk = []
+    last = None
+    for zoom, column, row in coordinates:
+        current = (zoom, column // meta_columns, row // meta_rows)
+        if len(chunk) >= size and current != last:
+            yield chunk
+            chunk = []
+        chunk.append((zoom, column, row))
+        last = current
+    if chunk:
+        yield chunk
+
+
+def seed_tiles(layer_key_name, coordinates, extension='png', skip_existing=True, swap=False):
+    """
+    Render and store in the cache the tiles of a caching layer
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param coordinates: list of (zoom, column, row) tuples
+    :param extension: tile format extension
+    :param skip_existing: do not render the tiles which are already in the cache
+    :param swap: write the tiles to the new file of the layer, see seed_layer
+    :return: (rendered, skipped, failed) tile counts
+    """
+
+    from caching.utils import get_config
+
+    config = get_config().config
+    layer = config.layers[layer_key_name]
+    mimetype, tile_format = layer.getTypeByExtension(extension)
+
+    if swap:
+        config.cache.begin_swap(layer_key_name)
+
+    # Write the tiles of the chunk in a single transaction
+    batch = hasattr(config.cache, 'begin_batch')
+    if batch:
+        config.cache.begin_batch(len(coordinates))
+
+    # Metatiles rendered by this call: all their tiles are saved at once
+    metatiles = set()
+
+    rendered = skipped = failed = 0
+    try:
+        for zoom, column, row in coordinates:
+            coord = Coordinate(row, column, zoom)
+            try:
+                with layer_generation(layer_key_name):
+                    if skip_existing and config.cache.read(layer, coord, tile_format) is not None:
+                        skipped += 1
+                        continue
+                    first = layer.metatile.firstCoord(coord)
+                    metatile = (first.zoom, first.column, first.row)
+                    if metatile not in metatiles:
+                        layer.getTileResponse(coord, extension, ignore_cached=True)
+                        metatiles.add(metatile)
+                rendered += 1
+            except Exception as ex:
+                logger.error('Seeding {} tile {}/{}/{} failed: {}'.format(layer_key_name, zoom, column, row, ex))
+                failed += 1
+    finally:
+        if batch:
+            config.cache.end_batch()
+
+    return rendered, skipped, failed
+
+
+def _init_worker():
+    """Initialize Django (and therefore QGIS) in a seeding process"""
+
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'base.settings')
+    django.setup()
+
+
+def _seed_chunk(args):
+
+    index, layer_key_name, coordinates, extension, skip_existing, swap = args
+    return (index, ) + seed_tiles(layer_key_name, coordinates, extension, skip_existing, swap)
+
+
+class SeedState(object):
+    """
+    Persistent state of a seeding job: the number of contiguous chunks
+    completed from the start, used to resume an interrupted seeding.
+    """
+
+    def __init__(self, layer_key_name, bbox, zooms, extension, metatile=(1, 1)):
+
+        job = json.dumps([layer_key_name, list(bbox), list(zooms), extension, SEED_CHUNK_SIZE, list(metatile)])
+        self.path = os.path.join(SEED_STATE_DIR, '{}-{}.json'.format(
+            layer_key_name, hashlib.sha1(job.encode('utf-8')).hexdigest()))
+        self.completed = set()
+        self.done = 0
+
+    def load(self):
+
+        try:
+            with open(self.path) as f:
+                self.done = json.load(f)['done']
+        except (FileNotFoundError, ValueError, KeyError):
+            self.done = 0
+        return self.done
+
+    def complete(self, index):
+        """Mark a chunk as completed and save the state"""
+
+        self.completed.add(index)
+        done = self.done
+        while done in self.completed:
+            self.completed.discard(done)
+            done += 1
+
+        if done != self.done:
+            self.done = done
+            os.makedirs(SEED_STATE_DIR, exist_ok=True)
+            tmp_path = '{}.tmp'.format(self.path)
+            with open(tmp_path, 'w') as f:
+                json.dump({'done': self.done}, f)
+            os.replace(tmp_path, self.path)
+
+    def delete(self):
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def seed_layer(layer_key_name, bbox=None, zooms=range(0, 11), extension='png', processes=None,
+               skip_existing=True, resume=True, swap=False, progress=None):
+    """
+    Seed a caching layer
+
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param bbox: (xmin, ymin, xmax, ymax) in the caching grid CRS, defaults to the project extent
+    :param zooms: zoom levels
+    :param extension: tile format extension
+    :param processes: number of rendering processes, defaults to TILESTACHE_SEED_PROCESSES or 1
+    :param skip_existing: do not render the tiles which are already in the cache
+    :param resume: resume an interrupted seeding of the same layer, bbox and zooms
+    :param swap: seed a new cache file of the layer, which atomically replaces the current
+                 one when the seeding is completed, only for caches with swap support (MBTiles)
+    :param progress: optional callable, called with a dict with keys total, done, rendered,
+                     skipped, failed and tiles_per_second after each chunk of tiles
+    :return: dict with the final progress values
+    """
+
+    from caching.utils import get_config
+
+    if bbox is None:
+        bbox = get_caching_layer_extent(layer_key_name)
+    zooms = list(zooms)
+    processes = processes or getattr(settings, 'TILESTACHE_SEED_PROCESSES', 1)
+
+    config = get_config().config
+    layer = config.layers[layer_key_name]
+    total = count_seed_coordinates(layer.projection, bbox, zooms)
+
+    if swap and not hasattr(config.cache, 'begin_swap'):
+        raise ValueError('The tile cache does not support swap seeding')
+
+    # Tiles of a metatile are rendered at once, by the same process
+    metatile = (layer.metatile.rows, layer.metatile.columns)
+
+    state = SeedState(layer_key_name, bbox, zooms, extension, metatile)
+    first_chunk = state.load() if resume else 0
+
+    if swap:
+        # Start from an empty file unless resuming
+        config.cache.begin_swap(layer_key_name, reset=first_chunk == 0)
+
+    stats = {
+        'total': total,
+        'done': min(first_chunk * SEED_CHUNK_SIZE, total),
+        'rendered': 0,
+        'skipped': 0,
+        'failed': 0,
+        'tiles_per_second': 0,
+    }
+
+    logger.info('Seeding {}: {} tiles, bbox {}, zooms {}-{}, resuming from tile {}'.format(
+        layer_key_name, total, bbox, min(zooms), max(zooms), stats['done']))
+
+    jobs = ((index, layer_key_name, chunk, extension, skip_existing, swap)
+            for index, chunk in enumerate(_chunks(get_seed_coordinates(layer.projection, bbox, zooms, metatile),
+                                                  SEED_CHUNK_SIZE, metatile))
+            if index >= first_chunk)
+
+    start = time.time()
+    seeded = 0
+
+    def update(result):
+
+        nonlocal seeded
+        index, rendered, skipped, failed = result
+        state.complete(index)
+        stats['rendered'] += rendered
+        stats['skipped'] += skipped
+        stats['failed'] += failed
+        stats['done'] += rendered + skipped + failed
+        seeded += rendered + skipped + failed
+        stats['tiles_per_second'] = seeded / max(time.time() - start, 0.001)
+        if progress is not None:
+            progress(dict(stats))
+
+    try:
+        if processes > 1:
+            # Spawn: QGIS must not be inherited from the parent process
+            with multiprocessing.get_context('spawn').Pool(processes, initializer=_init_worker) as pool:
+                for result in pool.imap_unordered(_seed_chunk, jobs):
+                    update(result)
+        else:
+            for job in jobs:
+                update(_seed_chunk(job))
+    except BaseException:
+        if swap:
+            # The tile cache config is shared by the process: serve the current generation again
+            config.cache.abort_swap(layer_key_name)
+        raise
+
+    if swap:
+        config.cache.commit_swap(layer_key_name)
+
+    state.delete()
+
+    logger.info('Seeding {} completed: {} rendered, {} skipped, {} failed, {:.1f} tiles/s'.format(
+        layer_key_name, stats['rendered'], stats['skipped'], stats['failed'], stats['tiles_per_second']))
+
+    return stats
@@ -0,0 +1,208 @@
+# coding=utf-8
+""""Tile cache statistics for caching layers
+
+Hits, misses, render time and bytes served by the tile API are counted per
+caching layer in each process and added to the shared counters in the Django
+cache (TILESTACHE_CACHE_NAME) at most every TILESTACHE_STATS_FLUSH_INTERVAL
+seconds, so that the tile path does not hit the cache backend on every tile.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-20'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+# Seconds between two flushes of the process counters to the shared counters
+STATS_FLUSH_INTERVAL = getattr(settings, 'TILESTACHE_STATS_FLUSH_INTERVAL', 10)
+
+STATS_KEY = 'tilestache_stats_{}_{}'
+
+# Storage size of the cached tiles of a layer: it is computed by a background task (walking the
+# tile tree can take longer than a request) and computed again after this number of seconds
+SIZE_REFRESH_INTERVAL = getattr(settings, 'TILESTACHE_CACHE_SIZE_REFRESH_INTERVAL', 3600)
+
+SIZE_KEY = 'tilestache_size_{}'
+SIZE_PENDING_KEY = 'tilestache_size_pending_{}'
+
+# Shared counters, render time is in milliseconds
+COUNTERS = ('hits', 'misses', 'render_ms', 'bytes')
+
+_counters = dict()
+_counters_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def _cache():
+
+    return caches[getattr(settings, 'TILESTACHE_CACHE_NAME', 'mced')]
+
+
+class StatsCache(object):
+    """
+    TileStache cache proxy which records if the last tile read in this thread was a cache hit,
+    and when the tile was written if the cache tells it
+
+    :param cache: TileStache cache
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._local = threading.local()
+
+    def read(self, layer, coord, format):
+        body = self._cache.read(layer, coord, format)
+        self._local.hit = body is not None
+        self._local.mtime = None
+        if body is not None and hasattr(self._cache, 'mtime'):
+            self._local.mtime = self._cache.mtime(layer, coord, format)
+        return body
+
+    def reset_hit(self):
+        """Forget the last read of this thread, before a tile request"""
+        self._local.hit = False
+        self._local.mtime = None
+
+    def last_read_hit(self):
+        """Return True if the last read of this thread was a cache hit"""
+        return getattr(self._local, 'hit', False)
+
+    def last_read_mtime(self):
+        """Return the time the tile of the last cache hit of this thread was written,
+        None if not known"""
+        return getattr(self._local, 'mtime', None)
+
+    def __getattr__(self, attr):
+        return getattr(self._cache, attr)
+
+
+def record_tile(layer_key_name, hit, nbytes, render_time):
+    """
+    Count a tile served by the tile API
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param hit: True if the tile was read from the cache
+    :param nbytes: bytes of the response body
+    :param render_time: seconds spent to get the tile
+    :return: None
+    """
+
+    global _last_flush
+
+    with _counters_lock:
+        counters = _counters.setdefault(layer_key_name, dict.fromkeys(COUNTERS, 0))
+        if hit:
+            counters['hits'] += 1
+        else:
+            counters['misses'] += 1
+            counters['render_ms'] += int(render_time * 1000)
+        counters['bytes'] += nbytes
+
+        if time.time() - _last_flush < STATS_FLUSH_INTERVAL:
+            return
+        _last_flush = time.time()
+
+    flush_stats()
+
+
+def flush_stats():
+    """
+    Add the counters of this process to the shared counters
+    :return: None
+    """
+
+    with _counters_lock:
+        pending = dict(_counters)
+        _counters.clear()
+
+    cache = _cache()
+    for layer_key_name, counters in pending.items():
+        for name, value in counters.items():
+            if not value:
+                continue
+            key = STATS_KEY.format(layer_key_name, name)
+            try:
+                cache.incr(key, value)
+            except ValueError:
+                cache.set(key, value, None)
+
+
+def get_layer_stats(layer_key_name):
+    """
+    Return the shared counters of a caching layer
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: dict with hits, misses, render_ms, bytes, requests, hit_ratio (percent)
+             and avg_render_ms
+    """
+
+    values = _cache().get_many([STATS_KEY.format(layer_key_name, name) for name in COUNTERS])
+    stats = {name: values.get(STATS_KEY.format(layer_key_name, name), 0) for name in COUNTERS}
+
+    stats['requests'] = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(100.0 * stats['hits'] / stats['requests'], 1) if stats['requests'] else None
+    stats['avg_render_ms'] = int(stats['render_ms'] / stats['misses']) if stats['misses'] else None
+    return stats
+
+
+def reset_layer_stats(layer_key_name):
+    """
+    Reset the shared counters of a caching layer
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: None
+    """
+
+    _cache().delete_many([STATS_KEY.format(layer_key_name, name) for name in COUNTERS])
+
+
+def get_layer_size(layer_key_name):
+    """
+    Return the last computed storage size of the cached tiles of a caching layer
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: (size in bytes, timestamp of the computation), (None, None) if never computed
+    """
+
+    return _cache().get(SIZE_KEY.format(layer_key_name)) or (None, None)
+
+
+def set_layer_size(layer_key_name, size):
+    """
+    Store the computed storage size of the cached tiles of a caching layer
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :param size: size in bytes, None if not available for the cache type
+    :return: None
+    """
+
+    cache = _cache()
+    cache.set(SIZE_KEY.format(layer_key_name), (size, time.time()), None)
+    cache.delete(SIZE_PENDING_KEY.format(layer_key_name))
+
+
+def reset_layer_size(layer_key_name):
+    """
+    Forget the computed storage size of a caching layer, i.e. after a cache reset
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: None
+    """
+
+    _cache().delete(SIZE_KEY.format(layer_key_name))
+
+
+def claim_layer_size_refresh(layer_key_name):
+    """
+    Check if the storage size of a caching layer has to be computed again: only the first
+    caller gets True until the size is stored or SIZE_REFRESH_INTERVAL seconds have passed
+    :param layer_key_name: caching layer key, i.e. 'qdjango12'
+    :return: bool
+    """
+
+    __, computed = get_layer_size(layer_key_name)
+    if computed is not None and time.time() - computed < SIZE_REFRESH_INTERVAL:
+        return False
+    return _cache().add(SIZE_PENDING_KEY.format(layer_key_name), True, SIZE_REFRESH_INTERVAL)
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 from django.apps import apps
 from django.views.generic import FormView, View
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, Http404
+from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.urls import reverse
+from django.shortcuts import render
 from django.utils.translation import ugettext as _
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.utils.decorators import method_decorator
 import TileStache
 from rest_framework.views import APIView
@@ -15,11 +19,20 @@ from core.utils.decorators import project_type_permission_required
 from core.models import BaseLayer
 from .forms import ActiveCachingLayerForm
 from .models import G3WCachingLayer
-from .utils import get_config, TilestacheConfig
+from .utils import get_config, bump_config_generation, TilestacheConfig, TILESTACHE_CACHE_ENCODING
+from .utils.cache import layer_generation
+from .utils.encoding import sniff_mimetype, ENCODING_MIMETYPES
+from .utils.stats import (get_layer_stats, record_tile, reset_layer_stats, get_layer_size,
+                          claim_layer_size_refresh)
 from .api.permissions import TilePermission
 from django.core.cache import caches
 from qdjango.models import Layer as QdjangoLayer
-from qgis.core import QgsCoordinateReferenceSystem
+from .utils.invalidation import transform_bboxes
+from .utils.projections import TileMatrixSet
+from .utils.seeding import get_caching_layer_extent
+from qgis.core import QgsCoordinateReferenceSystem, QgsUnitTypes
+import datetime
+import hashlib
 import time
 import json
 
@@ -41,6 +54,25 @@ class ActiveCachingLayerView(AjaxableFormResponseMixin, G3WProjectViewMixin, G3W
     def get_success_url(self):
         return None
 
+    def get_context_data(self, **kwargs):
+
+        context = super(ActiveCachingLayerView, self).get_context_data(**kwargs)
+
+        # Tile cache statistics of the activated caching layer, the storage size is
+        # computed in background and the last computed value is shown
+        if self.activated:
+            layer_key_name = str(self.activated)
+            context['stats'] = get_layer_stats(layer_key_name)
+            size, computed = get_layer_size(layer_key_name)
+            context['stats']['size'] = size
+            context['stats']['size_computed'] = datetime.datetime.fromtimestamp(computed, tz=datetime.timezone.utc) \
+                if computed is not None else None
+            if claim_layer_size_refresh(layer_key_name):
+                from caching.tasks import compute_caching_layer_size_task
+                compute_caching_layer_size_task(layer_key_name)
+
+        return context
+
     def get_form_kwargs(self):
 
         kwargs = super(ActiveCachingLayerView, self).get_form_kwargs()
@@ -60,6 +92,8 @@ class ActiveCachingLayerView(AjaxableFormResponseMixin, G3WProjectViewMixin, G3W
         try:
             self.activated = G3WCachingLayer.objects.get(app_name=self.app_name, layer_id=self.layer_id)
             kwargs['initial']['active'] = True
+            kwargs['initial']['max_age'] = self.activated.max_age
+            kwargs['initial']['encoding'] = self.activated.encoding
             if self.activated.baselayer_id != None:
                 kwargs['initial']['as_base_layer'] = True
                 kwargs['initial']['base_layer_title'] = self.activated.base_layer.title
@@ -158,16 +192,26 @@ class ActiveCachingLayerView(AjaxableFormResponseMixin, G3WProjectViewMixin, G3W
         if form.cleaned_data['active']:
             if not self.activated:
                 self.activated = G3WCachingLayer.objects.create(app_name=self.app_name, layer_id=self.layer_id)
+            if (self.activated.max_age, self.activated.encoding) != \
+                    (form.cleaned_data['max_age'], form.cleaned_data['encoding']):
+                if self.activated.encoding != form.cleaned_data['encoding']:
+                    # Tiles in the previous encoding are no longer valid
+                    get_config().erase_cache_layer(str(self.activated))
+                self.activated.max_age = form.cleaned_data['max_age']
+                self.activated.encoding = form.cleaned_data['encoding']
+                self.activated.save()
 
             # Baselayer management
             self._crud_baselayer(form)
         else:
             if self.activated:
+                reset_layer_stats(str(self.activated))
                 self.activated.delete()
             if self.base_layer:
                 self.base_layer.delete()
 
         TilestacheConfig.set_cache_config_dict(TilestacheConfig().config_dict)
+        bump_config_generation()
 
         return super(ActiveCachingLayerView, self).form_valid(form)
 
@@ -211,6 +255,9 @@ class TileStacheTileApiView(APIView):
         TilePermission,
     )
 
+    # Tiles are public: skip the session and user lookups on every tile hit
+    authentication_classes = ()
+
     def get(self, request, layer_name, z, x, y, extension):
         """
         Fetch tiles with tilestache.
@@ -226,9 +273,16 @@ class TileStacheTileApiView(APIView):
             except:
                 return Response({'status': 'layer not found'}, status=status.HTTP_404_NOT_FOUND)
 
-            status_code, headers, content = tilestache_layer.getTileResponse(coord, extension)
+            # The layer cache generation is read once for the lock, read and save of the tile
+            with layer_generation(layer_name) as generation:
+                config.cache.reset_hit()
+                start = time.time()
+                status_code, headers, content = tilestache_layer.getTileResponse(coord, extension)
+                hit = config.cache.last_read_hit()
+                elapsed = time.time() - start
 
-            mimetype = headers.get('Content-Type')
+            # Content type of the layer encoding, it may differ from the URL extension
+            mimetype = sniff_mimetype(content) or headers.get('Content-Type')
             if len(content) == 0:
                 status_code = 404
 
@@ -239,8 +293,29 @@ class TileStacheTileApiView(APIView):
                     'status': status_code
                 }
             )
-            if hasattr(tilestache_layer, 'allowed origin'):
-                response['Access-Control-Allow-Origin'] = tilestache_layer.get('allowed origin')
+
+            # Cache-Control and Expires from the layer 'maximum cache age', CORS from 'allowed origin'
+            for header in ('Cache-Control', 'Expires', 'Access-Control-Allow-Origin'):
+                if headers.get(header):
+                    response[header] = headers.get(header)
+
+            if status_code == 200:
+
+                # Strong validator: the layer cache generation and the tile digest, the digest
+                # also covers the tiles rendered again after a partial invalidation
+                response['ETag'] = quote_etag('{}-{}'.format(generation, hashlib.md5(content).hexdigest()))
+
+                # Weak validator: when the cached tile was written, a rendered tile is new
+                last_modified = config.cache.last_read_mtime() if hit else time.time()
+                if last_modified is not None:
+                    last_modified = int(last_modified)
+                    response['Last-Modified'] = http_date(last_modified)
+
+                response = get_conditional_response(request, etag=response['ETag'],
+                                                    last_modified=last_modified, response=response)
+
+            record_tile(layer_name, hit, len(response.content), elapsed)
+
             return response
         except Exception as ex:
             return Response(
@@ -250,3 +325,51 @@ class TileStacheTileApiView(APIView):
                 },
                 status=status.HTTP_404_NOT_FOUND
             )
+
+
+class WMTSCapabilitiesView(View):
+    """
+    WMTS GetCapabilities document of a caching layer, the tile matrix set is
+    computed from the same grid which serves the tiles (RESTful encoding)
+    """
+
+    def get(self, request, layer_name):
+
+        try:
+            tilestache_layer = get_config().config.layers[layer_name]
+        except KeyError:
+            raise Http404
+
+        try:
+            caching_layer = G3WCachingLayer.get_by_key(layer_name)
+            Layer = apps.get_app_config(caching_layer.app_name).get_model('layer')
+            layer = Layer.objects.get(pk=caching_layer.layer_id)
+        except ObjectDoesNotExist:
+            raise Http404
+
+        projection = tilestache_layer.projection
+        extent = get_caching_layer_extent(layer_name)
+        crs = QgsCoordinateReferenceSystem(projection.srs)
+        meters_per_unit = QgsUnitTypes.fromUnitToUnitFactor(crs.mapUnits(), QgsUnitTypes.DistanceMeters)
+
+        matrices = TileMatrixSet(projection, extent, meters_per_unit).matrices()
+        if crs.hasAxisInverted():
+            for matrix in matrices:
+                matrix['top_left'] = tuple(reversed(matrix['top_left']))
+
+        # Tile URL template: {TileMatrix}/{TileCol}/{TileRow} are z/x/y of the tile API
+        tile_url = reverse('caching-api-tile', args=[layer_name, 0, 0, 0, 'png'])
+        tile_url = tile_url[:-len('0/0/0.png')] + '{TileMatrix}/{TileCol}/{TileRow}.png'
+
+        # The tile URL extension does not change with the encoding, the formats are those of the tile data
+        mimetypes = ENCODING_MIMETYPES[caching_layer.encoding or TILESTACHE_CACHE_ENCODING]
+
+        return render(request, 'caching/wmts_capabilities.xml', {
+            'title': layer.title,
+            'layer_name': layer_name,
+            'srid': projection.srs.split(':')[-1],
+            'wgs84_bbox': transform_bboxes([extent], projection.srs, 'EPSG:4326')[0],
+            'tile_url': request.build_absolute_uri(tile_url),
+            'mimetypes': mimetypes,
+            'matrices': matrices,
+        }, content_type='application/xml')
@@ -26,6 +26,9 @@ class MetadataVectorLayer(object):
         self.relation_id = relation_id
         self.lock = lock
 
+        # Bounding boxes (layer CRS) of the geometries changed by editing
+        self.changed_extents = list()
+
         for k, v in list(kwargs.items()):
             setattr(self, k, v)
 
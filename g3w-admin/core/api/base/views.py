@@ -3,21 +3,16 @@ from collections import OrderedDict
 from copy import copy
 
 from django.conf import settings
-from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.gdal import OGRGeometry
 from django.core.exceptions import PermissionDenied
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
 from django.utils import six
 from django.utils.translation import ugettext
 from django.utils.translation import ugettext_lazy as _
 from qgis.core import (
     QgsJsonExporter,
-    QgsCoordinateTransform,
     QgsCoordinateReferenceSystem,
-    QgsCoordinateTransformContext,
     QgsFeatureRequest,
-    QgsWkbTypes,
-    QgsVectorLayer,
-    QgsJsonUtils,
     QgsFeature
 )
 from rest_framework import exceptions, status
@@ -34,7 +29,11 @@ from core.signals import (before_return_vector_data_layer,
 from core.utils.structure import (APIVectorLayerStructure, mapLayerAttributes,
                                   mapLayerAttributesFromQgisLayer)
 from core.utils.vector import BaseUserMediaHandler as UserMediaHandler
-from core.utils.qgisapi import get_qgis_features, count_qgis_features, server_fid
+from core.utils.geojson import StreamingFeatureCollection, stream_json
+from core.utils.geo import get_coord_transform
+from core.utils.qgisapi import (get_qgis_features, count_qgis_features, server_fid, feature_cursor,
+                                get_qgis_unique_values, get_coordinate_transform, set_destination_crs,
+                                iter_qgis_features, FeaturesBudget)
 
 import logging
 
@@ -211,6 +210,9 @@ class BaseVectorOnModelApiView(G3WAPIView):
 
     pagination_class = G3WAPIPaginator
 
+    # Set by the data mode to stream the results as a StreamingHttpResponse
+    stream_response = False
+
     @property
     def paginator(self):
         """
@@ -318,17 +320,13 @@ class BaseVectorOnModelApiView(G3WAPIView):
 
         # Use QGIS APi for QgsFeature instance
         if isinstance(feature, QgsFeature):
-            to_srid = QgsCoordinateReferenceSystem(f'EPSG:{to_srid}')
-            from_srid = QgsCoordinateReferenceSystem(f'EPSG:{from_srid}')
-            ct = QgsCoordinateTransform(
-                from_srid, to_srid, QgsCoordinateTransformContext())
             geometry = feature.geometry()
-            geometry.transform(ct)
+            geometry.transform(get_coordinate_transform(from_srid, to_srid))
             feature.setGeometry(geometry)
         else:
-            geometry = GEOSGeometry(GEOSGeometry(json.dumps(
-                feature['geometry'])).wkt, srid=int(from_srid))
-            geometry.transform(to_srid)
+            # GDAL geometry from GeoJSON, the 'crs' member is ignored
+            geometry = OGRGeometry(json.dumps(feature['geometry']))
+            geometry.transform(get_coord_transform(from_srid, to_srid))
             feature['geometry'] = json.loads(geometry.json)
 
     def reproject_featurecollection(self, featurecollection, to_layer=False):
@@ -441,131 +439,204 @@ class BaseVectorOnModelApiView(G3WAPIView):
 
         # Apply filter backends, store original subset string
         original_subset_string = self.metadata_layer.qgis_layer.subsetString()
-        if hasattr(self, 'filter_backends'):
-            for backend in self.filter_backends:
-                backend().apply_filter(request, self.metadata_layer.qgis_layer, qgis_feature_request, self)
-
-        # Paging cannot be a backend filter
-        if 'page' in request.query_params:
-            kwargs['page'] = request.query_params.get('page')
-            kwargs['page_size'] = request.query_params.get('page_size', 10)
-
-
-        # Make sure we have all attrs we need to build the server FID
-        provider = self.metadata_layer.qgis_layer.dataProvider()
-        if qgis_feature_request.flags() & QgsFeatureRequest.SubsetOfAttributes:
-            attrs = qgis_feature_request.subsetOfAttributes()
-            for attr_idx in provider.pkAttributeIndexes():
-                if attr_idx not in attrs:
-                    attrs.append(attr_idx)
-            qgis_feature_request.setSubsetOfAttributes(attrs)
-
-        self.features = get_qgis_features(
-            self.metadata_layer.qgis_layer, qgis_feature_request, **kwargs)
-
-        # Reproject feature if layer CRS != Project CRS
-        if self.reproject:
-            for f in self.features:
-                self.reproject_feature(f)
-
-        ex = QgsJsonExporter(self.metadata_layer.qgis_layer)
-
-        # If 'unique' request params is set,
-        # api return a list of unique
-        # field name sent with 'unique' param.
-        # --------------------------------------
-        # IDEA:     for big data it'll be iterate over features to get unique
-        #           c++ iteration is fast. Instead memory layer with too many features can be a problem.
-        if 'unique' in request.query_params:
-
-            vl = QgsVectorLayer(QgsWkbTypes.displayString(self.metadata_layer.qgis_layer.wkbType()),
-                                "temporary_vector", "memory")
-            pr = vl.dataProvider()
-
-            # add fields
-            pr.addAttributes(self.metadata_layer.qgis_layer.fields())
-            vl.updateFields()  # tell the vector layer to fetch changes from the provider
-
-            res = pr.addFeatures(self.features)
-
-            uniques = vl.uniqueValues(
-                self.metadata_layer.qgis_layer.fields().indexOf(request.query_params.get('unique'))
-            )
-
-            values = []
-            for u in uniques:
-                try:
-                    if u:
-                        values.append(json.loads(QgsJsonUtils.encodeValue(u)))
-                except Exception as e:
-                    logger.error(f'Response vector widget unique: {e}')
-                    continue
-
-            # sort values
-            values.sort()
-            self.results.update({
-                'data': values,
-                'count': len(values)
-            })
-
-            del(vl)
-
-        else:
+        # The filter backends set the subset string of the layer of the cached project, which is
+        # shared with the other requests: it is restored even when the request fails
+        try:
+            if hasattr(self, 'filter_backends'):
+                for backend in self.filter_backends:
+                    backend().apply_filter(request, self.metadata_layer.qgis_layer, qgis_feature_request, self)
+
+            # Paging cannot be a backend filter
+            if 'cursor' in request.query_params:
+                # Keyset pagination on primary key: ?cursor=&page_size=... for the first page,
+                # then ?cursor=<next_cursor of the previous page>
+                kwargs['cursor'] = request.query_params.get('cursor')
+                kwargs['page_size'] = request.query_params.get('page_size', 10)
+            elif 'page' in request.query_params:
+                kwargs['page'] = request.query_params.get('page')
+                kwargs['page_size'] = request.query_params.get('page_size', 10)
+
+
+            # Time and feature budget of the scans, see G3WADMIN_FEATURES_BUDGET_* settings:
+            # runaway scans are stopped with a 503 response
+            kwargs['feedback'] = FeaturesBudget()
+
+            # Make sure we have all attrs we need to build the server FID
+            provider = self.metadata_layer.qgis_layer.dataProvider()
+            if qgis_feature_request.flags() & QgsFeatureRequest.SubsetOfAttributes:
+                attrs = qgis_feature_request.subsetOfAttributes()
+                for attr_idx in provider.pkAttributeIndexes():
+                    if attr_idx not in attrs:
+                        attrs.append(attr_idx)
+                qgis_feature_request.setSubsetOfAttributes(attrs)
+
+            # If 'unique' request params is set,
+            # api return a list of unique
+            # field name sent with 'unique' param.
+            # --------------------------------------
+            # Values are computed by the provider (SELECT DISTINCT) with the filters applied
+            # when possible, else iterating the features with the field only.
+            if 'unique' in request.query_params:
+
+                self.features = []
+
+                values = [v for v in get_qgis_unique_values(self.metadata_layer.qgis_layer,
+                                                            request.query_params.get('unique'),
+                                                            qgis_feature_request,
+                                                            data_generation=self.get_layer_data_generation(),
+                                                            feedback=kwargs['feedback']) if v]
+
+                # sort values
+                values.sort()
+                self.results.update({
+                    'data': values,
+                    'count': len(values)
+                })
 
-            # patch for return GeoJson feature with CRS different from WGS84
-            # TODO: use .setTransformGeometries( false ) with QGIS >= 3.12
-            ex.setSourceCrs(QgsCoordinateReferenceSystem('EPSG:4326'))
+            else:
 
-            # check for formatter query url param and check if != 0
-            if 'formatter' in request.query_params:
-                formatter = request.query_params.get('formatter')
-                if formatter.isnumeric() and int(formatter) == 0:
-                    export_features = False
+                # Reproject feature if layer CRS != Project CRS:
+                # by the QGIS feature iterator when the filters allow it, else one by one
+                reproject = self.reproject and not set_destination_crs(qgis_feature_request,
+                                                                       self.layer.project.group.srid.auth_srid)
+
+                # check for formatter query url param and check if != 0
+                stream = False
+                if 'formatter' in request.query_params:
+                    formatter = request.query_params.get('formatter')
+                    if formatter.isnumeric() and int(formatter) == 0:
+                        export_features = False
+                        # Raw values are requested explicitly (i.e. data export): stream the features
+                        stream = True
+                    else:
+                        export_features = True
+
+                # Without paging the features of the data mode are fetched in batches while
+                # the response is streamed, they are never all in memory
+                fetch_while_streaming = stream and self.mode_call == MODE_DATA and 'page_size' not in kwargs
+
+                if fetch_while_streaming:
+                    self.features = None
+                    features = self.iter_features(qgis_feature_request, reproject,
+                                                  self.metadata_layer.qgis_layer.subsetString(),
+                                                  original_subset_string, **kwargs)
                 else:
-                    export_features = True
+                    self.features = get_qgis_features(
+                        self.metadata_layer.qgis_layer, qgis_feature_request, **kwargs)
 
-            if export_features:
-                feature_collection = json.loads(ex.exportFeatures(self.features))
-            else:
+                    if reproject:
+                        for f in self.features:
+                            self.reproject_feature(f)
 
-                # to exclude QgsFormater used into QgsJsonjExporter is necessary build by hand single json feature
-                ex.setIncludeAttributes(False)
+                    features = self.features
 
-                feature_collection = {
-                    'type': 'FeatureCollection',
-                    'features': []
-                }
+                ex = QgsJsonExporter(self.metadata_layer.qgis_layer)
 
-                for feature in self.features:
-                    fnames = [f.name() for f in feature.fields()]
-                    feature_collection['features'].append(
-                        json.loads(ex.exportFeature(feature, dict(zip(fnames, feature.attributes()))))
-                    )
+                # patch for return GeoJson feature with CRS different from WGS84
+                # TODO: use .setTransformGeometries( false ) with QGIS >= 3.12
+                ex.setSourceCrs(QgsCoordinateReferenceSystem('EPSG:4326'))
 
-            # Change media
-            self.change_media(feature_collection)
+                if export_features:
+                    feature_collection = json.loads(ex.exportFeatures(self.features))
 
-            # Patch feature IDs with server featureIDs
-            fids_map = {}
-            for f in self.features:
-                fids_map[f.id()] = server_fid(f, provider)
+                    # Change media
+                    self.change_media(feature_collection)
 
-            for i in range(len(feature_collection['features'])):
-                f = feature_collection['features'][i]
-                f['id'] = fids_map[f['id']]
+                    # Patch feature IDs with server featureIDs
+                    fids_map = {}
+                    for f in self.features:
+                        fids_map[f.id()] = server_fid(f, provider)
 
-            self.results.update(APIVectorLayerStructure(**{
-                'data': feature_collection,
-                'count': count_qgis_features(self.metadata_layer.qgis_layer, qgis_feature_request, **kwargs),
-                'geometryType': self.metadata_layer.geometry_type,
-            }).as_dict())
-
-            # FIXME: add extra fields data by signals and receivers
-            # FIXME: featurecollection = post_serialize_maplayer.send(layer_serializer, layer=self.layer_name)
-            # FIXME: Not sure how to map this to the new QGIS API
+                    for i in range(len(feature_collection['features'])):
+                        f = feature_collection['features'][i]
+                        f['id'] = fids_map[f['id']]
+                else:
 
-        # Restore the original subset string
-        self.metadata_layer.qgis_layer.setSubsetString(original_subset_string)
+                    # to exclude QgsFormater used into QgsJsonjExporter is necessary build by hand single json feature
+                    ex.setIncludeAttributes(False)
+
+                    geojson_features = self.geojson_features(ex, provider, features)
+                    if stream:
+                        feature_collection = StreamingFeatureCollection(geojson_features)
+                        self.stream_response = True
+                    else:
+                        feature_collection = {
+                            'type': 'FeatureCollection',
+                            'features': list(geojson_features)
+                        }
+
+                self.results.update(APIVectorLayerStructure(**{
+                    'data': feature_collection,
+                    'count': count_qgis_features(self.metadata_layer.qgis_layer, qgis_feature_request,
+                                                 approximate='approximate_count' in request.query_params, **kwargs),
+                    'geometryType': self.metadata_layer.geometry_type,
+                }).as_dict())
+
+                # Cursor of the next page, None for the last page
+                if 'cursor' in kwargs:
+                    self.results.update({
+                        'next_cursor': feature_cursor(self.features[-1], self.metadata_layer.qgis_layer)
+                        if len(self.features) == int(kwargs['page_size']) else None
+                    })
+
+                # FIXME: add extra fields data by signals and receivers
+                # FIXME: featurecollection = post_serialize_maplayer.send(layer_serializer, layer=self.layer_name)
+                # FIXME: Not sure how to map this to the new QGIS API
+        finally:
+            # Restore the original subset string
+            self.metadata_layer.qgis_layer.setSubsetString(original_subset_string)
+
+    def iter_features(self, qgis_feature_request, reproject, subset_string, original_subset_string, **kwargs):
+        """
+        Fetch the features in batches while they are consumed, i.e. while the response is streamed:
+        the filtered subset string is set on the layer for the duration of the iteration
+        :param qgis_feature_request: QgsFeatureRequest with the filters applied
+        :param reproject: True to reproject the features one by one
+        :param subset_string: the layer subset string with the filters applied
+        :param original_subset_string: the layer subset string to restore at the end
+        :param kwargs: options of iter_qgis_features
+        :return: generator of QgsFeature
+        """
+
+        qgis_layer = self.metadata_layer.qgis_layer
+        qgis_layer.setSubsetString(subset_string)
+        try:
+            for batch in iter_qgis_features(qgis_layer, qgis_feature_request, **kwargs):
+                for feature in batch:
+                    if reproject:
+                        self.reproject_feature(feature)
+                    yield feature
+        finally:
+            qgis_layer.setSubsetString(original_subset_string)
+
+    def geojson_features(self, exporter, provider, features):
+        """
+        Export features as GeoJSON feature dicts, one at a time, with user media values
+        and server featureIDs
+        :param exporter: QgsJsonExporter instance, without attributes
+        :param provider: QGIS layer data provider
+        :param features: iterable of QgsFeature
+        :return: generator of GeoJSON feature dicts
+        """
+
+        edittypes = eval(self.layer.edittypes) if self.layer.edittypes else {}
+        change_media = any(data.get('widgetv2type') == 'ExternalResource' for data in edittypes.values())
+
+        fnames = [f.name() for f in self.metadata_layer.qgis_layer.fields()]
+        for feature in features:
+            geojson_feature = json.loads(exporter.exportFeature(feature, dict(zip(fnames, feature.attributes()))))
+            if change_media:
+                UserMediaHandler(layer=self.layer, feature=geojson_feature).new_value(change=True)
+            geojson_feature['id'] = server_fid(feature, provider)
+            yield geojson_feature
+
+    def get_layer_data_generation(self):
+        """
+        Method to implement in child class to return the data generation of the layer,
+        changed when the layer data change: it enables the cache of the unique values
+        :return: data generation, None if not available
+        """
+        return None
 
     def set_reprojecting_status(self):
         """
@@ -614,6 +685,8 @@ class BaseVectorOnModelApiView(G3WAPIView):
                     self.results.results.update(ed[1])
 
             # response a APIVectorLayer
+            if self.stream_response:
+                return StreamingHttpResponse(stream_json(self.results.results), content_type='application/json')
             return Response(self.results.results)
         else:
             return response
@@ -11,14 +11,13 @@ __date__ = '2020-02-10'
 __copyright__ = 'Copyright 2020, Gis3w'
 
 from qgis.core import (
-    QgsCoordinateReferenceSystem,
-    QgsCoordinateTransform,
     QgsFeatureRequest,
     QgsRectangle,
-    QgsCoordinateTransformContext,
 )
 from rest_framework.exceptions import ParseError
 
+from core.utils.qgisapi import get_coordinate_transform
+
 
 class BaseFilterBackend():
     """Base class for QGIS request filters"""
@@ -178,10 +177,7 @@ class IntersectsBBoxFilter(BaseFilterBackend):
                 raise NotImplementedError('IntersectsBBoxFilter within operator not yet implemented')
 
             if hasattr(view, 'reproject') and view.reproject:
-                from_srid = view.layer.project.group.srid.auth_srid
-                to_srid = view.layer.srid
-                ct = QgsCoordinateTransform(QgsCoordinateReferenceSystem(
-                    from_srid), QgsCoordinateReferenceSystem(to_srid), QgsCoordinateTransformContext())
+                ct = get_coordinate_transform(view.layer.project.group.srid.auth_srid, view.layer.srid)
                 bbox_filter = ct.transform(bbox_filter)
 
             qgis_feature_request.setFilterRect(bbox_filter)
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.16 on 2021-04-26 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0071_remove_group_use_title_client'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheGeneration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
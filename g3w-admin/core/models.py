@@ -3,7 +3,7 @@ from django.conf import settings
 from django.conf.global_settings import LANGUAGES
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.urls import reverse
-from django.db import models
+from django.db import models, transaction
 from django.apps import apps
 from guardian.shortcuts import get_objects_for_user
 from guardian.compat import get_user_model
@@ -446,4 +446,84 @@ class ProjectMapUrlAlias(models.Model):
     """
     app_name = models.CharField(max_length=255)
     project_id = models.IntegerField()
-    alias =models.CharField(max_length=512, unique=True)
\ No newline at end of file
+    alias =models.CharField(max_length=512, unique=True)
+
+class CacheGeneration(models.Model):
+    """
+    Model to store shared generation counters of the process level caches:
+    every web server, pool worker and task process reads the same value, so
+    bumping a generation invalidates the cached data in all of them.
+    Other shared counters (i.e. project request counts) are stored here too.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    @classmethod
+    def get_value(cls, name):
+        """
+        Return the current value of a generation counter
+        :param name: counter name
+        :type name: str
+        :rtype: int
+        """
+
+        return cls.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+    @classmethod
+    def get_values(cls, names):
+        """
+        Return the current values of several generation counters with one query
+        :param names: counter names
+        :type names: list
+        :return: values in the same order of names
+        :rtype: list
+        """
+
+        values = dict(cls.objects.filter(name__in=names).values_list('name', 'value'))
+        return [values.get(name, 0) for name in names]
+
+    @classmethod
+    def bump(cls, name, amount=1):
+        """
+        Atomically increment a generation counter, the counter is created if missing
+        :param name: counter name
+        :type name: str
+        :param amount: increment, defaults to 1
+        :type amount: int
+        :return: the new value
+        :rtype: int
+        """
+
+        with transaction.atomic():
+            if not cls.objects.filter(name=name).update(value=models.F('value') + amount):
+                __, created = cls.objects.get_or_create(name=name, defaults={'value': amount})
+                if created:
+                    return amount
+                cls.objects.filter(name=name).update(value=models.F('value') + amount)
+
+            # The updated row is locked until the end of the transaction
+            return cls.get_value(name)
+
+    @classmethod
+    def compare_and_set(cls, name, expected, value):
+        """
+        Atomically set a generation counter to value if its current value is expected
+        :param name: counter name
+        :type name: str
+        :param expected: the value read by the caller
+        :type expected: int
+        :param value: the new value
+        :type value: int
+        :return: True if the counter has been set, False if it has been changed in the meantime
+        :rtype: bool
+        """
+
+        if cls.objects.filter(name=name, value=expected).update(value=value):
+            return True
+
+        if expected == 0:
+            # Missing counters are 0
+            __, created = cls.objects.get_or_create(name=name, defaults={'value': value})
+            return created
+
+        return False
@@ -21,6 +21,17 @@ Arguments:
 """
 pre_save_maplayer = django.dispatch.Signal(providing_args=["layer_metadata", "mode", "data", "user"])
 
+"""Signal sent after editing changes have been committed to the layers data sources.
+
+Arguments:
+    layer: the layer model instance whose data changed
+    user: current user from the request
+    extents: list of (xmin, ymin, xmax, ymax) bounding boxes of the added, updated (before and after the
+             update) and deleted geometries, in the layer CRS
+    crs: the layer CRS auth id, i.e. 'EPSG:4326'
+"""
+post_commit_maplayer = django.dispatch.Signal(providing_args=["layer", "user", "extents", "crs"])
+
 # signal to add extra maplayers attribute: i.e. iternet
 pre_delete_maplayer = django.dispatch.Signal(providing_args=["layer", "data", "user"])
 
@@ -12,6 +12,7 @@ __copyright__ = 'Copyright 2020, Gis3w'
 
 import os
 import json
+from rest_framework.exceptions import ParseError
 from rest_framework.test import APITestCase, APIClient
 from django.conf import settings
 from django.urls import reverse
@@ -21,8 +22,11 @@ from qdjango.models import Project
 from django.core.cache import caches
 from qdjango.models import Layer
 
-from core.utils.qgisapi import get_qgis_layer, get_qgis_features
-from qgis.core import QgsRectangle
+from core.utils.qgisapi import (get_qgis_layer, get_qgis_features, feature_cursor, count_qgis_features,
+                                iter_qgis_features, FeaturesBudget, FeaturesBudgetExceeded,
+                                get_qgis_unique_values, get_coordinate_transform, set_destination_crs,
+                                _expression_to_sql, _sql_literal)
+from qgis.core import QgsRectangle, QgsFeatureRequest, QgsPointXY, QgsExpression
 
 # Re-use test data from qdjango module
 DATASOURCE_PATH = os.path.join(os.getcwd(), 'qdjango', 'tests', 'data')
@@ -122,6 +126,68 @@ class CoreQgisApiTest(APITestCase):
         features = get_qgis_features(qgis_layer, page_size=1000)
         self.assertEqual(len(features), 2)
 
+    def testGetQgisFeaturesProviderPagination(self):
+        """Test QGIS API get_qgis_features pagination pushed to the provider"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+        subset_string = qgis_layer.subsetString()
+
+        # LIMIT/OFFSET in the provider (no QGIS side filters)
+        features = get_qgis_features(qgis_layer, page=2, page_size=1)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['pkuid'], 2)
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        features = get_qgis_features(qgis_layer, page=2, page_size=1, ordering='-pkuid')
+        self.assertEqual(features[0]['pkuid'], 1)
+
+        # Ordering from the request, as set by the ordering filter backend
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setOrderBy(QgsFeatureRequest.OrderBy([QgsFeatureRequest.OrderByClause('"name"', False)]))
+        features = get_qgis_features(qgis_layer, qgis_feature_request, page=2, page_size=1)
+        self.assertEqual(features[0]['name'], 'a point')
+
+        # QGIS side filters: ids first, then the features of the page
+        features = get_qgis_features(qgis_layer, search_filter='point', page=2, page_size=1)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['pkuid'], 2)
+        self.assertFalse(features[0].geometry().isNull())
+
+        features = get_qgis_features(qgis_layer, search_filter='point', page=3, page_size=1)
+        self.assertEqual(len(features), 0)
+
+    def testGetQgisFeaturesCursor(self):
+        """Test QGIS API get_qgis_features keyset pagination"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+
+        features = get_qgis_features(qgis_layer, cursor='', page_size=1)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['pkuid'], 1)
+        cursor = feature_cursor(features[0], qgis_layer)
+        self.assertEqual(cursor, '1')
+
+        features = get_qgis_features(qgis_layer, cursor=cursor, page_size=1)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['pkuid'], 2)
+
+        features = get_qgis_features(qgis_layer, cursor=feature_cursor(features[0], qgis_layer), page_size=1)
+        self.assertEqual(len(features), 0)
+
+        # Invalid cursor values of a numeric key are a bad request
+        for invalid_cursor in ('abc', 'nan', '1; DROP'):
+            with self.assertRaises(ParseError):
+                get_qgis_features(qgis_layer, cursor=invalid_cursor, page_size=1)
+
+        # Combined with the request filters, the request of the caller is unchanged
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"name" = \'another point\'')
+        features = get_qgis_features(qgis_layer, qgis_feature_request, cursor='', page_size=10)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(qgis_feature_request.filterExpression().expression(), '"name" = \'another point\'')
+
     def testGetQgisFeaturesOrdering(self):
         """Test QGIS API get_qgis_features with ordering"""
 
@@ -296,3 +362,184 @@ class CoreQgisApiTest(APITestCase):
         features = get_qgis_features(qgis_layer_clone)
         self.assertEqual(len(features), 1)
         self.assertEqual(features[0]['name'], 'another point')
+
+    def testIterQgisFeatures(self):
+        """Test QGIS API iter_qgis_features"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+        subset_string = qgis_layer.subsetString()
+
+        batches = list(iter_qgis_features(qgis_layer, batch_size=1))
+        self.assertEqual([len(b) for b in batches], [1, 1])
+        self.assertEqual([f.id() for b in batches for f in b], [f.id() for f in get_qgis_features(qgis_layer)])
+
+        batches = list(iter_qgis_features(qgis_layer, with_geometry=False))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 2)
+        self.assertTrue(batches[0][0].geometry().isNull())
+
+        # The subset string is restored when the generator is closed
+        batches = iter_qgis_features(qgis_layer, batch_size=1, extra_subset_string='pkuid > 0')
+        self.assertEqual(len(next(batches)), 1)
+        self.assertNotEqual(qgis_layer.subsetString(), subset_string)
+        batches.close()
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        # No features
+        self.assertEqual(list(iter_qgis_features(qgis_layer, extra_expression='false')), [])
+
+    def testFeaturesBudget(self):
+        """Test QGIS API FeaturesBudget"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+        subset_string = qgis_layer.subsetString()
+
+        self.assertEqual(len(get_qgis_features(qgis_layer, feedback=FeaturesBudget())), 2)
+        self.assertEqual(len(get_qgis_features(qgis_layer, feedback=FeaturesBudget(timeout=60, max_features=2))), 2)
+
+        # Feature budget
+        with self.assertRaises(FeaturesBudgetExceeded):
+            get_qgis_features(qgis_layer, feedback=FeaturesBudget(max_features=1),
+                              extra_subset_string='pkuid > 0')
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        with self.assertRaises(FeaturesBudgetExceeded):
+            list(iter_qgis_features(qgis_layer, batch_size=1, feedback=FeaturesBudget(max_features=1)))
+
+        # The feature budget is not used for counting
+        self.assertEqual(count_qgis_features(qgis_layer, search_filter='point',
+                                             feedback=FeaturesBudget(max_features=1)), 2)
+
+        # Time budget
+        feedback = FeaturesBudget(timeout=0)
+        with self.assertRaises(FeaturesBudgetExceeded):
+            get_qgis_features(qgis_layer, feedback=feedback)
+        self.assertTrue(feedback.isCanceled())
+
+        with self.assertRaises(FeaturesBudgetExceeded):
+            count_qgis_features(qgis_layer, search_filter='point', feedback=FeaturesBudget(timeout=0))
+
+    def testCountQgisFeatures(self):
+        """Test QGIS API count_qgis_features"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+        subset_string = qgis_layer.subsetString()
+
+        self.assertEqual(count_qgis_features(qgis_layer), 2)
+        self.assertEqual(count_qgis_features(qgis_layer, approximate=True), 2)
+
+        # Provider count with subset strings
+        self.assertEqual(count_qgis_features(qgis_layer, extra_subset_string='name != \'another point\''), 1)
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        # Expressions and BBOX are counted iterating the features
+        self.assertEqual(count_qgis_features(qgis_layer, search_filter='another'), 1)
+        self.assertEqual(count_qgis_features(qgis_layer, attribute_filters={'name': 'point'}), 2)
+        self.assertEqual(count_qgis_features(qgis_layer, bbox_filter=QgsRectangle(-1, -1, 1, 1)),
+                         len(get_qgis_features(qgis_layer, bbox_filter=QgsRectangle(-1, -1, 1, 1))))
+
+        # The request of the caller is unchanged
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"name" = \'a point\'')
+        qgis_feature_request.setLimit(1)
+        self.assertEqual(count_qgis_features(qgis_layer, qgis_feature_request, extra_expression='"pkuid" > 0'), 1)
+        self.assertEqual(qgis_feature_request.limit(), 1)
+
+    def testExpressionToSql(self):
+        """Test QGIS API compilation of filter expressions pushed down to PostGIS"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+
+        def to_sql(expression):
+            return _expression_to_sql(qgis_layer, QgsExpression(expression).rootNode())
+
+        self.assertEqual(to_sql('"name" = \'a point\' AND "pkuid" > 0'),
+                         '(("name" = E\'a point\') AND ("pkuid" > 0))')
+        self.assertEqual(to_sql('NOT "pkuid" IN (1, 2)'), '(NOT ("pkuid" IN (1, 2)))')
+        self.assertEqual(to_sql('"name" ILIKE \'%point%\' OR "name" IS NULL'),
+                         '(("name" ILIKE E\'%point%\') OR ("name" IS NOT DISTINCT FROM NULL))')
+
+        # Literals are quoted with the SQL rules, whatever the quoting of the expression
+        self.assertEqual(to_sql('"name" = {}'.format(QgsExpression.quotedValue("$q$') OR TRUE --"))),
+                         '("name" = E\'$q$\'\') OR TRUE --\')')
+        self.assertEqual(_sql_literal("a'b\\c"), "E'a''b\\\\c'")
+        self.assertIsNone(_sql_literal(float('nan')))
+
+        # Functions, unknown fields and special columns are not compiled
+        self.assertIsNone(to_sql('upper("name") = \'A POINT\''))
+        self.assertIsNone(to_sql('"not_a_field" = 1'))
+        self.assertIsNone(to_sql('$id = 1'))
+        self.assertIsNone(to_sql('"name" || \'x\' = \'a pointx\''))
+
+    def testGetQgisUniqueValues(self):
+        """Test QGIS API get_qgis_unique_values"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+        subset_string = qgis_layer.subsetString()
+
+        self.assertEqual(sorted(get_qgis_unique_values(qgis_layer, 'name')), ['a point', 'another point'])
+        self.assertEqual(len(get_qgis_unique_values(qgis_layer, 'name', limit=1)), 1)
+        self.assertEqual(get_qgis_unique_values(qgis_layer, 'not_a_field'), [])
+
+        # Filters of the request, the request is unchanged
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"name" = \'a point\'')
+        self.assertEqual(get_qgis_unique_values(qgis_layer, 'name', qgis_feature_request), ['a point'])
+        self.assertEqual(qgis_feature_request.filterExpression().expression(), '"name" = \'a point\'')
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        # Cache keyed by data generation and filters
+        caches['default'].clear()
+        self.assertEqual(get_qgis_unique_values(qgis_layer, 'name', qgis_feature_request, data_generation=1),
+                         ['a point'])
+        self.assertEqual(sorted(get_qgis_unique_values(qgis_layer, 'name', data_generation=1)),
+                         ['a point', 'another point'])
+        self.assertEqual(get_qgis_unique_values(qgis_layer, 'name', qgis_feature_request, data_generation=1),
+                         ['a point'])
+
+    def testGetCoordinateTransform(self):
+        """Test QGIS API get_coordinate_transform"""
+
+        ct = get_coordinate_transform(4326, 3857)
+        self.assertEqual(ct.sourceCrs().authid(), 'EPSG:4326')
+        self.assertEqual(ct.destinationCrs().authid(), 'EPSG:3857')
+        point = ct.transform(QgsPointXY(11, 43))
+        self.assertAlmostEqual(point.x(), 1224514.398, places=2)
+        self.assertAlmostEqual(point.y(), 5311971.846, places=2)
+
+        # Cached transforms are copied
+        self.assertIsNot(get_coordinate_transform(4326, 3857), ct)
+        self.assertEqual(get_coordinate_transform('4326', '3857').destinationCrs().authid(), 'EPSG:3857')
+
+    def testSetDestinationCrs(self):
+        """Test QGIS API set_destination_crs"""
+
+        qgis_layer = get_qgis_layer(self.layer)
+        self.assertTrue(qgis_layer.isValid())
+
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"name" = \'a point\'')
+        self.assertTrue(set_destination_crs(qgis_feature_request, 3857))
+        self.assertEqual(qgis_feature_request.destinationCrs().authid(), 'EPSG:3857')
+
+        ct = get_coordinate_transform(qgis_layer.crs().postgisSrid(), 3857)
+        feature = get_qgis_features(qgis_layer, qgis_feature_request)[0]
+        expected = get_qgis_features(qgis_layer, extra_expression='"name" = \'a point\'')[0].geometry()
+        expected.transform(ct)
+        self.assertEqual(feature.geometry().asWkt(3), expected.asWkt(3))
+
+        # Filters that depend on the layer CRS
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterRect(QgsRectangle(-1, -1, 1, 1))
+        self.assertFalse(set_destination_crs(qgis_feature_request, 3857))
+        self.assertFalse(qgis_feature_request.destinationCrs().isValid())
+
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('x($geometry) > 0')
+        self.assertFalse(set_destination_crs(qgis_feature_request, 3857))
+
@@ -11,6 +11,7 @@ __date__ = '2020-04-18'
 __copyright__ = 'Copyright 2015 - 2020, Gis3w'
 
 
+import json
 import re
 
 from crispy_forms.layout import Div
@@ -23,13 +24,15 @@ from django.urls import reverse
 from guardian.exceptions import GuardianError
 from guardian.shortcuts import assign_perm, get_anonymous_user
 from import_export.resources import ModelResource
+from rest_framework.exceptions import APIException
 
 from core.models import Group
 from core.utils.db import build_dango_connection_name
 from core.utils.decorators import project_type_permission_required
 from core.utils.forms import crispyBoxBaseLayer, crispyBoxMacroGroups
 from core.utils.general import *
-from core.utils.geo import camel_geometry_type
+from core.utils.geo import camel_geometry_type, get_coord_transform
+from core.utils.geojson import StreamingFeatureCollection, stream_json
 from core.utils.ie import modelresource_factory
 from core.utils.projects import countAllProjects
 from core.utils.response import send_file
@@ -179,6 +182,13 @@ class CoreUtilsTest(CoreTestBase):
         with self.assertRaises(KeyError):
             self.assertEqual(camel_geometry_type('POLYGONO'), 'Polygon')
 
+    def test_get_coord_transform(self):
+        """ Test function utils with same name """
+
+        ct = get_coord_transform(4326, 3857)
+        self.assertIs(get_coord_transform('4326', '3857'), ct)
+        self.assertIsNot(get_coord_transform(3857, 4326), ct)
+
     def test_modelresource_factory(self):
         """ Test function utils with same name """
 
@@ -205,3 +215,47 @@ class CoreUtilsTest(CoreTestBase):
         fobj = File(open(file, 'rb'))
         self.assertEqual(fobj.read(), response.content)
         fobj.close()
+
+    def test_stream_json(self):
+        """ Test function utils with same name """
+
+        features = [{'type': 'Feature', 'id': i, 'geometry': None, 'properties': {'name': f'città {i}'}}
+                    for i in range(100)]
+        data = {
+            'result': True,
+            'vector': {
+                'count': 100,
+                'data': StreamingFeatureCollection(iter(features)),
+                'fields': None
+            },
+            'featurelocks': []
+        }
+
+        chunks = list(stream_json(data, chunk_size=512))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(json.loads(''.join(chunks)), {
+            'result': True,
+            'vector': {
+                'count': 100,
+                'data': {'type': 'FeatureCollection', 'features': features},
+                'fields': None
+            },
+            'featurelocks': []
+        })
+
+        # Empty feature collection
+        data = {'data': StreamingFeatureCollection(iter([]))}
+        self.assertEqual(json.loads(''.join(stream_json(data))),
+                         {'data': {'type': 'FeatureCollection', 'features': []}})
+
+        # Errors while streaming close the feature collection with an error member
+        def failing_features():
+            yield features[0]
+            raise APIException('Scan canceled')
+
+        data = {'data': StreamingFeatureCollection(failing_features()), 'count': 100}
+        with self.assertLogs('core.utils.geojson', level='ERROR'):
+            streamed = json.loads(''.join(stream_json(data)))
+        self.assertEqual(streamed, {'data': {'type': 'FeatureCollection', 'features': [features[0]],
+                                             'error': 'Scan canceled'},
+                                    'count': 100})
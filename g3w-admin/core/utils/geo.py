@@ -1,5 +1,12 @@
+import threading
+
+from django.contrib.gis.gdal import CoordTransform, SpatialReference
 from pyproj import Proj, transform
 
+# GDAL coordinate transforms cannot be shared by threads: one cache for each thread
+_coord_transforms = threading.local()
+
+
 def camel_geometry_type(geometry_type):
     """
     From geometry type case insensitive to standard name
@@ -18,3 +25,23 @@ def camel_geometry_type(geometry_type):
     }
 
     return trans[geometry_type.lower()]
+
+
+def get_coord_transform(from_srid, to_srid):
+    """
+    Return the GDAL coordinate transform between two SRIDs, from a cache of the current thread
+    :param from_srid: source SRID
+    :param to_srid: destination SRID
+    :return: CoordTransform instance
+    """
+
+    transforms = getattr(_coord_transforms, 'transforms', None)
+    if transforms is None:
+        transforms = _coord_transforms.transforms = dict()
+
+    key = (int(from_srid), int(to_srid))
+    if key not in transforms:
+        transforms[key] = CoordTransform(SpatialReference(key[0]), SpatialReference(key[1]))
+
+    return transforms[key]
+
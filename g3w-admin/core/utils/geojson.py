@@ -0,0 +1,125 @@
+# coding=utf-8
+""""Streaming JSON serialization of vector API results
+
+The GeoJSON features of a :class:`StreamingFeatureCollection` are serialized
+one at a time while the response is sent to the client, so that the whole
+feature collection is never held in memory.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-23'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import logging
+
+from django.utils.translation import ugettext_lazy as _
+from rest_framework.exceptions import APIException
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+logger = logging.getLogger(__name__)
+
+# Size (in characters) of the chunks sent to the client
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class StreamingFeatureCollection(object):
+    """
+    GeoJSON FeatureCollection whose features are serialized when the response is streamed
+
+    :param features: iterable of GeoJSON feature dicts, usually a generator
+    """
+
+    def __init__(self, features):
+        self.features = features
+
+    def iterencode(self, encoder):
+        """
+        Serialize the feature collection one feature at a time.
+
+        The response status is already sent when the features are fetched: an error is logged
+        and the feature collection is closed with an "error" member, so that the client gets
+        a valid JSON document and can tell that the features are incomplete.
+        :param encoder: JSON encoder instance
+        :return: generator of JSON strings
+        """
+
+        yield '{"type":"FeatureCollection","features":['
+        separator = ''
+        try:
+            for feature in self.features:
+                yield separator + encoder.encode(feature)
+                separator = ','
+        except Exception as e:
+            logger.exception('Error while streaming the features: {}'.format(e))
+            detail = e.detail if isinstance(e, APIException) else _('Error while reading the features')
+            yield '],"error":' + encoder.encode(str(detail)) + '}'
+            return
+        yield ']}'
+
+
+def json_encoder():
+    """
+    Return a JSON encoder configured as the DRF JSONRenderer
+    :rtype: JSONEncoder
+    """
+
+    return JSONEncoder(ensure_ascii=not api_settings.UNICODE_JSON,
+                       allow_nan=not api_settings.STRICT_JSON,
+                       separators=(',', ':') if api_settings.COMPACT_JSON else (', ', ': '))
+
+
+def iterencode(data, encoder):
+    """
+    Serialize data to JSON strings, StreamingFeatureCollection values are streamed
+    :param data: data to serialize, dicts and lists can contain StreamingFeatureCollection values
+    :param encoder: JSON encoder instance
+    :return: generator of JSON strings
+    """
+
+    if isinstance(data, StreamingFeatureCollection):
+        yield from data.iterencode(encoder)
+    elif isinstance(data, dict):
+        yield '{'
+        separator = ''
+        for key, value in data.items():
+            yield separator + encoder.encode(str(key)) + ':'
+            yield from iterencode(value, encoder)
+            separator = ','
+        yield '}'
+    elif isinstance(data, (list, tuple)):
+        yield '['
+        separator = ''
+        for value in data:
+            yield separator
+            yield from iterencode(value, encoder)
+            separator = ','
+        yield ']'
+    else:
+        yield encoder.encode(data)
+
+
+def stream_json(data, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Serialize data to JSON chunks for a StreamingHttpResponse
+    :param data: data to serialize, dicts and lists can contain StreamingFeatureCollection values
+    :param chunk_size: minimum size of the chunks, the last one excepted
+    :return: generator of JSON strings
+    """
+
+    buffer = []
+    size = 0
+    for part in iterencode(data, json_encoder()):
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield ''.join(buffer)
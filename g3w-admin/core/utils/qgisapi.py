@@ -12,14 +12,135 @@ __author__ = 'elpaso@itopen.it'
 __date__ = '2020-02-03'
 __copyright__ = 'Copyright 2020, Gis3W'
 
+import hashlib
+import json
 import logging
-
-from qgis.core import QgsFeatureRequest, QgsRectangle, QgsVectorLayer
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import ugettext_lazy as _
+from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsCoordinateTransformContext,
+                       QgsDataSourceUri, QgsExpression, QgsExpressionNodeBinaryOperator, QgsExpressionNodeColumnRef,
+                       QgsExpressionNodeInOperator, QgsExpressionNodeLiteral, QgsExpressionNodeUnaryOperator,
+                       QgsFeatureRequest, QgsFeedback, QgsFields, QgsJsonUtils, QgsProviderRegistry, QgsRectangle,
+                       QgsVectorLayer)
+from qgis.PyQt.QtCore import QVariant
+from rest_framework import status
+from rest_framework.exceptions import APIException, ParseError
 
 from qdjango.apps import get_qgs_project
 
 logger = logging.getLogger(__file__)
 
+# Min planner estimate returned by count_qgis_features(approximate=True), smaller counts are exact
+APPROXIMATE_COUNT_THRESHOLD = getattr(settings, 'G3WADMIN_APPROXIMATE_COUNT_THRESHOLD', 1000000)
+
+# Default budget of the feature scans with a FeaturesBudget: seconds and number of features, None for no limit
+FEATURES_BUDGET_TIMEOUT = getattr(settings, 'G3WADMIN_FEATURES_BUDGET_TIMEOUT', None)
+FEATURES_BUDGET_MAX_FEATURES = getattr(settings, 'G3WADMIN_FEATURES_BUDGET_MAX_FEATURES', None)
+
+# Default number of features of the batches of iter_qgis_features
+FEATURES_BATCH_SIZE = 1000
+
+# Max number of values returned by get_qgis_unique_values and seconds the values are cached
+UNIQUE_VALUES_LIMIT = getattr(settings, 'G3WADMIN_UNIQUE_VALUES_LIMIT', 10000)
+UNIQUE_VALUES_CACHE_TIMEOUT = getattr(settings, 'G3WADMIN_UNIQUE_VALUES_CACHE_TIMEOUT', 600)
+
+UNIQUE_VALUES_CACHE_KEY = 'qgisapi_unique_values_{}'
+
+# Process cache of the coordinate transforms, keyed by (source SRID, destination SRID)
+_COORDINATE_TRANSFORMS = dict()
+_COORDINATE_TRANSFORMS_LOCK = threading.Lock()
+
+
+class FeaturesBudgetExceeded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('The request matches too many features or took too long, try again with more filters.')
+    default_code = 'features_budget_exceeded'
+
+
+class FeaturesBudget(QgsFeedback):
+    """QGIS feedback for feature scans with a time and a feature budget: the scan is canceled
+    when the budget is exhausted and FeaturesBudgetExceeded is raised.
+
+    The feedback is set on the feature request (QGIS >= 3.20) so that the providers can stop a scan
+    while no feature is returned, else the budget is checked after every feature.
+
+    :param timeout: max seconds of the scan, defaults to G3WADMIN_FEATURES_BUDGET_TIMEOUT
+    :type timeout: float, optional
+    :param max_features: max number of features returned by the scan, defaults to
+                         G3WADMIN_FEATURES_BUDGET_MAX_FEATURES
+    :type max_features: int, optional
+    """
+
+    def __init__(self, timeout=FEATURES_BUDGET_TIMEOUT, max_features=FEATURES_BUDGET_MAX_FEATURES):
+        super().__init__()
+        self.timeout = timeout
+        self.max_features = max_features
+        self.features = 0
+        self._deadline = None
+        self._timer = None
+
+    def start(self):
+        """Start the clock of the time budget, the clock starts with the first scan:
+        the time budget is shared by all the scans of the feedback (i.e. get and count)"""
+
+        if self.timeout is None:
+            return
+
+        if self._deadline is None:
+            self._deadline = time.monotonic() + self.timeout
+        if self._timer is None:
+            self._timer = threading.Timer(max(0, self._deadline - time.monotonic()), self.cancel)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        """Stop the clock of the time budget"""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def check(self, features=1):
+        """Count the features returned by the scan and check the budget
+
+        :param features: number of features returned since the last check
+        :type features: int
+        :raises FeaturesBudgetExceeded: when the budget is exhausted
+        """
+
+        self.features += features
+        if (self.max_features is not None and self.features > self.max_features) \
+                or (self._deadline is not None and time.monotonic() > self._deadline):
+            self.cancel()
+        if self.isCanceled():
+            self.stop()
+            raise FeaturesBudgetExceeded()
+
+    def iterate(self, features, count=True):
+        """Iterate features within the budget
+
+        :param features: features iterable, i.e. a QgsFeatureIterator
+        :param count: count the features for the feature budget, False to check the time budget only
+        :type count: bool
+        :return: generator of features
+        :raises FeaturesBudgetExceeded: when the budget is exhausted
+        """
+
+        self.start()
+        try:
+            for feature in features:
+                self.check(1 if count else 0)
+                yield feature
+            # The provider may have stopped the scan
+            self.check(0)
+        finally:
+            self.stop()
+
 
 def expression_from_server_fids(server_fids, provider) -> str:
     """Returns a string expression from a list of server FIDs in the form <pk1>@@<pk2>...
@@ -77,11 +198,70 @@ def server_fid(feature, provider) -> str:
     return '@@'.join(bits)
 
 
-def get_layer_fids_from_server_fids(server_fids, layer):
+def get_coordinate_transform(from_srid, to_srid):
+    """Returns the QGIS coordinate transform between two EPSG SRIDs, from a process cache:
+    the CRSs and the transform are built once and not for every feature.
+
+    Transforms are implicitly shared and keep the PROJ objects of each thread,
+    a copy of the cached transform is returned.
+
+    :param from_srid: source EPSG SRID
+    :type from_srid: int
+    :param to_srid: destination EPSG SRID
+    :type to_srid: int
+    :rtype: QgsCoordinateTransform
+    """
+
+    key = (int(from_srid), int(to_srid))
+    with _COORDINATE_TRANSFORMS_LOCK:
+        ct = _COORDINATE_TRANSFORMS.get(key)
+        if ct is None:
+            ct = QgsCoordinateTransform(QgsCoordinateReferenceSystem('EPSG:{}'.format(key[0])),
+                                        QgsCoordinateReferenceSystem('EPSG:{}'.format(key[1])),
+                                        QgsCoordinateTransformContext())
+            _COORDINATE_TRANSFORMS[key] = ct
+
+    return QgsCoordinateTransform(ct)
+
+
+def set_destination_crs(qgis_feature_request, to_srid):
+    """Sets the destination CRS of a feature request, so that the features are reprojected
+    by the QGIS feature iterator, when the filters of the request do not depend on the CRS:
+    the filter rect and the geometries in filter expressions are in the destination CRS
+    when it is set, so requests with a filter rect or with expressions (and ordering)
+    that use the geometry are not changed.
+
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest
+    :param to_srid: destination EPSG SRID
+    :type to_srid: int
+    :return: True if the destination CRS is set
+    :rtype: bool
+    """
+
+    if not qgis_feature_request.filterRect().isEmpty():
+        return False
+
+    expression = qgis_feature_request.filterExpression()
+    if expression is not None and expression.needsGeometry():
+        return False
+
+    for clause in qgis_feature_request.orderBy():
+        if clause.expression().needsGeometry():
+            return False
+
+    qgis_feature_request.setDestinationCrs(QgsCoordinateReferenceSystem('EPSG:{}'.format(to_srid)),
+                                           QgsCoordinateTransformContext())
+    return True
+
+
+def get_layer_fids_from_server_fids(server_fids, layer, feedback=None):
     """From a list of server_fids for a QGIS vector layer return layer fids
 
     :param server_fids: list of server_fids
     :param layer: QGIS vector layer to execute filtering
+    :param feedback: time and feature budget of the scan
+    :type feedback: FeaturesBudget, optional
     :return: a list for QGIS vector layer fids
     :rtype: list
     """
@@ -89,9 +269,13 @@ def get_layer_fids_from_server_fids(server_fids, layer):
     qgis_feature_request = QgsFeatureRequest()
     exp = expression_from_server_fids(server_fids, layer.dataProvider())
     qgis_feature_request.combineFilterExpression(exp)
-    features = get_qgis_features(layer, qgis_feature_request)
 
-    return [f.id() for f in features]
+    # Only the ids are needed: fetch the features in batches and without geometries
+    fids = []
+    for features in iter_qgis_features(layer, qgis_feature_request, with_geometry=False, feedback=feedback):
+        fids.extend(f.id() for f in features)
+
+    return fids
 
 def get_qgis_layer(layer_info):
     """Returns a QGIS vector layer from a layer information record.
@@ -115,19 +299,193 @@ def get_qgis_layer(layer_info):
         return QgsVectorLayer(datasource, name, provider_name)
 
 
-def __get_qgis_features(qgis_layer,
-                        qgis_feature_request=None,
-                        bbox_filter=None,
-                        attribute_filters=None,
-                        search_filter=None,
-                        with_geometry=True,
-                        page=None,
-                        page_size=None,
-                        ordering=None,
-                        exclude_fields=None,
-                        extra_expression=None,
-                        extra_subset_string=None):
-    """Private implementation for count and get"""
+def _pk_field_name(qgis_layer):
+    """Returns the name of the primary key field of a QGIS vector layer,
+    None if the layer has no primary key or a multi column primary key
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :rtype: str
+    """
+
+    pk_indexes = qgis_layer.dataProvider().pkAttributeIndexes()
+    if len(pk_indexes) != 1:
+        return None
+    return qgis_layer.fields().at(pk_indexes[0]).name()
+
+
+def _cursor_expression(qgis_layer, cursor):
+    """Returns the key expression and the filter expression of a keyset (cursor) page:
+    features are ordered by primary key (feature id if the layer has no single column
+    primary key) and the page starts after the cursor value.
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param cursor: primary key of the last feature of the previous page, empty for the first page
+    :type cursor: str
+    :raises ParseError: if the cursor is not a valid value of the key
+    :return: (key expression, filter expression or None)
+    :rtype: tuple
+    """
+
+    pk_name = _pk_field_name(qgis_layer)
+    if pk_name is None:
+        key = '$id'
+        numeric = True
+    else:
+        key = QgsExpression.quotedColumnRef(pk_name)
+        numeric = qgis_layer.fields().field(pk_name).isNumeric()
+
+    value = cursor if cursor != '' else None
+    if value is not None and numeric:
+        try:
+            value = float(value) if pk_name is not None and '.' in value else int(value)
+        except ValueError:
+            value = None
+        if value is None or not math.isfinite(value):
+            raise ParseError(_('Invalid cursor value: {}').format(cursor))
+
+    if value is None:
+        return key, None
+    return key, '{} > {}'.format(key, QgsExpression.quotedValue(value))
+
+
+def _order_by_fields(qgis_feature_request):
+    """Returns the ordering of a feature request as a list of (field name, ascending),
+    None if the request is ordered by expressions which are not fields
+
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest
+    :rtype: list
+    """
+
+    order_by = []
+    for clause in qgis_feature_request.orderBy():
+        if not clause.expression().isField():
+            return None
+        order_by.append((list(clause.expression().referencedColumns())[0], clause.ascending()))
+    return order_by
+
+
+def feature_cursor(feature, qgis_layer):
+    """Returns the keyset pagination cursor of a feature, to get the features after it
+    with get_qgis_features(cursor=...)
+
+    :param feature: the feature, with the primary key attribute
+    :type feature: QgsFeature
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :return: the primary key (feature id if the layer has no single column primary key)
+    :rtype: str
+    """
+
+    pk_name = _pk_field_name(qgis_layer)
+    if pk_name is None:
+        return str(feature.id())
+    return str(feature.attribute(pk_name))
+
+
+def _paging_subset_string(qgis_layer, order_by, limit, offset):
+    """Returns a subset string selecting a page of features with LIMIT and OFFSET
+    in the provider SQL, for PostGIS, SpatiaLite and GPKG/SQLite layers with a single
+    column primary key. The subquery applies the current subset string of the layer.
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param order_by: list of (field name, ascending), see _order_by_fields()
+    :type order_by: list
+    :param limit: page size
+    :type limit: int
+    :param offset: number of features to skip
+    :type offset: int
+    :return: the subset string, None if the provider is not supported
+    :rtype: str
+    """
+
+    pk_name = _pk_field_name(qgis_layer)
+    if pk_name is None:
+        return None
+
+    provider = qgis_layer.dataProvider()
+    if provider.name() in ('postgres', 'spatialite'):
+        uri = QgsDataSourceUri(qgis_layer.source())
+        # Query layers: the table is a subquery
+        table = uri.table() if uri.table().startswith('(') else uri.quotedTablename()
+        if uri.table().startswith('('):
+            table += ' AS _g3w_paging'
+    elif provider.name() == 'ogr' and provider.storageType() in ('GPKG', 'SQLite'):
+        layer_name = QgsProviderRegistry.instance().decodeUri('ogr', qgis_layer.source()).get('layerName')
+        if not layer_name:
+            return None
+        table = QgsExpression.quotedColumnRef(layer_name)
+    else:
+        return None
+
+    pk = QgsExpression.quotedColumnRef(pk_name)
+    order_by_sql = []
+    for field_name, ascending in order_by:
+        # Not existing fields are ignored, as QGIS does
+        if qgis_layer.fields().indexOf(field_name) != -1:
+            order_by_sql.append('{} {}'.format(QgsExpression.quotedColumnRef(field_name),
+                                               'ASC' if ascending else 'DESC'))
+    # The primary key makes the order stable between pages
+    order_by_sql.append('{} ASC'.format(pk))
+
+    subset_string = qgis_layer.subsetString()
+    return '{pk} IN (SELECT {pk} FROM {table}{where} ORDER BY {order_by} LIMIT {limit} OFFSET {offset})'.format(
+        pk=pk,
+        table=table,
+        where=' WHERE ({})'.format(subset_string) if subset_string else '',
+        order_by=', '.join(order_by_sql),
+        limit=int(limit),
+        offset=int(offset))
+
+
+def _get_page_features(qgis_layer, qgis_feature_request, offset, page_size):
+    """Returns a page of features when the offset cannot be pushed to the provider:
+    the ids of the features up to the end of the page are fetched without attributes
+    and geometries (i.e. primary keys only), then the features of the page are fetched by id.
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param qgis_feature_request: the QGIS feature request with filters and ordering
+    :type qgis_feature_request: QgsFeatureRequest
+    :param offset: number of features to skip
+    :type offset: int
+    :param page_size: page size
+    :type page_size: int
+    :return: list of features
+    :rtype: QgsFeature list
+    """
+
+    fids_request = QgsFeatureRequest(qgis_feature_request)
+    fids_request.setFlags(fids_request.flags() | QgsFeatureRequest.NoGeometry)
+    fids_request.setNoAttributes()
+    fids_request.setLimit(offset + page_size)
+    fids = [f.id() for f in qgis_layer.getFeatures(fids_request)][offset:]
+    if not fids:
+        return []
+
+    page_request = QgsFeatureRequest(qgis_feature_request)
+    page_request.setFilterFids(fids)
+    page_request.setLimit(-1)
+    page_request.setOrderBy(QgsFeatureRequest.OrderBy())
+    features = {f.id(): f for f in qgis_layer.getFeatures(page_request)}
+
+    return [features[fid] for fid in fids if fid in features]
+
+
+def __prepare_qgis_feature_request(qgis_layer,
+                                   qgis_feature_request=None,
+                                   bbox_filter=None,
+                                   attribute_filters=None,
+                                   search_filter=None,
+                                   with_geometry=True,
+                                   ordering=None,
+                                   exclude_fields=None,
+                                   extra_expression=None):
+    """Private implementation for count and get: configures the feature request with the filters,
+    returns the request and the list of the expressions to be combined with AND"""
 
     if qgis_feature_request is None:
         qgis_feature_request = QgsFeatureRequest()
@@ -174,23 +532,85 @@ def __get_qgis_features(qgis_layer,
             exp_parts.append('"{field_name}" ILIKE \'%{field_value}%\''.format(field_name=field_name.replace('"', '\\"'), field_value=str(field_value).replace('\'', '\\\'')))
         expression_parts.append(' AND '.join(exp_parts))
 
+    return qgis_feature_request, expression_parts
+
+
+def __set_extra_subset_string(qgis_layer, extra_subset_string):
+    """Private implementation for count and get: combines the extra subset string with
+    the subset string of the layer, returns the original subset string"""
+
+    original_subset_string = qgis_layer.subsetString()
+    if extra_subset_string is not None:
+        subset_string = original_subset_string
+        if subset_string:
+            qgis_layer.setSubsetString("({original_subset_string}) AND ({extra_subset_string})".format(original_subset_string=original_subset_string, extra_subset_string=extra_subset_string))
+        else:
+            qgis_layer.setSubsetString(extra_subset_string)
+
+    return original_subset_string
+
+
+def __iter_qgis_features(qgis_layer,
+                         qgis_feature_request=None,
+                         bbox_filter=None,
+                         attribute_filters=None,
+                         search_filter=None,
+                         with_geometry=True,
+                         page=None,
+                         page_size=None,
+                         ordering=None,
+                         exclude_fields=None,
+                         extra_expression=None,
+                         extra_subset_string=None,
+                         cursor=None,
+                         batch_size=None,
+                         feedback=None):
+    """Private implementation for get and iter: yields lists of batch_size features,
+    all the features in a single list if batch_size is None"""
+
+    qgis_feature_request, expression_parts = __prepare_qgis_feature_request(qgis_layer,
+                                                                            qgis_feature_request,
+                                                                            bbox_filter,
+                                                                            attribute_filters,
+                                                                            search_filter,
+                                                                            with_geometry,
+                                                                            ordering,
+                                                                            exclude_fields,
+                                                                            extra_expression)
+
     offset = 0
-    feature_count = qgis_layer.featureCount()
 
-    if page is not None and page_size is not None:
+    if cursor is not None and page_size is not None:
+        # Keyset pagination: ordered by primary key, starting after the cursor,
+        # the cursor filter is not applied to the request of the caller (i.e. for counting)
+        qgis_feature_request = QgsFeatureRequest(qgis_feature_request)
+        page_size = int(page_size)
+        key, cursor_expression = _cursor_expression(qgis_layer, cursor)
+        qgis_feature_request.setOrderBy(QgsFeatureRequest.OrderBy([QgsFeatureRequest.OrderByClause(key, True)]))
+        qgis_feature_request.setLimit(page_size)
+    elif page is not None and page_size is not None:
         page_size = int(page_size)
         page = int(page)
         offset = page_size * (page - 1)
-        feature_count =  page_size * page
         # Set to max, without taking filters into account
-        qgis_feature_request.setLimit(feature_count)
+        qgis_feature_request.setLimit(page_size * page)
     else:
         page_size = None  # make sure it's none
+        cursor = None
 
     # Fetch features
     if expression_parts:
-        qgis_feature_request.setFilterExpression('(' + ') AND ('.join(expression_parts) + ')')
+        qgis_feature_request.combineFilterExpression('(' + ') AND ('.join(expression_parts) + ')')
+
+    # Combined with the filters of the request, i.e. from filter backends
+    if cursor is not None and cursor_expression is not None:
+        qgis_feature_request.combineFilterExpression(cursor_expression)
 
+    # Let the providers stop the scan when the budget is exhausted (QGIS >= 3.20),
+    # the request of the caller must not keep a reference to the feedback
+    if feedback is not None and hasattr(qgis_feature_request, 'setFeedback'):
+        qgis_feature_request = QgsFeatureRequest(qgis_feature_request)
+        qgis_feature_request.setFeedback(feedback)
 
     logger.debug('Fetching features from layer {layer_name} - filter expression: {filter} - BBOX: {bbox}'.format(
         layer_name=qgis_layer.name(),
@@ -198,34 +618,40 @@ def __get_qgis_features(qgis_layer,
         bbox=qgis_feature_request.filterRect()
     ))
 
-    features = []
-
-    original_subset_string = qgis_layer.subsetString()
-    if extra_subset_string is not None:
-        subset_string = original_subset_string
-        if subset_string:
-            qgis_layer.setSubsetString("({original_subset_string}) AND ({extra_subset_string})".format(original_subset_string=original_subset_string, extra_subset_string=extra_subset_string))
-        else:
-            qgis_layer.setSubsetString(extra_subset_string)
-
-    iterator = qgis_layer.getFeatures(qgis_feature_request)
+    original_subset_string = __set_extra_subset_string(qgis_layer, extra_subset_string)
+    subset_string_changed = extra_subset_string is not None
 
     try:
-        for _ in range(offset):
-            next(iterator)
-        if page_size is not None:
-            for __ in range(page_size):
-                features.append(next(iterator))
+        order_by = _order_by_fields(qgis_feature_request)
+        if offset > 0 and order_by is not None and qgis_feature_request.filterType() == QgsFeatureRequest.FilterNone \
+                and qgis_feature_request.filterRect().isEmpty():
+            # All the filters are in the subset string: push LIMIT and OFFSET to the provider
+            paging_subset_string = _paging_subset_string(qgis_layer, order_by, page_size, offset)
+            if paging_subset_string is not None and qgis_layer.setSubsetString(paging_subset_string):
+                subset_string_changed = True
+                offset = 0
+                qgis_feature_request.setLimit(page_size)
+
+        if offset > 0:
+            features = _get_page_features(qgis_layer, qgis_feature_request, offset, page_size)
         else:
-            while True:
-                features.append(next(iterator))
-    except StopIteration:
-        pass
+            features = qgis_layer.getFeatures(qgis_feature_request)
 
-    if extra_subset_string is not None:
-        qgis_layer.setSubsetString(original_subset_string)
+        if feedback is not None:
+            features = feedback.iterate(features)
 
-    return features
+        batch = []
+        for feature in features:
+            batch.append(feature)
+            if batch_size is not None and len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    finally:
+        if subset_string_changed:
+            qgis_layer.setSubsetString(original_subset_string)
 
 
 def get_qgis_features(qgis_layer,
@@ -239,7 +665,9 @@ def get_qgis_features(qgis_layer,
                       ordering=None,
                       exclude_fields=None,
                       extra_expression=None,
-                      extra_subset_string=None):
+                      extra_subset_string=None,
+                      cursor=None,
+                      feedback=None):
     """Returns a list of QgsFeatures from the QGIS vector layer,
     with optional filter options.
 
@@ -273,11 +701,19 @@ def get_qgis_features(qgis_layer,
     :type: extra_expression: str, optional
     :param: extra_subset_string: extra subset string (provider side WHERE condition) for filtering features
     :type: extra_subset_string: str, optional
+    :param cursor: keyset pagination (requires page_size, ignores page and ordering): features are ordered
+                   by primary key and the page starts after the cursor value, i.e. the primary key
+                   of the last feature of the previous page, empty string for the first page
+    :type cursor: str, optional
+    :param feedback: time and feature budget of the scan
+    :type feedback: FeaturesBudget, optional
+    :raises FeaturesBudgetExceeded: when the budget of the feedback is exhausted
     :return: list of features
     :rtype: QgsFeature list
     """
 
-    return __get_qgis_features(qgis_layer,
+    features = []
+    for batch in __iter_qgis_features(qgis_layer,
                       qgis_feature_request,
                       bbox_filter,
                       attribute_filters,
@@ -288,7 +724,255 @@ def get_qgis_features(qgis_layer,
                       ordering,
                       exclude_fields,
                       extra_expression,
-                      extra_subset_string)
+                      extra_subset_string,
+                      cursor,
+                      None,
+                      feedback):
+        features.extend(batch)
+
+    return features
+
+
+def iter_qgis_features(qgis_layer,
+                       qgis_feature_request=None,
+                       batch_size=FEATURES_BATCH_SIZE,
+                       feedback=None,
+                       **kwargs):
+    """Yields the QgsFeatures from the QGIS vector layer in lists of batch_size features,
+    the features of the next batch are not fetched until the current batch is consumed.
+
+    The filter options are the same of get_qgis_features. The subset string of the layer can be
+    changed while iterating (i.e. by extra_subset_string): it is restored when the iteration
+    ends or the generator is closed, so iterate all the batches or close the generator.
+
+    :param qgis_layer: the QGIS vector layer instance
+    :type qgis_layer: QgsVectorLayer
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest, optional
+    :param batch_size: number of features of each batch, defaults to 1000
+    :type batch_size: int, optional
+    :param feedback: time and feature budget of the scan
+    :type feedback: FeaturesBudget, optional
+    :param kwargs: filter options of get_qgis_features
+    :raises FeaturesBudgetExceeded: when the budget of the feedback is exhausted
+    :return: generator of lists of features
+    :rtype: generator
+    """
+
+    return __iter_qgis_features(qgis_layer, qgis_feature_request, batch_size=batch_size, feedback=feedback, **kwargs)
+
+
+# Binary operators of QGIS expressions that are pushed down to PostgreSQL, with their SQL
+_SQL_BINARY_OPERATORS = {
+    QgsExpressionNodeBinaryOperator.boOr: 'OR',
+    QgsExpressionNodeBinaryOperator.boAnd: 'AND',
+    QgsExpressionNodeBinaryOperator.boEQ: '=',
+    QgsExpressionNodeBinaryOperator.boNE: '<>',
+    QgsExpressionNodeBinaryOperator.boLE: '<=',
+    QgsExpressionNodeBinaryOperator.boGE: '>=',
+    QgsExpressionNodeBinaryOperator.boLT: '<',
+    QgsExpressionNodeBinaryOperator.boGT: '>',
+    QgsExpressionNodeBinaryOperator.boLike: 'LIKE',
+    QgsExpressionNodeBinaryOperator.boNotLike: 'NOT LIKE',
+    QgsExpressionNodeBinaryOperator.boILike: 'ILIKE',
+    QgsExpressionNodeBinaryOperator.boNotILike: 'NOT ILIKE',
+    QgsExpressionNodeBinaryOperator.boIs: 'IS NOT DISTINCT FROM',
+    QgsExpressionNodeBinaryOperator.boIsNot: 'IS DISTINCT FROM',
+}
+
+
+def _sql_literal(value):
+    """Returns the PostgreSQL literal of a QGIS expression literal value
+
+    :param value: the literal value
+    :return: the quoted SQL literal, None if the value type is not supported
+    :rtype: str
+    """
+
+    if value is None or (isinstance(value, QVariant) and value.isNull()):
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else None
+    if isinstance(value, str):
+        if '\x00' in value:
+            return None
+        # Escape string syntax is quoted the same whatever standard_conforming_strings is
+        return "E'{}'".format(value.replace('\\', '\\\\').replace("'", "''"))
+    return None
+
+
+def _expression_to_sql(qgis_layer, node):
+    """Compiles a QGIS expression node to a PostgreSQL WHERE clause.
+
+    Only provider field references, literals, the IN operator, NOT and the comparison and
+    boolean operators are compiled: identifiers and literals are quoted with the SQL rules,
+    the original expression text is never used.
+
+    :param qgis_layer: QGIS vector layer, for the field names
+    :type qgis_layer: QgsVectorLayer
+    :param node: the expression node, usually QgsExpression.rootNode()
+    :type node: QgsExpressionNode
+    :return: the SQL clause, None if the node cannot be compiled
+    :rtype: str
+    """
+
+    if node is None:
+        return None
+
+    if isinstance(node, QgsExpressionNodeColumnRef):
+        fields = qgis_layer.fields()
+        index = fields.lookupField(node.name())
+        if index < 0 or fields.fieldOrigin(index) != QgsFields.OriginProvider:
+            return None
+        return '"{}"'.format(fields.at(index).name().replace('"', '""'))
+
+    if isinstance(node, QgsExpressionNodeLiteral):
+        return _sql_literal(node.value())
+
+    if isinstance(node, QgsExpressionNodeUnaryOperator):
+        operand = _expression_to_sql(qgis_layer, node.operand())
+        if operand is None:
+            return None
+        if node.op() == QgsExpressionNodeUnaryOperator.uoNot:
+            return '(NOT {})'.format(operand)
+        if node.op() == QgsExpressionNodeUnaryOperator.uoMinus:
+            return '(-{})'.format(operand)
+        return None
+
+    if isinstance(node, QgsExpressionNodeBinaryOperator):
+        operator = _SQL_BINARY_OPERATORS.get(node.op())
+        if operator is None:
+            return None
+        left = _expression_to_sql(qgis_layer, node.opLeft())
+        right = _expression_to_sql(qgis_layer, node.opRight())
+        if left is None or right is None:
+            return None
+        return '({} {} {})'.format(left, operator, right)
+
+    if isinstance(node, QgsExpressionNodeInOperator):
+        value = _expression_to_sql(qgis_layer, node.node())
+        items = [_expression_to_sql(qgis_layer, item) for item in node.list().list()]
+        if value is None or not items or None in items:
+            return None
+        return '({} {} ({}))'.format(value, 'NOT IN' if node.isNotIn() else 'IN', ', '.join(items))
+
+    return None
+
+
+def _provider_subset_string(qgis_layer, qgis_feature_request):
+    """Returns the layer subset string combined with the filter expression of the request
+    compiled to SQL, for PostGIS layers
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param qgis_feature_request: the QGIS feature request with a filter expression
+    :type qgis_feature_request: QgsFeatureRequest
+    :return: the subset string, None if the expression cannot be compiled
+    :rtype: str
+    """
+
+    if qgis_layer.dataProvider().name() != 'postgres':
+        return None
+
+    expression = qgis_feature_request.filterExpression()
+    if expression is None or expression.hasParserError():
+        return None
+
+    sql = _expression_to_sql(qgis_layer, expression.rootNode())
+    if sql is None:
+        return None
+
+    subset_string = qgis_layer.subsetString()
+    return '({}) AND {}'.format(subset_string, sql) if subset_string else sql
+
+
+def _provider_count(qgis_layer, qgis_feature_request):
+    """Returns the number of features matching the request counted by the provider
+    (i.e. SELECT COUNT(*)), with the filter expression added to the layer subset string:
+    only for PostGIS layers and expressions that can be compiled to SQL (see _expression_to_sql).
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest
+    :return: the count, None if the request cannot be counted by the provider
+    :rtype: int
+    """
+
+    if not qgis_feature_request.filterRect().isEmpty():
+        return None
+
+    if qgis_feature_request.filterType() == QgsFeatureRequest.FilterNone:
+        count = qgis_layer.featureCount()
+        return count if count >= 0 else None
+
+    if qgis_feature_request.filterType() != QgsFeatureRequest.FilterExpression:
+        return None
+
+    provider_subset_string = _provider_subset_string(qgis_layer, qgis_feature_request)
+    if provider_subset_string is None:
+        return None
+
+    subset_string = qgis_layer.subsetString()
+    if not qgis_layer.setSubsetString(provider_subset_string):
+        # Rejected by the provider (i.e. type mismatch): it has kept the original subset string
+        return None
+
+    try:
+        count = qgis_layer.featureCount()
+    finally:
+        qgis_layer.setSubsetString(subset_string)
+
+    return count if count >= 0 else None
+
+
+def _estimated_count(qgis_layer, qgis_feature_request):
+    """Returns the PostgreSQL planner estimate of the number of features matching the request,
+    for PostGIS layers when it is greater than APPROXIMATE_COUNT_THRESHOLD
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest
+    :return: the estimate, None if not available or under the threshold
+    :rtype: int
+    """
+
+    if qgis_layer.dataProvider().name() != 'postgres' or not qgis_feature_request.filterRect().isEmpty() \
+            or qgis_feature_request.filterType() not in (QgsFeatureRequest.FilterNone,
+                                                         QgsFeatureRequest.FilterExpression):
+        return None
+
+    # The filter expression is never added as text: only its SQL compilation is
+    if qgis_feature_request.filterType() == QgsFeatureRequest.FilterExpression:
+        where = _provider_subset_string(qgis_layer, qgis_feature_request)
+        if where is None:
+            return None
+    else:
+        where = qgis_layer.subsetString()
+
+    uri = QgsDataSourceUri(qgis_layer.source())
+    table = '{} AS _g3w_count'.format(uri.table()) if uri.table().startswith('(') else uri.quotedTablename()
+    sql = 'EXPLAIN (FORMAT JSON) SELECT 1 FROM {}{}'.format(
+        table, ' WHERE ({})'.format(where) if where else '')
+
+    try:
+        connection = QgsProviderRegistry.instance().providerMetadata('postgres').createConnection(
+            qgis_layer.source(), {})
+        plan = connection.executeSql(sql)[0][0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        estimate = int(plan[0]['Plan']['Plan Rows'])
+    except Exception as e:
+        logger.debug('Estimated count not available for layer {}: {}'.format(qgis_layer.name(), e))
+        return None
+
+    return estimate if estimate >= APPROXIMATE_COUNT_THRESHOLD else None
+
 
 def count_qgis_features(qgis_layer,
                       qgis_feature_request=None,
@@ -297,8 +981,10 @@ def count_qgis_features(qgis_layer,
                       search_filter=None,
                       extra_expression=None,
                       extra_subset_string=None,
+                      approximate=False,
+                      feedback=None,
                       **kwargs):
-    """Returns a list of QgsFeatures from the QGIS vector layer,
+    """Returns the number of QgsFeatures from the QGIS vector layer,
     with optional filter options.
 
     The API can be used in two distinct ways (that are not mutually exclusive):
@@ -307,6 +993,10 @@ def count_qgis_features(qgis_layer,
     2. pass a series of filter attributes and let this method configure
     the QgsFeatureRequest.
 
+    Features are counted by the provider when the filters can be pushed to it
+    (subset strings and, for PostGIS, filter expressions that are valid SQL),
+    else they are iterated without attributes and geometries.
+
     :param qgis_layer: the QGIS vector layer instance
     :type qgis_layer: QgsVectorLayer
     :param qgis_feature_request: the QGIS feature request
@@ -317,19 +1007,25 @@ def count_qgis_features(qgis_layer,
     :type attribute_filters: dict, optional
     :param search_filter: string filter for all fields
     :type search_filter: str, optional
-    :param: exclude_fields: list of fields to exclude from returned data, '__all__' for no attributes
     :param: extra_expression: extra expression for filtering features
     :type: extra_expression: str, optional
     :param: extra_subset_string: extra subset string (provider side WHERE condition) for filtering features
     :type: extra_subset_string: str, optional
-    :return: list of features
-    :rtype: QgsFeature list
+    :param approximate: return the PostgreSQL planner estimate for PostGIS layers, when it is
+                        greater than G3WADMIN_APPROXIMATE_COUNT_THRESHOLD
+    :type approximate: bool, optional
+    :param feedback: time budget of the scan when the features are iterated, the feature budget
+                     is not used for counting
+    :type feedback: FeaturesBudget, optional
+    :raises FeaturesBudgetExceeded: when the time budget of the feedback is exhausted
+    :return: number of features
+    :rtype: int
     """
 
     # Fast track for no filters
     no_filters = (attribute_filters is None
         and (bbox_filter is None or bbox_filter.isEmpty()) and
-        attribute_filters is None and
+        search_filter is None and
         extra_expression is None and
         extra_subset_string is None)
 
@@ -337,30 +1033,181 @@ def count_qgis_features(qgis_layer,
         no_filters = (no_filters and
             qgis_feature_request.filterRect().isEmpty() and
             qgis_feature_request.filterType() == QgsFeatureRequest.FilterNone)
+        qgis_feature_request = QgsFeatureRequest(qgis_feature_request)
     else:
         qgis_feature_request = QgsFeatureRequest()
 
-    if no_filters:
+    if no_filters and not approximate:
         # Try to patch a possible Oracle views QGIS featureCount bug.
         qgs_fc = qgis_layer.featureCount()
         if qgs_fc != -1:
-            return qgis_layer.featureCount()
+            return qgs_fc
+
+    qgis_feature_request, expression_parts = __prepare_qgis_feature_request(qgis_layer,
+                                                                            qgis_feature_request,
+                                                                            bbox_filter,
+                                                                            attribute_filters,
+                                                                            search_filter,
+                                                                            False, # with_geometry
+                                                                            None, # ordering
+                                                                            '__all__', # exclude_fields
+                                                                            extra_expression)
+    qgis_feature_request.setLimit(-1)
+    qgis_feature_request.setOrderBy(QgsFeatureRequest.OrderBy())
+    if expression_parts:
+        qgis_feature_request.combineFilterExpression('(' + ') AND ('.join(expression_parts) + ')')
 
-    qgis_feature_request.setNoAttributes()
-    if qgis_feature_request.limit() != -1:
-        qgis_feature_request = QgsFeatureRequest(qgis_feature_request)
-        qgis_feature_request.setLimit(-1)
+    original_subset_string = __set_extra_subset_string(qgis_layer, extra_subset_string)
 
-    return len(__get_qgis_features(qgis_layer,
-                      qgis_feature_request,
-                      bbox_filter,
-                      attribute_filters,
-                      search_filter,
-                      False, #with_geometry,
-                      None, #page,
-                      None, #page_size,
-                      None, #ordering,
-                      None, #exclude_fields,
-                      extra_expression,
-                      extra_subset_string))
+    try:
+        count = None
+        if approximate:
+            count = _estimated_count(qgis_layer, qgis_feature_request)
+        if count is None:
+            count = _provider_count(qgis_layer, qgis_feature_request)
+        if count is None:
+            # Iterate without building the list of the features
+            if feedback is not None and hasattr(qgis_feature_request, 'setFeedback'):
+                qgis_feature_request.setFeedback(feedback)
+            features = qgis_layer.getFeatures(qgis_feature_request)
+            if feedback is not None:
+                features = feedback.iterate(features, count=False)
+            count = 0
+            for _ in features:
+                count += 1
+    finally:
+        if extra_subset_string is not None:
+            qgis_layer.setSubsetString(original_subset_string)
+
+    return count
+
+
+def _provider_unique_values(qgis_layer, field_index, qgis_feature_request, limit):
+    """Returns the unique values of a field matching the request computed by the provider
+    (i.e. SELECT DISTINCT), with the filter expression added to the layer subset string:
+    only for PostGIS layers and expressions that can be compiled to SQL (see _expression_to_sql).
+
+    :param qgis_layer: QGIS vector layer
+    :type qgis_layer: QgsVectorLayer
+    :param field_index: index of the field
+    :type field_index: int
+    :param qgis_feature_request: the QGIS feature request
+    :type qgis_feature_request: QgsFeatureRequest
+    :param limit: max number of values, -1 for no limit
+    :type limit: int
+    :return: the values, None if the request cannot be pushed to the provider
+    :rtype: set
+    """
+
+    if not qgis_feature_request.filterRect().isEmpty():
+        return None
+
+    if qgis_feature_request.filterType() == QgsFeatureRequest.FilterNone:
+        return qgis_layer.uniqueValues(field_index, limit)
+
+    if qgis_feature_request.filterType() != QgsFeatureRequest.FilterExpression \
+            or qgis_layer.fields().fieldOrigin(field_index) != QgsFields.OriginProvider:
+        return None
+
+    provider_subset_string = _provider_subset_string(qgis_layer, qgis_feature_request)
+    if provider_subset_string is None:
+        return None
+
+    subset_string = qgis_layer.subsetString()
+    if not qgis_layer.setSubsetString(provider_subset_string):
+        # Rejected by the provider (i.e. type mismatch): it has kept the original subset string
+        return None
+
+    try:
+        return qgis_layer.uniqueValues(field_index, limit)
+    finally:
+        qgis_layer.setSubsetString(subset_string)
+
+
+def get_qgis_unique_values(qgis_layer,
+                           field_name,
+                           qgis_feature_request=None,
+                           limit=UNIQUE_VALUES_LIMIT,
+                           data_generation=None,
+                           feedback=None):
+    """Returns the unique values of a field of the QGIS vector layer, for the features matching
+    the layer subset string and the filters of the request.
+
+    The values are computed by the provider (i.e. SELECT DISTINCT) when the filters can be pushed
+    to it (subset strings and, for PostGIS, filter expressions that can be compiled to SQL), else the features
+    are iterated with the field only and without geometries.
+
+    When data_generation is not None the values are cached for G3WADMIN_UNIQUE_VALUES_CACHE_TIMEOUT seconds,
+    the key includes the layer, the data generation, the field, the limit and all the filters.
+
+    :param qgis_layer: the QGIS vector layer instance
+    :type qgis_layer: QgsVectorLayer
+    :param field_name: the name of the field
+    :type field_name: str
+    :param qgis_feature_request: the QGIS feature request, it is not changed
+    :type qgis_feature_request: QgsFeatureRequest, optional
+    :param limit: max number of values, -1 for no limit, defaults to G3WADMIN_UNIQUE_VALUES_LIMIT
+    :type limit: int, optional
+    :param data_generation: version of the layer data, changed when the data change
+    :type data_generation: int, optional
+    :param feedback: time budget of the scan when the features are iterated
+    :type feedback: FeaturesBudget, optional
+    :raises FeaturesBudgetExceeded: when the time budget of the feedback is exhausted
+    :return: unique values converted to JSON types, NULL is None
+    :rtype: list
+    """
+
+    field_index = qgis_layer.fields().indexOf(field_name)
+    if field_index < 0:
+        return []
+
+    qgis_feature_request = QgsFeatureRequest(qgis_feature_request) if qgis_feature_request is not None \
+        else QgsFeatureRequest()
+
+    key = None
+    if data_generation is not None:
+        bits = [qgis_layer.id(), qgis_layer.source(), str(data_generation), field_name, str(limit),
+                qgis_layer.subsetString(), qgis_feature_request.filterRect().asWktPolygon()
+                if not qgis_feature_request.filterRect().isEmpty() else '']
+        if qgis_feature_request.filterType() == QgsFeatureRequest.FilterExpression:
+            bits.append(qgis_feature_request.filterExpression().expression())
+        elif qgis_feature_request.filterType() != QgsFeatureRequest.FilterNone:
+            # Fids filters are not cached
+            bits = None
+        if bits is not None:
+            key = UNIQUE_VALUES_CACHE_KEY.format(hashlib.sha1('\n'.join(bits).encode('utf-8')).hexdigest())
+            values = cache.get(key)
+            if values is not None:
+                return values
+
+    values = _provider_unique_values(qgis_layer, field_index, qgis_feature_request, limit)
+
+    if values is None:
+        # Iterate the features with the field only
+        qgis_feature_request.setLimit(-1)
+        qgis_feature_request.setOrderBy(QgsFeatureRequest.OrderBy())
+        qgis_feature_request.setFlags(qgis_feature_request.flags() | QgsFeatureRequest.NoGeometry)
+        qgis_feature_request.setSubsetOfAttributes([field_index])
+        if feedback is not None and hasattr(qgis_feature_request, 'setFeedback'):
+            qgis_feature_request.setFeedback(feedback)
+        features = qgis_layer.getFeatures(qgis_feature_request)
+        if feedback is not None:
+            features = feedback.iterate(features, count=False)
+        values = set()
+        for feature in features:
+            values.add(feature.attribute(field_index))
+            if 0 <= limit <= len(values):
+                break
+
+    json_values = []
+    for value in values:
+        try:
+            json_values.append(json.loads(QgsJsonUtils.encodeValue(value)))
+        except Exception as e:
+            logger.error('Unique values of layer {}: {}'.format(qgis_layer.name(), e))
+
+    if key is not None:
+        cache.set(key, json_values, UNIQUE_VALUES_CACHE_TIMEOUT)
+
+    return json_values
 
@@ -0,0 +1,56 @@
+# coding=utf-8
+""""Huey task decorators shared by the suite modules
+
+.. note:: This program is free software; you can redistribute it and/or modify
+          it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-03-29'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+from functools import wraps
+
+from django.db import close_old_connections
+from huey.contrib.djhuey import HUEY
+
+task = HUEY.task
+
+
+def close_db(fn):
+    """Decorator called by db_task() to be used with tasks that may operate
+    on the database.
+
+    This implementation is a copy of djhuey implementation but it falls
+    back to noop when HUEY.testing is True.
+
+    Set HUEY.testing to True to skip DB connection close.
+
+    """
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            if not HUEY.immediate and not getattr(HUEY, 'testing', False):
+                close_old_connections()
+    return inner
+
+
+def db_task(*args, **kwargs):
+    """Decorator to be used with tasks that may operate on the database.
+
+    This implementation is a copy of djhuey implementation but it falls
+    back to noop when HUEY.testing is True.
+
+    Set HUEY.testing to True to skip DB connection close.
+
+    """
+
+    def decorator(fn):
+        ret = task(*args, **kwargs)(close_db(fn))
+        ret.call_local = fn
+        return ret
+    return decorator
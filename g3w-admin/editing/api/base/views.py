@@ -12,8 +12,8 @@ from rest_framework.exceptions import ValidationError
 
 from core.api.base.vector import MetadataVectorLayer
 from core.api.base.views import BaseVectorOnModelApiView
-from core.signals import (post_save_maplayer, pre_delete_maplayer,
-                          pre_save_maplayer)
+from core.signals import (post_commit_maplayer, post_save_maplayer,
+                          pre_delete_maplayer, pre_save_maplayer)
 from core.utils.qgisapi import server_fid, get_layer_fids_from_server_fids
 from editing.models import (EDITING_POST_DATA_ADDED, EDITING_POST_DATA_DELETED,
                             EDITING_POST_DATA_UPDATED)
@@ -121,6 +121,21 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
                         MAPPING_DJANGO_MODEL_FIELD_FILE_OBJECT[type(
                             media_property)](media_file)
 
+    def add_changed_extent(self, metadata_layer, geometry):
+        """Record the bounding box of a geometry added, changed or deleted by editing
+
+        :param metadata_layer: metadata of the layer being edited
+        :type metadata_layer: MetadataVectorLayer
+        :param geometry: the geometry, in the layer CRS
+        :type geometry: QgsGeometry
+        """
+
+        if geometry is None or geometry.isNull():
+            return
+        bbox = geometry.boundingBox()
+        metadata_layer.changed_extents.append(
+            (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()))
+
     def save_vector_data(self, metadata_layer, post_layer_data, has_transactions, post_save_signal=True, **kwargs):
         """Save vector editing data
 
@@ -247,7 +262,17 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
                                     # update pk attribute:
                                     feature.setAttribute(pks[0], server_fid(feature, qgis_layer.dataProvider()))
 
+                            if metadata_layer.geometry_type != QGIS_LAYER_TYPE_NO_GEOM:
+                                self.add_changed_extent(metadata_layer, feature.geometry())
+
                         elif mode_editing == EDITING_POST_DATA_UPDATED:
+
+                            # Geometry before the update: attribute changes may change the rendering too
+                            if metadata_layer.geometry_type != QGIS_LAYER_TYPE_NO_GEOM:
+                                self.add_changed_extent(metadata_layer,
+                                                        qgis_layer.getFeature(geojson_feature['id']).geometry())
+                                self.add_changed_extent(metadata_layer, feature.geometry())
+
                             attr_map = {}
                             for name, value in geojson_feature['properties'].items():
                                 if name in qgis_layer.dataProvider().fieldNameMap():
@@ -335,6 +360,9 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
                 # FIXME: pre_delete_maplayer
                 # pre_delete_maplayer.send(metadata_layer.serializer, layer=metadata_layer.layer_id, # data=serializer.data, user=self.request.user)
 
+                if metadata_layer.geometry_type != QGIS_LAYER_TYPE_NO_GEOM:
+                    self.add_changed_extent(metadata_layer, qgis_layer.getFeature(feature_id).geometry())
+
                 qgis_layer.dataProvider().clearErrors()
 
                 if has_transactions:
@@ -361,6 +389,7 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
         post_layer_data = request.data
 
         new_relations = dict()
+        post_relations_data = dict()
 
         # Store references to all layers that have been made editable,
         # used to commit/rollback at the end of the loop and on errors
@@ -394,7 +423,6 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
                 self.metadata_layer, post_layer_data, has_transactions)
 
             # get every relationsedits
-            post_relations_data = dict()
             if self.relations_data_key in post_layer_data and bool(post_layer_data[self.relations_data_key]):
                 post_relations_data = post_layer_data[self.relations_data_key]
 
@@ -459,6 +487,19 @@ class BaseEditingVectorOnModelApiView(BaseVectorOnModelApiView):
                 'errors': str(e)
             })
 
+        # Notify layers data changes: without transactions the changes
+        # already written to the data source are not rolled back on errors
+        if self.results.result or not has_transactions:
+            post_commit_maplayer.send(self, layer=self.layer, user=request.user,
+                                      extents=self.metadata_layer.changed_extents,
+                                      crs=self.metadata_layer.qgis_layer.crs().authid())
+            for referencing_layer in self.metadata_relations.keys():
+                if referencing_layer in post_relations_data:
+                    metadata_relation = self.metadata_relations[referencing_layer]
+                    post_commit_maplayer.send(self, layer=metadata_relation.layer, user=request.user,
+                                              extents=metadata_relation.changed_extents,
+                                              crs=metadata_relation.qgis_layer.crs().authid())
+
         try:
             self.results.update({
                 'response': {
@@ -218,10 +218,12 @@ def validate_constraint(**kwargs):
     spatial_predicate = getattr(settings, 'EDITING_CONSTRAINT_SPATIAL_PREDICATE', 'contains')
 
     for rule in rules:
-        allowed_geom, __ = rule.get_constraint_geometry()
+        compiled = rule.get_compiled_constraint_geometry()
+        allowed_geom = compiled.geometry
         geom = geom_class(coords)
         geom.srid = allowed_geom.srid
-        predicate_method = getattr(allowed_geom, spatial_predicate)
+        # Use the prepared geometry when it supports the predicate
+        predicate_method = getattr(compiled.prepared, spatial_predicate, None) or getattr(allowed_geom, spatial_predicate)
         if not predicate_method(geom):
             raise IntegrityError( _('Constraint validation failed for geometry: %s') % geom.wkt)
 
@@ -25,10 +25,11 @@ from django.db import IntegrityError, transaction, connections
 from django.test import TestCase, override_settings
 from core.models import G3WSpatialRefSys, Group as CoreGroup
 from qdjango.utils.data import QgisProject
-from qdjango.models import GeoConstraint, GeoConstraintRule, Layer
+from qdjango.models import GeoConstraint, GeoConstraintRule, Layer, invalidate_constraint_geometries
 from editing.models import *
 
 from rest_framework.test import APIClient
+from qgis.core import QgsExpression, QgsExpressionContext, QgsFeature, QgsGeometry
 from guardian.shortcuts import assign_perm
 from usersmanage.utils import setPermissionUserObject
 
@@ -304,6 +305,55 @@ class ConstraintsModelTestsBase(ConstraintsTestsBase):
         rule.rule = 'dfs?Adfasdfs[đß+èèfsd+'
         self.assertFalse(rule.validate_sql()[0])
 
+    def test_compiled_constraint_geometry(self):
+        """Test cached constraint geometry and QGIS expression"""
+
+        editing_layer = Layer.objects.get(name='editing_layer')
+        constraint_layer = Layer.objects.get(name=self.constraint_layer_name)
+        constraint = GeoConstraint(
+            layer=editing_layer, constraint_layer=constraint_layer)
+        constraint.save()
+        rule = GeoConstraintRule(constraint=constraint,
+                              user=self.test_user1, rule='int_f=1')
+        rule.save()
+
+        compiled = rule.get_compiled_constraint_geometry()
+        self.assertGreater(compiled.count, 0)
+        self.assertIs(rule.get_compiled_constraint_geometry(), compiled)
+        self.assertTrue(rule.get_qgis_expression().startswith('bbox($geometry, '))
+        self.assertTrue(compiled.prepared.contains(compiled.geometry.point_on_surface))
+
+        # The expression references the compiled geometry instead of embedding its WKT
+        expression = rule.get_qgis_expression()
+        self.assertNotIn(compiled.geometry.wkt, expression)
+        self.assertIn("g3w_geoconstraint('{}', {}, $geometry)".format(compiled.token, rule.pk), expression)
+        self.assertTrue(compiled.evaluate(QgsGeometry.fromWkt(compiled.geometry.point_on_surface.wkt)))
+
+        context = QgsExpressionContext()
+        feature = QgsFeature()
+        feature.setGeometry(QgsGeometry.fromWkt(compiled.geometry.point_on_surface.wkt))
+        context.setFeature(feature)
+        self.assertTrue(QgsExpression(expression).evaluate(context))
+
+        # Unknown tokens never compile the geometry while evaluating
+        with self.assertNumQueries(0), self.assertLogs('qdjango.models.geoconstraints', level='WARNING'):
+            self.assertFalse(QgsExpression("g3w_geoconstraint('unknown', {}, $geometry)".format(
+                rule.pk)).evaluate(context))
+
+        xmin, ymin, xmax, ymax = compiled.geometry.extent
+        extent = rule.get_constraint_extent()
+        self.assertAlmostEqual(extent.xMinimum(), xmin)
+        self.assertAlmostEqual(extent.yMaximum(), ymax)
+
+        # Data changes of the constraint layer invalidate the cache
+        invalidate_constraint_geometries(constraint_layer.pk)
+        self.assertIsNot(rule.get_compiled_constraint_geometry(), compiled)
+
+        # Rule changes too
+        compiled = rule.get_compiled_constraint_geometry()
+        rule.rule = 'int_f=2'
+        self.assertIsNot(rule.get_compiled_constraint_geometry(), compiled)
+
     def test_editing_view_retrieve_data(self):
         """Test constraint filter for editing API - SELECT"""
 
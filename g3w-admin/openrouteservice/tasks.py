@@ -10,54 +10,11 @@ __author__ = 'elpaso@itopen.it'
 __date__ = '2021-03-29'
 __copyright__ = 'Copyright 2021, Gis3W'
 
-from functools import wraps
-
-from django.db import close_old_connections
-from huey.contrib.djhuey import HUEY
 from huey_monitor.tqdm import ProcessInfo
 
+from core.utils.tasks import db_task
 from .utils import isochrone_from_layer
 
-task = HUEY.task
-
-
-def close_db(fn):
-    """Decorator called by db_task() to be used with tasks that may operate
-    on the database.
-
-    This implementation is a copy of djhuey implementation but it falls
-    back to noop when HUEY.testing is True.
-
-    Set HUEY.testing to True to skip DB connection close.
-
-    """
-
-    @wraps(fn)
-    def inner(*args, **kwargs):
-        try:
-            return fn(*args, **kwargs)
-        finally:
-            if not HUEY.immediate and not getattr(HUEY, 'testing', False):
-                close_old_connections()
-    return inner
-
-
-def db_task(*args, **kwargs):
-    """Decorator to be used with tasks that may operate on the database.
-
-    This implementation is a copy of djhuey implementation but it falls
-    back to noop when HUEY.testing is True.
-
-    Set HUEY.testing to True to skip DB connection close.
-
-    """
-
-    def decorator(fn):
-        ret = task(*args, **kwargs)(close_db(fn))
-        ret.call_local = fn
-        return ret
-    return decorator
-
 
 @db_task(context=True)
 def isochrone_from_layer_task(input_qgis_layer_id, profile, params, project_id, qgis_layer_id, connection_id, new_layer_name, name, style, task):
@@ -67,14 +67,19 @@ class GeoConstraintsFilter(BaseFilterBackend):
     def apply_filter(self, request, qgis_layer, qgis_feature_request, view):
 
         rule_parts = []
+        extent = None
 
         rules = GeoConstraintRule.get_active_constraints_for_user(request.user, view.layer,
                                                                   context=getattr(view, 'context', 'v'))
 
-        for rule in rules:
-            expression = rule.get_qgis_expression()
-            if expression:
-                rule_parts.append(expression)
+        # The view keeps the compiled geometries referenced by the expressions
+        # until the features are fetched (i.e. while the response is streamed)
+        view.constraint_geometries = [rule.get_compiled_constraint_geometry() for rule in rules]
+
+        for compiled in view.constraint_geometries:
+            if compiled.expression:
+                rule_parts.append(compiled.expression)
+                extent = compiled.extent if extent is None else extent.intersect(compiled.extent)
 
         if rule_parts:
             expression = ' AND '.join(rule_parts)
@@ -84,3 +89,8 @@ class GeoConstraintsFilter(BaseFilterBackend):
                 expression = '( %s ) AND ( %s )' % (current_expression, expression)
 
             qgis_feature_request.setFilterExpression(expression)
+
+            # Let the provider discard the features outside of the constraint extent,
+            # the exact spatial predicate is evaluated on the remaining ones only
+            if extent is not None and not extent.isEmpty() and qgis_feature_request.filterRect().isNull():
+                qgis_feature_request.setFilterRect(extent)
@@ -151,5 +151,5 @@ class GeoConstraintGEOFeatureAPIView(APIView):
         for constraint in constraints:
             geom = constraint.get_constraint_geometry()
             if geom[1] > 0:
-                geometries.append(json.loads(constraint.get_constraint_geometry()[0].json))
+                geometries.append(json.loads(geom[0].json))
         return Response({'geometries': geometries})
\ No newline at end of file
@@ -1,5 +1,9 @@
+import hashlib
 import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 
 from core.utils.general import getAuthPermissionContentType
 from django.apps import AppConfig, apps
@@ -21,6 +25,39 @@ if settings.DEBUG:
 USE_CUSTOM_CACHE_INVALIDATOR = getattr(
     settings, 'G3WADMIN_USE_CUSTOM_CACHE_INVALIDATOR', False)
 
+# Seconds between two checks of the project files by the custom cache
+# invalidator watcher thread, 0 to check the project file on every request
+PROJECT_WATCHER_INTERVAL = getattr(
+    settings, 'G3WADMIN_PROJECT_WATCHER_INTERVAL', 2)
+
+# Cluster wide project cache invalidation through the database
+USE_PROJECT_INVALIDATION_BUS = getattr(
+    settings, 'G3WADMIN_USE_PROJECT_INVALIDATION_BUS', False)
+
+# Seconds between two checks of the shared generation of a project
+PROJECT_INVALIDATION_BUS_INTERVAL = getattr(
+    settings, 'G3WADMIN_PROJECT_INVALIDATION_BUS_INTERVAL', 1)
+
+# Max number of projects kept in the QGIS Server project cache, 0 for no limit
+MAX_CACHED_PROJECTS = getattr(
+    settings, 'G3WADMIN_MAX_CACHED_PROJECTS', 0)
+
+# Max process RSS in MB before evicting projects from the QGIS Server project cache, 0 for no limit
+MAX_CACHED_PROJECTS_RSS = getattr(
+    settings, 'G3WADMIN_MAX_CACHED_PROJECTS_RSS', 0)
+
+# Project file paths (or file names) which are never evicted from the QGIS Server project cache
+PINNED_PROJECTS = getattr(
+    settings, 'G3WADMIN_PINNED_PROJECTS', [])
+
+# Seconds between two logs of the QGIS Server project cache stats of a process, 0 to disable
+PROJECT_CACHE_STATS_LOG_INTERVAL = getattr(
+    settings, 'G3WADMIN_PROJECT_CACHE_STATS_LOG_INTERVAL', 600)
+
+# Seconds between two writes of the project request counts of a process to the database
+PROJECT_REQUESTS_FLUSH_INTERVAL = getattr(
+    settings, 'G3WADMIN_PROJECT_REQUESTS_FLUSH_INTERVAL', 60)
+
 # Setup AUTH DB
 if hasattr(settings, 'QGIS_AUTH_DB_DIR_PATH') and settings.QGIS_AUTH_DB_DIR_PATH:
     os.environ['QGIS_AUTH_DB_DIR_PATH'] = settings.QGIS_AUTH_DB_DIR_PATH
@@ -90,31 +127,382 @@ class ProjectCacheInvalidator():
     disk which on Linux misses the INOTIFY signal used by the internal QGIS
     Server logic to invalidate the cache.
 
-    WARNING: this logic may introduce a significant slowdown on each server
-             request due to the time which is necessary to check the project file
+    Project files are checked by a watcher thread every
+    G3WADMIN_PROJECT_WATCHER_INTERVAL seconds: the watcher bumps the generation
+    of the changed projects and the request thread only compares the generation
+    of the cached project with the current one, without any filesystem access.
+    The project cache is therefore invalidated at most
+    G3WADMIN_PROJECT_WATCHER_INTERVAL seconds after the project file has changed.
+
+    WARNING: with G3WADMIN_PROJECT_WATCHER_INTERVAL = 0 the project file timestamp
+             is checked on each server request, this may introduce a significant
+             slowdown due to the time which is necessary to check the project file
              timestamp.
     """
 
-    __CACHED_PROJECTS = {}
+    # path -> last seen project file mtime
+    _mtimes = {}
+    # path -> current project file generation
+    _generations = {}
+    # path -> generation of the project in QgsConfigCache
+    _cached_generations = {}
+
+    _lock = threading.Lock()
+    _watcher = None
+    _watcher_pid = None
 
     @classmethod
-    def check_cache(cls, path):
+    def _stat(cls, path):
+        """Returns the project file mtime or None"""
+
         try:
-            stat_info = os.stat(path)
+            return os.stat(path).st_mtime
         except FileNotFoundError:
+            return None
+
+    @classmethod
+    def poll(cls, paths=None):
+        """Checks the project files mtime and bumps the generation of the changed ones
+
+        :param paths: project paths to check, defaults to all the known paths
+        :type paths: list, None
+        """
+
+        for path in list(cls._mtimes.keys()) if paths is None else paths:
+            mtime = cls._stat(path)
+            if mtime is None:
+                continue
+            with cls._lock:
+                if cls._mtimes.get(path, mtime) < mtime:
+                    cls._generations[path] = cls._generations.get(path, 0) + 1
+                cls._mtimes[path] = mtime
+
+    @classmethod
+    def _watch(cls, interval):
+
+        while True:
+            time.sleep(interval)
+            try:
+                cls.poll()
+            except Exception as ex:
+                logger.error('QGIS Server project watcher error: %s' % ex)
+
+    @classmethod
+    def start_watcher(cls):
+        """Starts the watcher thread of the current process, if not already started"""
+
+        # Threads do not survive a fork (i.e. uWSGI workers)
+        if cls._watcher_pid == os.getpid():
             return
 
-        mtime = stat_info.st_mtime
+        with cls._lock:
+            if cls._watcher_pid != os.getpid():
+                cls._watcher = threading.Thread(target=cls._watch, args=(PROJECT_WATCHER_INTERVAL, ),
+                                                name='qdjango-project-watcher', daemon=True)
+                cls._watcher.start()
+                cls._watcher_pid = os.getpid()
+                logger.info('QGIS Server project watcher started, interval: %ss' % PROJECT_WATCHER_INTERVAL)
+
+    @classmethod
+    def invalidate(cls, path):
+        """Removes a project from the QGIS Server caches"""
+
+        QgsConfigCache.instance().removeEntry(path)
+        QGS_SERVER.serverInterface().capabilitiesCache().removeCapabilitiesDocument(path)
+        ProjectCacheManager.forget(path)
+
+    @classmethod
+    def check_cache(cls, path):
+        """Invalidates the cached project if the project file has changed since it was loaded
+
+        :param path: the filesystem path to the project
+        :type path: str
+        """
+
+        if PROJECT_WATCHER_INTERVAL:
+            cls.start_watcher()
+        else:
+            cls.poll([path])
+
         try:
-            if cls.__CACHED_PROJECTS[path] < mtime:
-                logger.warning(
-                    'QGIS Server cached project mtime has changed, clearing cache: %s' % path)
-                QgsConfigCache.instance().removeEntry(path)
-                QGS_SERVER.serverInterface().capabilitiesCache().removeCapabilitiesDocument(path)
+            generation = cls._generations[path]
         except KeyError:
             logger.warning(
                 'QGIS Server project added to mtime cache: %s' % path)
-            cls.__CACHED_PROJECTS[path] = mtime
+            with cls._lock:
+                cls._mtimes[path] = cls._stat(path) or 0
+                cls._generations.setdefault(path, 0)
+                cls._cached_generations[path] = cls._generations[path]
+            return
+
+        if cls._cached_generations.get(path) != generation:
+            cls.invalidate(path)
+            cls._cached_generations[path] = generation
+            logger.warning(
+                'QGIS Server cached project mtime has changed, cache cleared %.1fs after the change: %s' % (
+                    time.time() - cls._mtimes[path], path))
+
+
+class ProjectCacheManager():
+    """Least recently used policy for the QGIS Server project cache.
+
+    The QGIS Server project cache (QgsConfigCache) has no size limit: the least
+    recently used projects are removed from the cache when there are more than
+    G3WADMIN_MAX_CACHED_PROJECTS projects or when the process RSS is above
+    G3WADMIN_MAX_CACHED_PROJECTS_RSS MB (requires psutil).
+    Projects listed in G3WADMIN_PINNED_PROJECTS are never evicted.
+
+    Load times and hit counts are collected for every project and logged every
+    G3WADMIN_PROJECT_CACHE_STATS_LOG_INTERVAL seconds.
+
+    Requests are counted in memory and the counts are added to the shared
+    counters in the database every G3WADMIN_PROJECT_REQUESTS_FLUSH_INTERVAL
+    seconds, they are used to pick the most requested projects to pre-warm.
+    """
+
+    # path -> None, least recently used first
+    _lru = OrderedDict()
+    # path -> stats dict
+    _stats = {}
+    # time of the last stats log
+    _stats_logged = time.time()
+    # path -> requests not yet written to the database
+    _requests = {}
+    _requests_lock = threading.Lock()
+    # time of the last write of the request counts
+    _requests_flushed = time.time()
+
+    REQUESTS_KEY = 'qdjango_project_requests_{}'
+
+    @classmethod
+    def requests_key(cls, path):
+        """Returns the name of the shared request counter of a project path"""
+
+        return cls.REQUESTS_KEY.format(hashlib.md5(path.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def is_pinned(cls, path):
+        """Returns True if the project must not be evicted"""
+
+        return path in PINNED_PROJECTS or os.path.basename(path) in PINNED_PROJECTS
+
+    @classmethod
+    def is_cached(cls, path):
+        """Returns True if the project is in the QGIS Server project cache"""
+
+        return path in cls._lru
+
+    @classmethod
+    def touch(cls, path, elapsed):
+        """Records a project cache access and applies the eviction policy
+
+        :param path: the filesystem path to the project
+        :type path: str
+        :param elapsed: seconds spent to get the project from the cache
+        :type elapsed: float
+        """
+
+        stats = cls._stats.setdefault(path, {
+            'hits': 0,
+            'loads': 0,
+            'load_time': None,
+            'total_load_time': 0,
+        })
+
+        # Request counter, used to pick the most requested projects to pre-warm
+        with cls._requests_lock:
+            cls._requests[path] = cls._requests.get(path, 0) + 1
+        if time.time() - cls._requests_flushed > PROJECT_REQUESTS_FLUSH_INTERVAL:
+            cls.flush_requests()
+
+        loaded = path not in cls._lru
+        if loaded:
+            stats['loads'] += 1
+            stats['load_time'] = elapsed
+            stats['total_load_time'] += elapsed
+            cls._lru[path] = None
+            logger.info('QGIS Server project loaded in %.2fs: %s' % (elapsed, path))
+        else:
+            stats['hits'] += 1
+            cls._lru.move_to_end(path)
+
+        # The RSS only grows with a project load
+        cls.evict(exclude=path, check_rss=loaded)
+
+        if PROJECT_CACHE_STATS_LOG_INTERVAL and time.time() - cls._stats_logged > PROJECT_CACHE_STATS_LOG_INTERVAL:
+            cls.log_stats()
+
+    @classmethod
+    def flush_requests(cls):
+        """Adds the request counts of the process to the shared counters in the database"""
+
+        from core.models import CacheGeneration
+
+        with cls._requests_lock:
+            requests, cls._requests = cls._requests, {}
+            cls._requests_flushed = time.time()
+
+        for path, count in requests.items():
+            CacheGeneration.bump(cls.requests_key(path), count)
+
+    @classmethod
+    def requests(cls, paths):
+        """Returns the shared request counts of project paths, including the
+        counts of the process not yet written to the database
+
+        :param paths: the filesystem paths to the projects
+        :type paths: list
+        :return: the request counts in the same order of paths
+        :rtype: list
+        """
+
+        from core.models import CacheGeneration
+
+        cls.flush_requests()
+        return CacheGeneration.get_values([cls.requests_key(path) for path in paths])
+
+    @classmethod
+    def forget(cls, path):
+        """Marks a project as no longer in the QGIS Server project cache"""
+
+        cls._lru.pop(path, None)
+
+    @classmethod
+    def _rss(cls):
+        """Returns the RSS of the process in MB or None if psutil is not available"""
+
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process(os.getpid()).memory_info().rss / 1024 ** 2
+
+    @classmethod
+    def evict(cls, exclude=None, check_rss=True):
+        """Removes the least recently used projects from the QGIS Server caches
+        until the cache is within the limits.
+
+        Freed memory is not always returned to the OS immediately, so the RSS
+        does not drop after an eviction: when the RSS is above the limit only
+        one project is evicted per call, and the RSS is checked only after a
+        project load (check_rss) so that cache hits never drain the cache.
+
+        :param exclude: the path of a project which must not be evicted (i.e. the current one)
+        :type exclude: str
+        :param check_rss: check the process RSS limit too, defaults to True
+        :type check_rss: bool
+        """
+
+        if not MAX_CACHED_PROJECTS and not MAX_CACHED_PROJECTS_RSS:
+            return
+
+        rss_over_budget = False
+        if MAX_CACHED_PROJECTS_RSS and check_rss:
+            rss = cls._rss()
+            rss_over_budget = rss is not None and rss > MAX_CACHED_PROJECTS_RSS
+
+        evicted = 0
+        for path in list(cls._lru.keys()):
+            count_over_budget = MAX_CACHED_PROJECTS and len(cls._lru) > MAX_CACHED_PROJECTS
+            if not count_over_budget and not (rss_over_budget and evicted == 0):
+                break
+            if path == exclude or cls.is_pinned(path):
+                continue
+            ProjectCacheInvalidator.invalidate(path)
+            evicted += 1
+            logger.info('QGIS Server project evicted from cache: %s' % path)
+
+    @classmethod
+    def stats(cls):
+        """Returns the project cache stats
+
+        :return: a list of dicts with path, cached, pinned, hits, loads, load_time
+                 (last load time in seconds) and total_load_time
+        :rtype: list
+        """
+
+        return [dict(path=path, cached=path in cls._lru, pinned=cls.is_pinned(path), **stats)
+                for path, stats in cls._stats.items()]
+
+    @classmethod
+    def log_stats(cls):
+        """Logs the project cache stats of the process, most requested projects first"""
+
+        cls._stats_logged = time.time()
+        for stats in sorted(cls.stats(), key=lambda s: s['hits'] + s['loads'], reverse=True):
+            logger.info(
+                'QGIS Server project cache stats (pid %s): %s cached: %s, pinned: %s, hits: %s, loads: %s, '
+                'last load time: %.2fs, total load time: %.2fs' % (
+                    os.getpid(), stats['path'], stats['cached'], stats['pinned'], stats['hits'], stats['loads'],
+                    stats['load_time'] or 0, stats['total_load_time']))
+
+
+class ProjectInvalidationBus():
+    """Cluster wide invalidation of the cached projects.
+
+    When a project is saved a generation counter for the project file is bumped
+    in the database, so it is seen by all the nodes and never evicted. Every
+    process compares, at most once every G3WADMIN_PROJECT_INVALIDATION_BUS_INTERVAL
+    seconds, the shared generation with the generation of its cached project and
+    removes the project from the QGIS Server caches when they differ.
+    """
+
+    KEY = 'qdjango_project_file_gen_{}'
+
+    # path -> generation of the project in QgsConfigCache
+    _cached_generations = {}
+    # path -> last check time
+    _checked = {}
+
+    @classmethod
+    def key(cls, path):
+        """Returns the name of the shared generation counter of a project path"""
+
+        return cls.KEY.format(hashlib.md5(path.encode('utf-8')).hexdigest())
+
+    @classmethod
+    def publish(cls, path):
+        """Notifies all the processes that a project file has changed
+
+        :param path: the filesystem path to the project
+        :type path: str
+        """
+
+        from core.models import CacheGeneration
+
+        CacheGeneration.bump(cls.key(path))
+
+        # Check again on the next local request
+        cls._checked.pop(path, None)
+        logger.info('QGIS Server project invalidation published: %s' % path)
+
+    @classmethod
+    def check_cache(cls, path):
+        """Invalidates the cached project if its shared generation has changed
+
+        :param path: the filesystem path to the project
+        :type path: str
+        """
+
+        now = time.time()
+        if now - cls._checked.get(path, 0) < PROJECT_INVALIDATION_BUS_INTERVAL:
+            return
+        cls._checked[path] = now
+
+        from core.models import CacheGeneration
+
+        generation = CacheGeneration.get_value(cls.key(path))
+        cached_generation = cls._cached_generations.get(path)
+        cls._cached_generations[path] = generation
+
+        if cached_generation is not None and cached_generation != generation:
+            ProjectCacheInvalidator.invalidate(path)
+            logger.warning(
+                'QGIS Server cached project invalidated by the invalidation bus: %s' % path)
+
+
+# Last call of QgsApplication.processEvents() when the custom cache invalidator is active
+_LAST_PROCESS_EVENTS = 0
 
 
 def get_qgs_project(path):
@@ -129,6 +517,8 @@ def get_qgs_project(path):
     :rtype: QgsProject or None
     """
 
+    global _LAST_PROCESS_EVENTS
+
     try:
         # Call process events in case the project has been updated and the cache
         # needs rebuilt. This triggers the QGIS server internal cache manager that
@@ -136,12 +526,22 @@ def get_qgs_project(path):
         # does not work reliably with project that are stored on network mounted
         # volumes, in that case we need to use our own cache manager, enable it with
         # G3WADMIN_USE_CUSTOM_CACHE_INVALIDATOR=True
-        
-        QgsApplication.instance().processEvents()
 
         if USE_CUSTOM_CACHE_INVALIDATOR:
+            # Project changes are detected by our own cache manager, events
+            # only need to be processed once in a while
+            now = time.time()
+            if now - _LAST_PROCESS_EVENTS >= PROJECT_WATCHER_INTERVAL:
+                _LAST_PROCESS_EVENTS = now
+                QgsApplication.instance().processEvents()
             ProjectCacheInvalidator.check_cache(path)
+        else:
+            QgsApplication.instance().processEvents()
 
+        if USE_PROJECT_INVALIDATION_BUS:
+            ProjectInvalidationBus.check_cache(path)
+
+        start = time.time()
         project = QgsConfigCache.instance().project(path, QGS_SERVER_SETTINGS)
 
         # This is required after QGIS 3.10.11, see https://github.com/qgis/QGIS/pull/38488#issuecomment-692190106
@@ -166,6 +566,10 @@ def get_qgs_project(path):
                 logger.warning(
                     'Project reloaded because QgsProject.setInstance() is not available in this QGIS version: %s' % path)
                 QgsProject.instance().read(path)
+
+        if project is not None:
+            ProjectCacheManager.touch(path, time.time() - start)
+
         return QgsProject.instance()
     except Exception as ex:
         logger.warning('There was an error loading the project from path: %s, this is normally due to unavailable layers. If this is unexpected, please turn on and check server debug logs for further details.\n%s.' % (path, ex))
@@ -1,7 +1,11 @@
+import ast
+from io import BytesIO
 from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
 from django.http.request import QueryDict
 from django.urls import reverse
-from .models import Layer
+from qgis.core import QgsCoordinateReferenceSystem
+from .models import Layer, Project
 from caching.utils import projections
 
 
@@ -16,14 +20,97 @@ def get_layer_to_erase_for_project(layer_id):
     return Layer.objects.filter(datasource=layer.datasource)
 
 
+def get_project_extent(project):
+    """
+    Get the extent of a project, in the project CRS (the caching grid CRS)
+    :param project: qdjango project
+    :return: (xmin, ymin, xmax, ymax)
+    """
+
+    extent = ast.literal_eval(project.max_extent or project.initial_extent)
+    return float(extent['xmin']), float(extent['ymin']), float(extent['xmax']), float(extent['ymax'])
+
+
+def get_layer_extent(layer_id):
+    """
+    Get the extent of the project of a layer, in the project CRS (the caching grid CRS)
+    :param layer_id:
+    :return: (xmin, ymin, xmax, ymax)
+    """
+
+    return get_project_extent(Layer.objects.select_related('project').get(pk=layer_id).project)
+
+
 if 'caching' in settings.G3WADMIN_LOCAL_MORE_APPS:
 
     from caching.utils.layer import TilestacheLayerBase
 
+    class QgisServerProvider(object):
+        """TileStache provider that renders the tiles with the QGIS Server of the
+        current process (or of the QGIS Server pool), without the HTTP round trip
+        of the 'url template' provider.
+
+        As with the caching token of the 'url template' provider, tiles are
+        rendered without project permission checks and without user constraints.
+
+        :param layer: TileStache layer
+        :param project_id: qdjango project pk
+        :type project_id: int
+        :param query: WMS GetMap parameters, without BBOX, SRS, WIDTH and HEIGHT
+        :type query: dict
+        """
+
+        def __init__(self, layer, project_id, query):
+
+            self.layer = layer
+            self.project_id = project_id
+            self.query = query
+            self._project = None
+
+        @property
+        def project(self):
+
+            if self._project is None:
+                self._project = Project.objects.select_related('group').get(pk=self.project_id)
+            return self._project
+
+        def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom):
+            """Renders the area with a WMS GetMap request and returns a PIL image"""
+
+            from PIL import Image
+            from qdjango.server_context import ServerRequestContext
+            from qdjango.server_pool import get_server_pool, process_server_request
+
+            q = QueryDict('', mutable=True)
+            q.update(self.query)
+            q['BBOX'] = '{},{},{},{}'.format(xmin, ymin, xmax, ymax)
+            q['SRS'] = srs
+            q['WIDTH'] = str(width)
+            q['HEIGHT'] = str(height)
+
+            project = self.project
+            ows_url = reverse('OWS:ows', kwargs={'group_slug': project.group.slug, 'project_type': 'qdjango',
+                                                 'project_id': project.pk})
+            uri = '{}{}?{}'.format(settings.QDJANGO_SERVER_URL, ows_url, q.urlencode())
+            context = ServerRequestContext(AnonymousUser(), project, q)
+
+            server_pool = get_server_pool()
+            if server_pool is not None:
+                body, status_code, headers = server_pool.handle_request(context, uri, 'GET', {}, None)
+            else:
+                body, status_code, headers = process_server_request(context, uri, 'GET', {}, None)
+
+            content_type = {k.lower(): v for k, v in headers.items()}.get('content-type', '')
+            if status_code != 200 or not content_type.startswith('image/'):
+                raise Exception('QGIS Server error rendering tile for project {}: {}'.format(
+                    project.pk, body[:1024]))
+
+            return Image.open(BytesIO(body))
+
     class TilestacheLayer(TilestacheLayerBase):
 
         def build_layer_dict(self):
-            layer = Layer.objects.get(pk=self.caching_layer.layer_id)
+            layer = Layer.objects.select_related('project__group__srid').get(pk=self.caching_layer.layer_id)
 
             # update self.q
             if layer.project.wms_use_layer_ids:
@@ -32,18 +119,41 @@ if 'caching' in settings.G3WADMIN_LOCAL_MORE_APPS:
             else:
                 self.q['LAYERS'] = layer.name
 
-            # add TILESTACHE_CACHE_TOKEN
-            self.q['g3wsuite_caching_token'] = settings.TILESTACHE_CACHE_TOKEN
-
-            # build dict
-            # FIXME: QDJANGO_SERVER_URL now points to the base URL
             qdjango_project = layer.project
-            ows_url = reverse('OWS:ows', kwargs={'group_slug': qdjango_project.group.slug, 'project_type': 'qdjango', 'project_id': qdjango_project.id})
-            self.layer_dict = {
-                'provider': {
+
+            if getattr(settings, 'TILESTACHE_CACHE_PROVIDER', 'qgis') == 'qgis':
+
+                # render in-process, BBOX, SRS, WIDTH and HEIGHT are set by the provider
+                query = {k: v for k, v in self.q.items() if k not in ('BBOX', 'SRS', 'WIDTH', 'HEIGHT')}
+                provider = {
+                    'class': 'qdjango.cache:QgisServerProvider',
+                    'kwargs': {
+                        'project_id': qdjango_project.pk,
+                        'query': query
+                    }
+                }
+            else:
+
+                # add TILESTACHE_CACHE_TOKEN
+                self.q['g3wsuite_caching_token'] = settings.TILESTACHE_CACHE_TOKEN
+
+                # build dict
+                # FIXME: QDJANGO_SERVER_URL now points to the base URL
+                ows_url = reverse('OWS:ows', kwargs={'group_slug': qdjango_project.group.slug, 'project_type': 'qdjango', 'project_id': qdjango_project.id})
+                provider = {
                     'name': 'url template',
                     'template': '{}{}?{}'.format(settings.QDJANGO_SERVER_URL, ows_url, self.q.urlencode(safe='$'))
-                },
-                'projection': 'caching.utils.projections:CustomXYZGridProjection(\'EPSG:{}\')'.
-                    format(layer.project.group.srid.auth_srid)
+                }
+
+            # Tile grid fitted to the project CRS units and extent, see CustomGridProjection
+            srid = layer.project.group.srid.auth_srid
+            tile_size = getattr(settings, 'TILESTACHE_CACHE_TILE_SIZE', 256)
+            self.layer_dict = {
+                'provider': provider,
+                'projection': 'caching.utils.projections:CustomXYZGridProjection(\'EPSG:{}\', {}, {}, {})'.format(
+                    srid,
+                    get_project_extent(layer.project),
+                    QgsCoordinateReferenceSystem('EPSG:{}'.format(srid)).isGeographic(),
+                    tile_size),
+                'tile height': tile_size
             }
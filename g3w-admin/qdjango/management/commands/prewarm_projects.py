@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from qdjango.utils.prewarm import prewarm_projects
+
+
+class Command(BaseCommand):
+    """
+    This command loads QGIS projects into the QGIS Server project cache and checks their layers.
+    """
+
+    help = 'Load QGIS projects into the QGIS Server project cache and report load times and invalid layers'
+
+    def add_arguments(self, parser):
+
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument('--all', dest='all', action='store_true', help='All active projects')
+        group.add_argument('--top', dest='top', type=int, help='The N most requested active projects')
+        group.add_argument('--projects', dest='projects', nargs='+', type=int, help='Project ids')
+
+    def handle(self, *args, **options):
+
+        if options['all']:
+            selection = 'all'
+        elif options['top']:
+            selection = options['top']
+        elif options['projects']:
+            selection = options['projects']
+        else:
+            selection = getattr(settings, 'G3WADMIN_PREWARM_PROJECTS', None) or 'all'
+
+        try:
+            results = prewarm_projects(selection)
+        except (TypeError, ValueError) as ex:
+            raise CommandError('Invalid project selection %s: %s' % (selection, ex))
+
+        for project, elapsed, invalid_layers in results:
+            if invalid_layers is None:
+                self.stdout.write(self.style.ERROR('Project {} could not be loaded: {}'.format(
+                    project.pk, project.qgis_file.path)))
+            elif invalid_layers:
+                self.stdout.write(self.style.WARNING('Project {} loaded in {:.2f}s, invalid layers: {}'.format(
+                    project.pk, elapsed, ', '.join(invalid_layers))))
+            else:
+                self.stdout.write(self.style.SUCCESS('Project {} loaded in {:.2f}s'.format(
+                    project.pk, elapsed)))
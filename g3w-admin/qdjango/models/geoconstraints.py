@@ -11,6 +11,10 @@ __copyright__ = 'Copyright 2019, Gis3w'
 
 
 import logging
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.auth.models import Group as AuthGroup, User
@@ -28,15 +32,155 @@ from qgis.core import (
     QgsCoordinateTransformContext,
     QgsGeometry,
     QgsExpression,
+    QgsRectangle,
+    qgsfunction,
 )
 
-from core.utils.qgisapi import get_qgis_features, get_qgis_layer
+from core.models import CacheGeneration
+from core.utils.qgisapi import iter_qgis_features, get_qgis_layer
 from qdjango.models import Layer
 
 
 logger = logging.getLogger(__name__)
 
 
+# Name of the layer data generation counter, used to invalidate the cached
+# constraint geometries when the constraint layer (or the constrained layer) changes
+# and the cached unique values of the layer fields
+LAYER_GENERATION_KEY = 'qdjango_geoconstraint_layer_gen_{}'
+
+
+def get_layer_data_generation(layer_id):
+    """Returns the data generation of a layer, changed when its data or its datasource change
+
+    :param layer_id: qdjango layer pk
+    :type layer_id: int
+    :rtype: int
+    """
+
+    return CacheGeneration.get_value(LAYER_GENERATION_KEY.format(layer_id))
+
+
+def invalidate_constraint_geometries(layer_id):
+    """Invalidate the cached constraint geometries (and unique values) which depend on a layer,
+    in every process
+
+    :param layer_id: qdjango layer pk
+    :type layer_id: int
+    """
+
+    CacheGeneration.bump(LAYER_GENERATION_KEY.format(layer_id))
+
+
+# Compiled constraint geometries referenced by the g3w_geoconstraint expressions, by token
+_CONSTRAINT_GEOMETRY_TOKENS = weakref.WeakValueDictionary()
+
+
+class ConstraintGeometry(object):
+    """A compiled constraint geometry: the GEOS geometry, its prepared version,
+    its extent and the QGIS expression of the spatial predicate.
+
+    The expression of a saved rule does not embed the geometry WKT: the exact
+    predicate is evaluated by the ``g3w_geoconstraint`` expression function
+    against this compiled geometry, found by its token. The token is valid while
+    the compiled geometry is referenced: the code which builds a filter with the
+    expression (i.e. the access control filter, the API filter backend) keeps a
+    reference until the features are fetched.
+
+    :param geometry: the constraint geometry in the constrained layer CRS, or '' if no features matched
+    :type geometry: MultiPolygon, str
+    :param count: the number of constraint geometries
+    :type count: int
+    :param rule_pk: the pk of the rule, None for unsaved rules
+    :type rule_pk: int, None
+    """
+
+    def __init__(self, geometry, count, rule_pk=None):
+
+        self.geometry = geometry
+        self.count = count
+        self.prepared = None
+        self.extent = None
+        self.expression = ''
+        self.token = None
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
+        if not geometry:
+            return
+
+        self.prepared = geometry.prepared
+        self.extent = QgsRectangle(*geometry.extent)
+        self.spatial_predicate = getattr(
+            settings, 'EDITING_CONSTRAINT_SPATIAL_PREDICATE', 'contains')
+
+        if rule_pk is not None:
+            self.token = uuid.uuid4().hex
+            _CONSTRAINT_GEOMETRY_TOKENS[self.token] = self
+            expression = "g3w_geoconstraint('{token}', {rule_pk}, $geometry)".format(
+                token=self.token, rule_pk=int(rule_pk))
+        elif self.spatial_predicate == 'contains':
+            # The constraint geometry contains feature geometry
+            expression = "contains(geom_from_wkt( '{wkt}' ), $geometry )".format(wkt=geometry.wkt)
+        else:
+            # The constraint geometry is within the feature geometry
+            expression = "within(geom_from_wkt( '{wkt}' ), $geometry)".format(wkt=geometry.wkt)
+
+        # Both predicates imply that the bounding boxes intersect: the cheap bbox
+        # test short-circuits the exact predicate for most of the features and
+        # it is compiled by the providers which support it
+        self.expression = "bbox($geometry, geom_from_wkt( '{bbox}' )) AND {expression}".format(
+            bbox=self.extent.asWktPolygon(), expression=expression)
+
+    def evaluate(self, qgis_geometry):
+        """Evaluate the spatial predicate of the constraint on a feature geometry
+
+        :param qgis_geometry: the feature geometry, in the constrained layer CRS
+        :type qgis_geometry: QgsGeometry
+        :return: True if the feature geometry satisfies the constraint
+        :rtype: bool
+        """
+
+        if not self.geometry or qgis_geometry is None or qgis_geometry.isNull():
+            return False
+
+        # Prepared GEOS geometries are not safe for concurrent use
+        with self._engine_lock:
+            if self._engine is None:
+                constraint_geometry = QgsGeometry()
+                constraint_geometry.fromWkb(bytes(self.geometry.wkb))
+                self._engine = QgsGeometry.createGeometryEngine(constraint_geometry.constGet())
+                self._engine.prepareGeometry()
+
+            if self.spatial_predicate == 'contains':
+                return self._engine.contains(qgis_geometry.constGet())
+            return self._engine.within(qgis_geometry.constGet())
+
+
+@qgsfunction(args='auto', group='G3W-SUITE', usesgeometry=True)
+def g3w_geoconstraint(token, rule_pk, geometry, feature, parent):
+    """
+    Evaluates a G3W-SUITE geoconstraint rule on a geometry.
+    <h4>Syntax</h4>
+    <p>g3w_geoconstraint(token, rule_pk, geometry)</p>
+    """
+
+    compiled = _CONSTRAINT_GEOMETRY_TOKENS.get(token)
+
+    # The expression is evaluated in the feature iteration and render threads: the
+    # geometry is never compiled here, the features of an unknown token are hidden
+    if compiled is None:
+        logger.warning('Unknown geoconstraint token {} for rule {}: features are filtered out'.format(
+            token, rule_pk))
+        return False
+
+    return compiled.evaluate(geometry)
+
+
+_CONSTRAINT_GEOMETRIES = OrderedDict()
+_CONSTRAINT_GEOMETRIES_LOCK = threading.Lock()
+
+
 CONSTRAINT_LAYER_TYPE_GRANTED = (
     'spatialite',
     'postgres',
@@ -168,8 +312,8 @@ class GeoConstraintRule(models.Model):
             raise ValidationError(
                 _('There is an error in the SQL rule where condition: %s' % ex))
 
-    def get_constraint_geometry(self):
-        """Returns the geometry from the constraint layer and rule
+    def _build_constraint_geometry(self):
+        """Builds the geometry from the constraint layer and rule
 
         :return: the constraint geometry and the number of matched records
         :rtype: tuple( MultiPolygon, integer)
@@ -182,24 +326,26 @@ class GeoConstraintRule(models.Model):
         qgis_feature_request = QgsFeatureRequest()
         qgis_feature_request.setFilterExpression(self.rule)
 
-        features = get_qgis_features(constraint_layer, qgis_feature_request, exclude_fields='__all__')
-
-        if not features:
-            return '', 0
-
         geometry = QgsMultiPolygon()
-
-        for feature in features:
-            geom = feature.geometry()
-            if geom.isMultipart():
-                geom = [g for g in geom.constGet()]
-            else:
-                geom = [geom.constGet()]
-
-            i = 0
-            for g in geom:
-                geometry.insertGeometry(g.clone(), 0)
-                i += 1
+        features_count = 0
+
+        # Features are fetched in batches, only the geometries are kept
+        for features in iter_qgis_features(constraint_layer, qgis_feature_request, exclude_fields='__all__'):
+            for feature in features:
+                features_count += 1
+                geom = feature.geometry()
+                if geom.isMultipart():
+                    geom = [g for g in geom.constGet()]
+                else:
+                    geom = [geom.constGet()]
+
+                i = 0
+                for g in geom:
+                    geometry.insertGeometry(g.clone(), 0)
+                    i += 1
+
+        if not features_count:
+            return '', 0
 
         # Now, transform into a GEOS geometry
         if constraint_layer.crs() != layer.crs():
@@ -210,25 +356,62 @@ class GeoConstraintRule(models.Model):
 
         return constraint_geometry, constraint_geometry.num_geom
 
-    def get_qgis_expression(self):
-        """Returns the QGIS expression text for this rule
+    def get_compiled_constraint_geometry(self):
+        """Returns the compiled constraint geometry, from a process cache keyed by
+        rule and by the data generation of the constraint and constrained layers
+
+        :rtype: ConstraintGeometry
         """
 
-        constraint_geometry, __ = self.get_constraint_geometry()
+        constraint = self.constraint
+        generations = CacheGeneration.get_values([LAYER_GENERATION_KEY.format(constraint.constraint_layer_id),
+                                                  LAYER_GENERATION_KEY.format(constraint.layer_id)])
+        key = (self.pk, self.rule, constraint.constraint_layer_id, constraint.layer_id) + tuple(generations)
 
-        expression = ''
+        with _CONSTRAINT_GEOMETRIES_LOCK:
+            try:
+                _CONSTRAINT_GEOMETRIES.move_to_end(key)
+                return _CONSTRAINT_GEOMETRIES[key]
+            except KeyError:
+                pass
 
-        if constraint_geometry:
-            spatial_predicate = getattr(
-            settings, 'EDITING_CONSTRAINT_SPATIAL_PREDICATE', 'contains')
-            if spatial_predicate == 'contains':
-                # The constraint geometry contains feature geometry
-                expression = "contains(geom_from_wkt( '{wkt}' ), $geometry )".format(wkt=constraint_geometry.wkt)
-            else:
-                # The constraint geometry is within the feature geometry
-                expression = "within(geom_from_wkt( '{wkt}' ), $geometry)".format(wkt=constraint_geometry.wkt)
-
-        return expression
+        compiled = ConstraintGeometry(*self._build_constraint_geometry(), rule_pk=self.pk)
+
+        # Unsaved rules (i.e. validation) are not cached
+        if self.pk is None:
+            return compiled
+
+        with _CONSTRAINT_GEOMETRIES_LOCK:
+            _CONSTRAINT_GEOMETRIES[key] = compiled
+            while len(_CONSTRAINT_GEOMETRIES) > getattr(settings, 'QDJANGO_GEOCONSTRAINT_CACHE_SIZE', 100):
+                _CONSTRAINT_GEOMETRIES.popitem(last=False)
+
+        return compiled
+
+    def get_constraint_geometry(self):
+        """Returns the geometry from the constraint layer and rule
+
+        :return: the constraint geometry and the number of matched records
+        :rtype: tuple( MultiPolygon, integer)
+        """
+
+        compiled = self.get_compiled_constraint_geometry()
+        return compiled.geometry, compiled.count
+
+    def get_constraint_extent(self):
+        """Returns the extent of the constraint geometry in the constrained layer CRS
+
+        :return: the extent or None if no features matched the rule
+        :rtype: QgsRectangle, None
+        """
+
+        return self.get_compiled_constraint_geometry().extent
+
+    def get_qgis_expression(self):
+        """Returns the QGIS expression text for this rule
+        """
+
+        return self.get_compiled_constraint_geometry().expression
 
     def validate_sql(self):
         """Checks if the rule can be executed without errors
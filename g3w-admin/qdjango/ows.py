@@ -16,9 +16,9 @@ from django.http.request import QueryDict
 from django.db.models import Q
 from django.core.cache import cache
 
-from qgis.server import QgsBufferServerRequest, QgsBufferServerResponse
-
-from qdjango.apps import QGS_SERVER, get_qgs_project
+from qdjango.ows_cache import get_ows_response_cache
+from qdjango.server_context import ServerRequestContext
+from qdjango.server_pool import get_server_pool, process_server_request
 
 from OWS.ows import OWSRequestHandlerBase
 from .models import Project, Layer
@@ -77,55 +77,52 @@ class OWSRequestHandler(OWSRequestHandlerBase):
             q['REQUEST'] = ows_request
 
         # FIXME: proxy or redirect in case of WMS/WFS/XYZ cascading?
-        qgs_project = get_qgs_project(self.project.qgis_file.path)
-
-        if qgs_project is None:
-            raise Http404('The requested QGIS project could not be loaded!')
-
-        data = None
-        if request.method == 'GET':
-            method = QgsBufferServerRequest.GetMethod
-        elif request.method == 'POST':
-            method = QgsBufferServerRequest.PostMethod
-            data = request.body
-        elif request.method == 'PUT':
-            method = QgsBufferServerRequest.PutMethod
-            data = request.body
-        elif request.method == 'PATCH':
-            method = QgsBufferServerRequest.PatchMethod
-            data = request.body
-        elif request.method == 'HEAD':
-            method = QgsBufferServerRequest.HeadMethod
-        elif request.method == 'DELETE':
-            method = QgsBufferServerRequest.DeleteMethod
-        else:
-            logger.warning(
-                "Request method not supported: %s, assuming GET" % request.method)
-            method = QgsBufferServerRequest.GetMethod
+        data = request.body if request.method in ('POST', 'PUT', 'PATCH') else None
 
         headers = {}
         for header_key in request.headers.keys():
             headers[header_key] = request.headers.get(header_key)
         uri = request.build_absolute_uri(request.path) + '?' + q.urlencode()
-        logger.debug('Calling QGIS Server: %s' % uri)
-        qgs_request = QgsBufferServerRequest(uri, method, headers, data)
-
-        # Attach user and project to the server object to make them accessible by the
-        # server access control plugins (constraints etc.)
-        QGS_SERVER.djrequest = request
-        QGS_SERVER.user = request.user
-        QGS_SERVER.project = self.project
 
-        qgs_response = QgsBufferServerResponse()
+        # Request context used by the server access control plugins: user,
+        # project and request data (filter token etc.)
+        context = ServerRequestContext(request.user, self.project,
+                                       request.POST if request.method == 'POST' else request.GET)
+
+        # Try the rendered response cache
+        ows_cache = get_ows_response_cache()
+        cache_key = None
+        if ows_cache is not None and ows_cache.is_cacheable(request, q):
+            cache_key = ows_cache.get_key(self.project.pk, context.fingerprint, q)
+            cached = ows_cache.get(cache_key)
+            if cached is not None:
+                return self._build_response(*cached)
+
+        server_pool = get_server_pool()
         try:
-            QGS_SERVER.handleRequest(qgs_request, qgs_response, qgs_project)
+            if server_pool is not None:
+                body, status_code, response_headers = server_pool.handle_request(
+                    context, uri, request.method, headers, data)
+            else:
+                body, status_code, response_headers = process_server_request(
+                    context, uri, request.method, headers, data)
+        except Http404:
+            raise
         except Exception as ex:
             return HttpResponseServerError(reason="Error handling server request: %s" % ex)
 
-        response = HttpResponse(bytes(qgs_response.body()))
-        response.status_code = qgs_response.statusCode()
+        if cache_key is not None:
+            ows_cache.set(cache_key, body, status_code, response_headers)
+
+        return self._build_response(body, status_code, response_headers)
+
+    def _build_response(self, body, status_code, headers):
+        """Build the Django response from the QGIS Server response data"""
+
+        response = HttpResponse(body)
+        response.status_code = status_code
 
-        for key, value in qgs_response.headers().items():
+        for key, value in headers.items():
             response[key] = value
 
         return response
@@ -0,0 +1,396 @@
+# coding=utf-8
+""""Rendered OWS response cache
+
+Caches the QGIS Server responses for GetMap, GetLegendGraphic and
+GetFeatureInfo requests. The cache key is built from the normalized OWS
+parameters and from the fingerprint of the constraints which apply to the
+caller, so that users with different constraints never share a response.
+
+Entries are invalidated by bumping a per-project generation (which is part of
+the key) when the project file is saved or when an editing commit touches one
+of the project layers. The generation is stored in the database, so that it is
+shared by all the processes whatever the cache backend.
+
+Example configuration (local_settings.py)::
+
+    QDJANGO_OWS_CACHE = {
+        'BACKEND': 'locmem',  # or 'filesystem' or 'django'
+        'LOCATION': None,  # directory for 'filesystem', cache alias for 'django'
+        'MAX_SIZE': 256 * 1024 ** 2,  # bytes
+        'MAX_ENTRY_SIZE': 4 * 1024 ** 2,  # bytes
+        'TIMEOUT': 3600,  # seconds, only for 'django' backend
+        'BBOX_SNAP': 0.01,  # fraction of a pixel
+    }
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-13'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import hashlib
+import logging
+import math
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# OWS requests whose response can be cached
+CACHEABLE_REQUESTS = (
+    'GETMAP',
+    'GETLEGENDGRAPHIC',
+    'GETLEGENDGRAPHICS',
+    'GETFEATUREINFO',
+)
+
+# Parameters which do not change the response
+IGNORED_PARAMETERS = (
+    'G3WSUITE_CACHING_TOKEN',
+    '_',
+)
+
+PROJECT_GENERATION_KEY = 'qdjango_ows_cache_gen_{}'
+
+
+class LocMemLRUStorage(object):
+    """Process local LRU storage with size based eviction
+
+    :param max_size: max size in bytes of the stored values
+    :type max_size: int
+    """
+
+    def __init__(self, max_size, **kwargs):
+
+        self.max_size = max_size
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value):
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_size and self._entries:
+                __, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class FileSystemStorage(object):
+    """File system storage with size based eviction of the least recently
+    used files (by access time).
+
+    :param location: the cache directory
+    :type location: str
+    :param max_size: max size in bytes of the stored files
+    :type max_size: int
+    """
+
+    def __init__(self, max_size, location=None, **kwargs):
+
+        self.max_size = max_size
+        self.location = location or os.path.join(
+            getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or '/tmp', 'qdjango_ows_cache')
+        os.makedirs(self.location, exist_ok=True)
+        self._lock = threading.Lock()
+        self.size = sum(os.path.getsize(path) for path in self._files())
+
+    def _files(self):
+
+        for root, __, files in os.walk(self.location):
+            for name in files:
+                yield os.path.join(root, name)
+
+    def _path(self, key):
+
+        return os.path.join(self.location, key[:2], key)
+
+    def get(self, key):
+
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write and rename: readers never see a partial file
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size += len(value)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently accessed files until the size is
+        below 90% of the max size"""
+
+        files = []
+        for path in self._files():
+            try:
+                stat_info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat_info.st_atime, stat_info.st_size, path))
+
+        self.size = sum(f[1] for f in files)
+        for __, file_size, path in sorted(files):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= file_size
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+
+        with self._lock:
+            for path in list(self._files()):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.size = 0
+
+
+class DjangoCacheStorage(object):
+    """Storage on a Django cache, size based eviction is delegated to the
+    cache backend (i.e. memcached)
+
+    :param location: the Django cache alias, defaults to 'default'
+    :type location: str
+    :param timeout: cache timeout in seconds
+    :type timeout: int
+    """
+
+    def __init__(self, max_size=None, location=None, timeout=None, **kwargs):
+
+        self.cache = caches[location or 'default']
+        self.timeout = timeout
+
+    def get(self, key):
+
+        return self.cache.get(key)
+
+    def set(self, key, value):
+
+        self.cache.set(key, value, self.timeout)
+
+    def clear(self):
+
+        # Generations make old entries unreachable, the backend will evict them
+        pass
+
+
+STORAGE_CLASSES = {
+    'locmem': LocMemLRUStorage,
+    'filesystem': FileSystemStorage,
+    'django': DjangoCacheStorage,
+}
+
+
+def normalize_bbox(bbox, width, height, snap):
+    """Snap the BBOX coordinates to a fraction of the pixel size, so that
+    requests for the same image differing only by floating point noise
+    share the same key.
+
+    :param bbox: the BBOX parameter value
+    :type bbox: str
+    :param width: the image width in pixels
+    :type width: str
+    :param height: the image height in pixels
+    :type height: str
+    :param snap: the fraction of pixel size to snap to
+    :type snap: float
+    :return: the normalized BBOX
+    :rtype: str
+    """
+
+    try:
+        xmin, ymin, xmax, ymax = [float(c) for c in bbox.split(',')]
+        pixel_size = min(abs(xmax - xmin) / float(width), abs(ymax - ymin) / float(height))
+        # Snap to a power of ten grid, so that the grid does not depend
+        # on the noise we want to absorb
+        res = 10 ** math.floor(math.log10(pixel_size * snap))
+        digits = max(0, -int(math.log10(res)))
+    except (ValueError, TypeError, ZeroDivisionError):
+        return bbox
+
+    return ','.join('{:.{}f}'.format(round(c / res) * res, digits) for c in (xmin, ymin, xmax, ymax))
+
+
+def normalize_ows_parameters(q, bbox_snap=0.01):
+    """Return a normalized (sorted, upper-cased keys) list of OWS parameters
+
+    Layer lists are stripped but not sorted because the order of the layers
+    changes the rendered image and the order of the returned features.
+
+    :param q: OWS request parameters
+    :type q: QueryDict, dict
+    :param bbox_snap: fraction of pixel size used to snap the BBOX
+    :type bbox_snap: float
+    :rtype: list
+    """
+
+    params = {}
+    for key, value in q.items():
+        key = key.upper()
+        if key in IGNORED_PARAMETERS:
+            continue
+        if key in ('LAYERS', 'QUERY_LAYERS', 'LAYER', 'STYLES'):
+            value = ','.join(v.strip() for v in value.split(','))
+        elif key in ('SERVICE', 'REQUEST', 'FORMAT', 'INFO_FORMAT', 'CRS', 'SRS'):
+            value = value.upper()
+        params[key] = value
+
+    if 'BBOX' in params and 'WIDTH' in params and 'HEIGHT' in params:
+        params['BBOX'] = normalize_bbox(params['BBOX'], params['WIDTH'], params['HEIGHT'], bbox_snap)
+
+    return sorted(params.items())
+
+
+class OWSResponseCache(object):
+    """Rendered OWS response cache
+
+    :param backend: storage backend name, one of STORAGE_CLASSES keys
+    :type backend: str
+    :param max_entry_size: max size of a single cached response
+    :type max_entry_size: int
+    :param bbox_snap: fraction of pixel size used to snap the BBOX
+    :type bbox_snap: float
+    """
+
+    def __init__(self, backend='locmem', max_size=256 * 1024 ** 2, max_entry_size=4 * 1024 ** 2, bbox_snap=0.01,
+                 location=None, timeout=None):
+
+        self.storage = STORAGE_CLASSES[backend](max_size=max_size, location=location, timeout=timeout)
+        self.max_entry_size = max_entry_size
+        self.bbox_snap = bbox_snap
+
+    @staticmethod
+    def is_cacheable(request, q):
+        """Check if the request can be served from the cache
+
+        :param request: Django request
+        :param q: OWS parameters with upper-cased keys
+        :rtype: bool
+        """
+
+        return request.method == 'GET' and q.get('REQUEST', '').upper() in CACHEABLE_REQUESTS
+
+    @staticmethod
+    def get_generation(project_id):
+        """Return the cache generation of a project"""
+
+        from core.models import CacheGeneration
+
+        return CacheGeneration.get_value(PROJECT_GENERATION_KEY.format(project_id))
+
+    @staticmethod
+    def invalidate_project(project_id):
+        """Invalidate all cached responses for a project, in every process,
+        by bumping its generation"""
+
+        from core.models import CacheGeneration
+
+        CacheGeneration.bump(PROJECT_GENERATION_KEY.format(project_id))
+        logger.debug('OWS response cache invalidated for project %s' % project_id)
+
+    def get_key(self, project_id, fingerprint, q):
+        """Build the cache key
+
+        :param project_id: qdjango project pk
+        :type project_id: int
+        :param fingerprint: constraints fingerprint of the caller
+        :type fingerprint: str
+        :param q: OWS parameters
+        :type q: QueryDict, dict
+        :rtype: str
+        """
+
+        bits = [str(project_id), str(self.get_generation(project_id)), fingerprint]
+        for key, value in normalize_ows_parameters(q, self.bbox_snap):
+            bits.append('{}={}'.format(key, value))
+        return hashlib.sha1('&'.join(bits).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return a cached response as a (body, status code, headers) tuple or None"""
+
+        value = self.storage.get(key)
+        if value is None:
+            return None
+        try:
+            return pickle.loads(value)
+        except Exception as ex:
+            logger.warning('Invalid OWS cache entry %s: %s' % (key, ex))
+            return None
+
+    def set(self, key, body, status_code, headers):
+        """Store a response, only successful responses are stored"""
+
+        if status_code != 200 or len(body) > self.max_entry_size:
+            return
+        self.storage.set(key, pickle.dumps((body, status_code, headers), pickle.HIGHEST_PROTOCOL))
+
+
+_OWS_RESPONSE_CACHE = None
+_OWS_RESPONSE_CACHE_LOCK = threading.Lock()
+
+
+def get_ows_response_cache():
+    """Return the process OWS response cache
+
+    :return: the cache or None if QDJANGO_OWS_CACHE is not set
+    :rtype: OWSResponseCache, None
+    """
+
+    global _OWS_RESPONSE_CACHE
+
+    config = getattr(settings, 'QDJANGO_OWS_CACHE', None)
+    if not config:
+        return None
+
+    if _OWS_RESPONSE_CACHE is None:
+        with _OWS_RESPONSE_CACHE_LOCK:
+            if _OWS_RESPONSE_CACHE is None:
+                kwargs = {k.lower(): v for k, v in config.items()}
+                _OWS_RESPONSE_CACHE = OWSResponseCache(**kwargs)
+
+    return _OWS_RESPONSE_CACHE
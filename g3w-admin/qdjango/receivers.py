@@ -1,15 +1,29 @@
 from django.dispatch import receiver
-from django.db.models.signals import post_delete, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.conf import settings
 from django.core.cache import caches
+from django.contrib.auth.models import User
 from django.contrib.auth.signals import user_logged_out
 from django.http.request import QueryDict
-from core.signals import perform_client_search, post_delete_project
+from core.signals import perform_client_search, post_delete_project, post_commit_maplayer
 from core.models import ProjectMapUrlAlias
 from OWS.utils.data import GetFeatureInfoResponse
-from .models import Project, Layer, Widget, SessionTokenFilter
+from .models import (
+    Project,
+    Layer,
+    Widget,
+    SessionTokenFilter,
+    SingleLayerConstraint,
+    ConstraintSubsetStringRule,
+    ConstraintExpressionRule,
+    GeoConstraint,
+    GeoConstraintRule,
+    invalidate_constraint_geometries
+)
 from .signals import post_save_qdjango_project_file
 from .ows import OWSRequestHandler
+from .ows_cache import OWSResponseCache
+from .server_context import bump_constraints_version
 import os
 import logging
 
@@ -67,6 +81,77 @@ def delete_cache_project_settings(sender, **kwargs):
 
     instance = kwargs['instance']
 
+    # Invalidate rendered OWS responses
+    OWSResponseCache.invalidate_project(instance.pk)
+
+
+@receiver(post_save_qdjango_project_file)
+def invalidate_ows_response_cache(sender, **kwargs):
+    """
+    Invalidate rendered OWS responses when the project file is saved
+    """
+
+    from qdjango.utils.data import QgisProject
+    if not isinstance(sender, QgisProject):
+        return
+    OWSResponseCache.invalidate_project(sender.instance.pk)
+
+
+@receiver(post_save_qdjango_project_file)
+def publish_project_invalidation(sender, **kwargs):
+    """
+    Notify all the QGIS Server processes (on all nodes) that the project file has changed
+    """
+
+    from qdjango.apps import ProjectInvalidationBus
+    from qdjango.utils.data import QgisProject
+    if not isinstance(sender, QgisProject):
+        return
+    ProjectInvalidationBus.publish(sender.instance.qgis_file.path)
+
+
+@receiver(post_commit_maplayer)
+def invalidate_ows_response_cache_on_commit(sender, **kwargs):
+    """
+    Invalidate rendered OWS responses when editing changes the layer data
+    """
+
+    layer = kwargs['layer']
+    if isinstance(layer, Layer):
+        OWSResponseCache.invalidate_project(layer.project_id)
+
+
+@receiver(post_commit_maplayer)
+@receiver(post_save, sender=Layer)
+def invalidate_geoconstraint_geometries(sender, **kwargs):
+    """
+    Invalidate the cached geoconstraint geometries built from (or for) a layer
+    when its data or its datasource change
+    """
+
+    layer = kwargs['layer'] if 'layer' in kwargs else kwargs['instance']
+    if isinstance(layer, Layer):
+        invalidate_constraint_geometries(layer.pk)
+
+
+@receiver([post_save, post_delete], sender=Layer)
+@receiver([post_save, post_delete], sender=SingleLayerConstraint)
+@receiver([post_save, post_delete], sender=ConstraintSubsetStringRule)
+@receiver([post_save, post_delete], sender=ConstraintExpressionRule)
+@receiver([post_save, post_delete], sender=GeoConstraint)
+@receiver([post_save, post_delete], sender=GeoConstraintRule)
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_constraint_contexts(sender, **kwargs):
+    """
+    Invalidate the compiled constraint contexts used by QGIS Server access control filters
+    """
+
+    # m2m_changed is sent before and after the change
+    if kwargs.get('action', '').startswith('pre_'):
+        return
+
+    bump_constraints_version()
+
 
 @receiver(post_save, sender=Layer)
 def update_widget(sender, **kwargs):
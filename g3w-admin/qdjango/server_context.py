@@ -0,0 +1,313 @@
+# coding=utf-8
+""""QGIS Server request context
+
+The context holds the caller information (user, project and request
+parameters) that the QGIS Server access control filters need to compute the
+layer constraints. It is bound to the current thread for the duration of a
+single ``QgsServer.handleRequest`` call, so that the same filters can run
+either in-process or in a worker of the QGIS Server pool.
+
+The constraints which apply to the user are compiled once per request in a
+:class:`ConstraintContext` with a constant number of queries, and the
+compiled context is reused across requests until the constraint rules change.
+The rules version is stored in the database (:class:`core.models.CacheGeneration`)
+so that a change is seen at once by all the web server processes and by the
+QGIS Server pool workers.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-12'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Name of the constraint rules version counter, bumped when any rule, constraint,
+# layer or user group membership changes
+CONSTRAINTS_VERSION_KEY = 'qdjango_constraints_version'
+
+
+def get_constraints_version():
+    """Return the current constraint rules version"""
+
+    from core.models import CacheGeneration
+
+    return CacheGeneration.get_value(CONSTRAINTS_VERSION_KEY)
+
+
+def bump_constraints_version():
+    """Invalidate all the compiled constraint contexts, in every process"""
+
+    from core.models import CacheGeneration
+
+    CacheGeneration.bump(CONSTRAINTS_VERSION_KEY)
+
+
+class ConstraintContext(object):
+    """Constraints of a user on a project, compiled with a constant number of queries:
+    the project layers, the user groups and the active subset string, expression
+    and geo constraint rules for visualization.
+
+    :param user: the user
+    :type user: User, AnonymousUser
+    :param project: the qdjango project
+    :type project: Project
+    """
+
+    def __init__(self, user, project):
+
+        from django.db.models import Q
+        from qdjango.models import (ConstraintExpressionRule, ConstraintSubsetStringRule,
+                                    GeoConstraintRule, Layer)
+
+        self.layers = {l.qgs_layer_id: l for l in Layer.objects.filter(project=project)}
+
+        self._subset_string_rules = defaultdict(list)
+        self._expression_rules = defaultdict(list)
+        self._geo_rules = defaultdict(list)
+        # layer pk -> compiled constraint geometries referenced by the geo rule expressions
+        self._constraint_geometries = {}
+
+        # Anonymous user is never constrained
+        if user is None or user.is_anonymous:
+            return
+
+        user_groups = list(user.groups.all())
+
+        for rule_class, rules in ((ConstraintSubsetStringRule, self._subset_string_rules),
+                                  (ConstraintExpressionRule, self._expression_rules),
+                                  (GeoConstraintRule, self._geo_rules)):
+            context_kwargs = {'constraint__{}'.format(k): v for k, v in rule_class.get_context('v').items()}
+            queryset = rule_class.objects.filter(
+                Q(user=user) | Q(group__in=user_groups),
+                constraint__layer__project=project,
+                constraint__active=True,
+                **context_kwargs)
+            if rule_class is GeoConstraintRule:
+                queryset = queryset.select_related('constraint__layer__project', 'constraint__constraint_layer__project')
+            for rule in queryset.order_by('pk'):
+                rules[rule.constraint.layer_id].append(rule)
+
+    def layer(self, qgs_layer_id):
+        """Return the qdjango layer from the QGIS layer id or None"""
+
+        return self.layers.get(qgs_layer_id)
+
+    def subset_string_rule(self, layer_id):
+        """Return the subset string rule definition for a qdjango layer pk,
+        same as ConstraintSubsetStringRule.get_rule_definition_for_user"""
+
+        return ' AND '.join("(%s)" % rule.rule for rule in self._subset_string_rules.get(layer_id, []))
+
+    def expression_rule(self, layer_id):
+        """Return the expression rule definition for a qdjango layer pk,
+        same as ConstraintExpressionRule.get_rule_definition_for_user"""
+
+        return ' AND '.join("(%s)" % rule.rule for rule in self._expression_rules.get(layer_id, []))
+
+    def geo_rule(self, layer_id):
+        """Return the geo constraint QGIS expression for a qdjango layer pk,
+        same as GeoConstraintRule.get_rule_definition_for_user.
+
+        The constraint geometries are compiled here, when the access control filter
+        is built, and the context keeps them for the g3w_geoconstraint expressions
+        evaluated while rendering"""
+
+        compiled = [rule.get_compiled_constraint_geometry() for rule in self._geo_rules.get(layer_id, [])]
+        self._constraint_geometries[layer_id] = compiled
+        return ' AND '.join(c.expression for c in compiled)
+
+    @property
+    def fingerprint(self):
+        """Return a string identifying the rules of this context"""
+
+        bits = []
+        for rules in (self._subset_string_rules, self._expression_rules, self._geo_rules):
+            for layer_id in sorted(rules.keys()):
+                for rule in rules[layer_id]:
+                    bits.append('{}:{}:{}'.format(rule.__class__.__name__, rule.pk, rule.rule))
+        return '|'.join(bits)
+
+
+_CONSTRAINT_CONTEXTS = OrderedDict()
+_CONSTRAINT_CONTEXTS_LOCK = threading.Lock()
+
+
+def get_constraint_context(user, project, version=None):
+    """Return the compiled constraint context for a user and a project,
+    contexts are cached by (user, project, rules version)
+
+    :param user: the user
+    :type user: User, AnonymousUser
+    :param project: the qdjango project
+    :type project: Project
+    :param version: the constraint rules version, read from the database if None
+    :type version: int, None
+    :rtype: ConstraintContext
+    """
+
+    if version is None:
+        version = get_constraints_version()
+
+    user_key = None if user is None or user.is_anonymous else user.pk
+    key = (user_key, project.pk, version)
+
+    with _CONSTRAINT_CONTEXTS_LOCK:
+        try:
+            _CONSTRAINT_CONTEXTS.move_to_end(key)
+            return _CONSTRAINT_CONTEXTS[key]
+        except KeyError:
+            pass
+
+    constraint_context = ConstraintContext(user, project)
+
+    with _CONSTRAINT_CONTEXTS_LOCK:
+        _CONSTRAINT_CONTEXTS[key] = constraint_context
+        while len(_CONSTRAINT_CONTEXTS) > getattr(settings, 'QDJANGO_CONSTRAINT_CONTEXT_CACHE_SIZE', 500):
+            _CONSTRAINT_CONTEXTS.popitem(last=False)
+
+    return constraint_context
+
+
+class ServerRequestContext(object):
+    """Explicit request context for QGIS Server access control filters
+
+    :param user: the user making the request
+    :type user: User, AnonymousUser
+    :param project: the qdjango project
+    :type project: Project
+    :param request_data: request parameters (GET or POST), only the values are used
+    :type request_data: dict, QueryDict, optional
+    :param constraints_version: the constraint rules version, read from the database
+                                on first access if None
+    :type constraints_version: int, optional
+    """
+
+    def __init__(self, user, project, request_data=None, constraints_version=None):
+
+        self.user = user
+        self.project = project
+        self.request_data = request_data if request_data is not None else {}
+        self._constraints_version = constraints_version
+        self._constraints = None
+        self._filtertoken_expressions = None
+
+    @property
+    def filtertoken(self):
+        """Return the session filter token from the request parameters or None"""
+
+        return self.request_data.get('filtertoken') or None
+
+    @property
+    def constraints_version(self):
+        """Return the constraint rules version the request is filtered with
+
+        :rtype: int
+        """
+
+        if self._constraints_version is None:
+            self._constraints_version = get_constraints_version()
+        return self._constraints_version
+
+    @property
+    def constraints(self):
+        """Return the compiled constraint context of the request
+
+        :rtype: ConstraintContext
+        """
+
+        if self._constraints is None:
+            self._constraints = get_constraint_context(self.user, self.project, self.constraints_version)
+        return self._constraints
+
+    def filtertoken_expression(self, layer):
+        """Return the session filter token expression for a qdjango layer,
+        same as SessionTokenFilter.get_expr_for_token
+
+        :param layer: the qdjango layer
+        :type layer: Layer
+        :rtype: str
+        """
+
+        if not self.filtertoken:
+            return ""
+
+        if self._filtertoken_expressions is None:
+            from qdjango.models import SessionTokenFilterLayer
+
+            self._filtertoken_expressions = defaultdict(list)
+            for stf_layer in SessionTokenFilterLayer.objects.filter(
+                    session_token_filter__token=self.filtertoken, layer__project=self.project):
+                self._filtertoken_expressions[stf_layer.layer_id].append(stf_layer.qgs_expr)
+
+        expressions = self._filtertoken_expressions.get(layer.pk, [])
+        if len(expressions) == 0:
+            logger.error(
+                f"A qgis expression with this filtertoken '{self.filtertoken}' doesn't exists: skipping filtering!")
+            return ""
+        elif len(expressions) > 1:
+            logger.error(
+                f"More than one token or more expressions for this layer '{layer.qgs_layer_id}' exist: skipping filtering!")
+            return ""
+        return expressions[0]
+
+    @property
+    def fingerprint(self):
+        """Return a string that identifies the set of constraints which may
+        apply to this request: requests sharing the same fingerprint are
+        filtered in the same way by the access control filters.
+
+        The fingerprint covers the subset string, expression and geo
+        constraint rules active for the user on the project and the session
+        filter token: users without constraints share the same fingerprint.
+
+        :rtype: str
+        """
+
+        bits = 't:{}|{}'.format(self.filtertoken or '', self.constraints.fingerprint)
+        return hashlib.md5(bits.encode('utf-8')).hexdigest()
+
+
+def get_server_request_context():
+    """Return the QGIS Server request context bound to the current thread
+
+    :return: the current context or None if no request is being handled
+    :rtype: ServerRequestContext, None
+    """
+
+    return getattr(_local, 'context', None)
+
+
+def set_server_request_context(context):
+    """Bind a QGIS Server request context to the current thread
+
+    :param context: the request context, None to clear the current one
+    :type context: ServerRequestContext, None
+    """
+
+    _local.context = context
+
+
+@contextmanager
+def server_request_context(context):
+    """Context manager that binds the request context to the current thread
+    for the duration of the block"""
+
+    set_server_request_context(context)
+    try:
+        yield context
+    finally:
+        set_server_request_context(None)
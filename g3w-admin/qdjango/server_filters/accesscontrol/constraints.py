@@ -14,7 +14,7 @@ __copyright__ = 'Copyright 2020, Gis3W'
 from qgis.server import QgsAccessControlFilter
 from qgis.core import QgsMessageLog, Qgis
 from qdjango.apps import QGS_SERVER
-from qdjango.models import ConstraintSubsetStringRule, ConstraintExpressionRule, Layer, GeoConstraintRule
+from qdjango.server_context import get_server_request_context
 
 class SingleLayerSubsetStringAccessControlFilter(QgsAccessControlFilter):
     """A filter that sets a subset string from the layer constraints"""
@@ -25,14 +25,17 @@ class SingleLayerSubsetStringAccessControlFilter(QgsAccessControlFilter):
     def layerFilterSubsetString(self, layer):
         """Retrieve and sets user layer constraints"""
 
-        try:
-            qdjango_layer = Layer.objects.get(project=QGS_SERVER.project, qgs_layer_id=layer.id())
-        except Layer.DoesNotExist:
+        context = get_server_request_context()
+        if context is None:
             return ""
 
-        rule = ConstraintSubsetStringRule.get_rule_definition_for_user(QGS_SERVER.user, qdjango_layer.pk)
+        qdjango_layer = context.constraints.layer(layer.id())
+        if qdjango_layer is None:
+            return ""
+
+        rule = context.constraints.subset_string_rule(qdjango_layer.pk)
         if rule:
-            QgsMessageLog.logMessage("SingleLayerSubsetStringAccessControlFilter rule for user %s and layer id %s: %s" % (QGS_SERVER.user, layer.id(), rule), "", Qgis.Info)
+            QgsMessageLog.logMessage("SingleLayerSubsetStringAccessControlFilter rule for user %s and layer id %s: %s" % (context.user, layer.id(), rule), "", Qgis.Info)
 
         return rule
 
@@ -61,15 +64,18 @@ class SingleLayerExpressionAccessControlFilter(QgsAccessControlFilter):
     def layerFilterExpression(self, layer):
         """Retrieve and sets user layer constraints"""
 
-        try:
-            qdjango_layer = Layer.objects.get(project=QGS_SERVER.project, qgs_layer_id=layer.id())
-        except Layer.DoesNotExist:
-            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter for user %s: layer id %s does not exist!" % (QGS_SERVER.user, layer.id()), "", Qgis.Warning)
+        context = get_server_request_context()
+        if context is None:
+            return ""
+
+        qdjango_layer = context.constraints.layer(layer.id())
+        if qdjango_layer is None:
+            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter for user %s: layer id %s does not exist!" % (context.user, layer.id()), "", Qgis.Warning)
             return ""
 
-        rule = ConstraintExpressionRule.get_rule_definition_for_user(QGS_SERVER.user, qdjango_layer.pk)
+        rule = context.constraints.expression_rule(qdjango_layer.pk)
         if rule:
-            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter rule for user %s and layer id %s: %s" % (QGS_SERVER.user, layer.id(), rule), "", Qgis.Info)
+            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter rule for user %s and layer id %s: %s" % (context.user, layer.id(), rule), "", Qgis.Info)
 
         return rule
 
@@ -96,15 +102,18 @@ class GeoConstraintAccessControlFilter(QgsAccessControlFilter):
     def layerFilterExpression(self, layer):
         """Retrieve and sets user layer constraints"""
 
-        try:
-            qdjango_layer = Layer.objects.get(project=QGS_SERVER.project, qgs_layer_id=layer.id())
-        except Layer.DoesNotExist:
-            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter for user %s: layer id %s does not exist!" % (QGS_SERVER.user, layer.id()), "", Qgis.Warning)
+        context = get_server_request_context()
+        if context is None:
+            return ""
+
+        qdjango_layer = context.constraints.layer(layer.id())
+        if qdjango_layer is None:
+            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter for user %s: layer id %s does not exist!" % (context.user, layer.id()), "", Qgis.Warning)
             return ""
 
-        rule = GeoConstraintRule.get_rule_definition_for_user(QGS_SERVER.user, qdjango_layer)
+        rule = context.constraints.geo_rule(qdjango_layer.pk)
         if rule:
-            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter rule for user %s and layer id %s: %s" % (QGS_SERVER.user, layer.id(), rule), "", Qgis.Info)
+            QgsMessageLog.logMessage("SingleLayerExpressionAccessControlFilter rule for user %s and layer id %s: %s" % (context.user, layer.id(), rule), "", Qgis.Info)
 
         return rule
 
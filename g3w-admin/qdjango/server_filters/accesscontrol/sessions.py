@@ -14,7 +14,7 @@ __copyright__ = 'Copyright 2015 - 2020, Gis3w'
 from qgis.server import QgsAccessControlFilter
 from qgis.core import QgsMessageLog, Qgis
 from qdjango.apps import QGS_SERVER
-from qdjango.models import SessionTokenFilter, Layer
+from qdjango.server_context import get_server_request_context
 
 
 class SingleLayerSessionTokenAccessControlFilter(QgsAccessControlFilter):
@@ -26,20 +26,20 @@ class SingleLayerSessionTokenAccessControlFilter(QgsAccessControlFilter):
     def layerFilterExpression(self, layer):
         """Retrieve and sets user layer constraints"""
 
-        try:
-            qdjango_layer = Layer.objects.get(project=QGS_SERVER.project, qgs_layer_id=layer.id())
-        except Layer.DoesNotExist:
+        context = get_server_request_context()
+        if context is None:
             return ""
 
         # check for filtertoken
-        request_data = QGS_SERVER.djrequest.POST if QGS_SERVER.djrequest.method == 'POST' \
-            else QGS_SERVER.djrequest.GET
-
-        filtertoken = request_data.get('filtertoken')
+        filtertoken = context.filtertoken
         if not filtertoken:
             return ""
 
-        rule = SessionTokenFilter.get_expr_for_token(filtertoken, qdjango_layer)
+        qdjango_layer = context.constraints.layer(layer.id())
+        if qdjango_layer is None:
+            return ""
+
+        rule = context.filtertoken_expression(qdjango_layer)
         QgsMessageLog.logMessage("SingleLayerSessionTokenAccessControlFilter expression for filtertoken %s layer id %s: %s" % (filtertoken, layer.id(), rule), "", Qgis.Info)
         return rule
 
@@ -0,0 +1,307 @@
+# coding=utf-8
+""""QGIS Server execution: in-process or through a pool of pre-forked workers
+
+By default every OWS request is handled by the per-process ``QGS_SERVER``
+singleton. When ``QDJANGO_SERVER_POOL_SIZE`` is greater than zero, requests
+are sent instead to a pool of QGIS Server worker processes, each one with its
+own ``QgsConfigCache``. Requests are routed by project affinity so that each
+project is always rendered by the same few workers
+(``QDJANGO_SERVER_POOL_PROJECT_WORKERS``) and their caches stay warm.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-12'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404
+
+logger = logging.getLogger(__name__)
+
+# Environment variable set in the pool worker processes
+SERVER_POOL_WORKER_ENV = 'G3WADMIN_SERVER_POOL_WORKER'
+
+
+def _python_executable():
+    """Return the Python interpreter used to start the pool workers.
+
+    Under uWSGI ``sys.executable`` is the uwsgi binary, which cannot run the
+    spawned workers: the interpreter of the virtualenv (or of the installation)
+    is used instead, unless QDJANGO_SERVER_POOL_PYTHON is set.
+
+    :return: path of the Python interpreter
+    :rtype: str
+    """
+
+    python = getattr(settings, 'QDJANGO_SERVER_POOL_PYTHON', None)
+    if python:
+        return python
+
+    if os.path.basename(sys.executable or '').startswith('python'):
+        return sys.executable
+
+    for name in ('python{}.{}'.format(*sys.version_info[:2]), 'python3', 'python'):
+        python = os.path.join(sys.exec_prefix, 'bin', name)
+        if os.access(python, os.X_OK):
+            return python
+
+    raise ImproperlyConfigured('No Python interpreter found for the QGIS Server pool workers, '
+                               'please set QDJANGO_SERVER_POOL_PYTHON')
+
+
+def process_server_request(context, uri, method, headers, data):
+    """Run a request through the QGIS Server of the current process
+
+    :param context: the request context, with user, project and request
+                    parameters used by the access control filters
+    :type context: ServerRequestContext
+    :param uri: the full request URI
+    :type uri: str
+    :param method: HTTP method name (GET, POST, ...)
+    :type method: str
+    :param headers: request headers
+    :type headers: dict
+    :param data: request body or None
+    :type data: bytes, None
+    :raises Http404: if the QGIS project could not be loaded
+    :return: response body, status code and headers
+    :rtype: tuple (bytes, int, dict)
+    """
+
+    from qgis.server import QgsBufferServerRequest, QgsBufferServerResponse
+    from qdjango.apps import QGS_SERVER, get_qgs_project
+    from qdjango.server_context import server_request_context
+
+    qgs_project = get_qgs_project(context.project.qgis_file.path)
+
+    if qgs_project is None:
+        raise Http404('The requested QGIS project could not be loaded!')
+
+    methods = {
+        'GET': QgsBufferServerRequest.GetMethod,
+        'POST': QgsBufferServerRequest.PostMethod,
+        'PUT': QgsBufferServerRequest.PutMethod,
+        'PATCH': QgsBufferServerRequest.PatchMethod,
+        'HEAD': QgsBufferServerRequest.HeadMethod,
+        'DELETE': QgsBufferServerRequest.DeleteMethod,
+    }
+
+    try:
+        qgs_method = methods[method]
+    except KeyError:
+        logger.warning(
+            "Request method not supported: %s, assuming GET" % method)
+        qgs_method = QgsBufferServerRequest.GetMethod
+
+    # Body is only sent for methods that carry one
+    if method not in ('POST', 'PUT', 'PATCH'):
+        data = None
+
+    logger.debug('Calling QGIS Server: %s' % uri)
+    qgs_request = QgsBufferServerRequest(uri, qgs_method, headers, data)
+    qgs_response = QgsBufferServerResponse()
+
+    # User, project and request data are made available to the server access
+    # control plugins (constraints etc.) through the request context
+    with server_request_context(context):
+        QGS_SERVER.handleRequest(qgs_request, qgs_response, qgs_project)
+
+    return bytes(qgs_response.body()), qgs_response.statusCode(), dict(qgs_response.headers())
+
+
+def _init_worker():
+    """Initialize Django (and therefore QGIS) in a pool worker process"""
+
+    import django
+
+    os.environ[SERVER_POOL_WORKER_ENV] = '1'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'base.settings')
+    django.setup()
+
+
+def _ping():
+    """No-op task used to pre-initialize the workers"""
+
+    return os.getpid()
+
+
+def _handle_request(payload):
+    """Pool worker entry point: rebuild user and project from their pk
+    and run the request on the QGIS Server of the worker
+
+    :param payload: request payload built by QgsServerWorkerPool.handle_request
+    :type payload: dict
+    :rtype: tuple (bytes, int, dict)
+    """
+
+    from django.contrib.auth.models import AnonymousUser, User
+    from django.db import close_old_connections
+    from qdjango.models import Project
+    from qdjango.server_context import ServerRequestContext
+
+    close_old_connections()
+
+    project = Project.objects.get(pk=payload['project_id'])
+    if payload['user_id'] is None:
+        user = AnonymousUser()
+    else:
+        user = User.objects.get(pk=payload['user_id'])
+
+    # The rules version read by the caller is passed along, so that the worker
+    # discards its compiled constraints as soon as the rules change
+    context = ServerRequestContext(user, project, payload['request_data'],
+                                   constraints_version=payload['constraints_version'])
+
+    return process_server_request(context,
+                                  payload['uri'],
+                                  payload['method'],
+                                  payload['headers'],
+                                  payload['data'])
+
+
+class QgsServerWorkerPool(object):
+    """Pool of QGIS Server worker processes with project affinity.
+
+    Every worker is a single process executor, started with the ``spawn``
+    method so that it initializes its own QgsApplication and QgsServer
+    instead of inheriting the (non fork-safe) ones of the parent.
+
+    Every project is bound to ``project_workers`` workers: a request goes to
+    the one with the fewest pending requests, so that a busy project is not
+    queued on a single process.
+
+    :param size: number of worker processes
+    :type size: int
+    :param timeout: max number of seconds to wait for a response
+    :type timeout: int
+    :param project_workers: number of workers bound to every project
+    :type project_workers: int
+    """
+
+    def __init__(self, size, timeout=None, project_workers=1):
+
+        self.size = size
+        self.timeout = timeout
+        self.project_workers = max(1, min(project_workers, size))
+        self._lock = threading.Lock()
+        self._pending = [0] * size
+        self._executors = [self._new_executor() for __ in range(size)]
+
+        # Pre-initialize the workers, so that the first request does not
+        # pay for the Django and QGIS startup
+        for executor in self._executors:
+            executor.submit(_ping)
+
+    def _new_executor(self):
+
+        mp_context = multiprocessing.get_context('spawn')
+        mp_context.set_executable(_python_executable())
+        return ProcessPoolExecutor(max_workers=1,
+                                   mp_context=mp_context,
+                                   initializer=_init_worker)
+
+    def worker_indexes(self, project_id):
+        """Return the indexes of the workers bound to a project
+
+        :param project_id: qdjango project pk
+        :type project_id: int
+        :rtype: list
+        """
+
+        first = int(project_id) % self.size
+        return [(first + i) % self.size for i in range(self.project_workers)]
+
+    def worker_index(self, project_id):
+        """Return the index of the least busy worker bound to a project
+
+        :param project_id: qdjango project pk
+        :type project_id: int
+        :rtype: int
+        """
+
+        return min(self.worker_indexes(project_id), key=lambda index: self._pending[index])
+
+    def handle_request(self, context, uri, method, headers, data):
+        """Send a request to the worker bound to the project and wait for the response,
+        arguments are the same as process_server_request.
+
+        :rtype: tuple (bytes, int, dict)
+        """
+
+        user = context.user
+        payload = {
+            'project_id': context.project.pk,
+            'user_id': None if user is None or user.is_anonymous else user.pk,
+            'request_data': dict(context.request_data.items()),
+            'constraints_version': context.constraints_version,
+            'uri': uri,
+            'method': method,
+            'headers': headers,
+            'data': data,
+        }
+
+        with self._lock:
+            index = self.worker_index(context.project.pk)
+            self._pending[index] += 1
+        try:
+            future = self._executors[index].submit(_handle_request, payload)
+            return future.result(timeout=self.timeout)
+        except BrokenProcessPool:
+            # The worker died (i.e. QGIS crashed): replace it, the failed
+            # request is not retried
+            logger.error('QGIS Server pool worker %s died, restarting it' % index)
+            with self._lock:
+                self._executors[index] = self._new_executor()
+            raise
+        finally:
+            with self._lock:
+                self._pending[index] -= 1
+
+    def shutdown(self):
+        """Shutdown all the workers"""
+
+        for executor in self._executors:
+            executor.shutdown(wait=False)
+
+
+_SERVER_POOL = None
+_SERVER_POOL_LOCK = threading.Lock()
+
+
+def get_server_pool():
+    """Return the QGIS Server worker pool of the current process, the
+    pool is created on first access.
+
+    :return: the pool or None if the pool is not enabled (QDJANGO_SERVER_POOL_SIZE = 0)
+             or if we are already running in a pool worker
+    :rtype: QgsServerWorkerPool, None
+    """
+
+    global _SERVER_POOL
+
+    size = getattr(settings, 'QDJANGO_SERVER_POOL_SIZE', 0)
+    if not size or os.environ.get(SERVER_POOL_WORKER_ENV):
+        return None
+
+    if _SERVER_POOL is None:
+        with _SERVER_POOL_LOCK:
+            if _SERVER_POOL is None:
+                logger.info('Starting QGIS Server pool with %s workers' % size)
+                _SERVER_POOL = QgsServerWorkerPool(
+                    size, getattr(settings, 'QDJANGO_SERVER_POOL_TIMEOUT', None),
+                    getattr(settings, 'QDJANGO_SERVER_POOL_PROJECT_WORKERS', 1))
+
+    return _SERVER_POOL
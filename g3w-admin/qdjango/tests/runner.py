@@ -13,8 +13,7 @@ __date__ = '2021-03-03'
 __copyright__ = 'Copyright 2021, Gis3W'
 
 from django.test.runner import DiscoverRunner, _teardown_databases
-from qdjango.apps import QGS_APPLICATION, QGS_SERVER
-from qgis.server import QgsConfigCache
+from qdjango.apps import QGS_APPLICATION, ProjectCacheInvalidator, ProjectCacheManager
 
 
 class G3wSuiteTestRunner(DiscoverRunner):
@@ -23,13 +22,10 @@ class G3wSuiteTestRunner(DiscoverRunner):
     def teardown_databases(self, old_config, **kwargs):
         """Destroy all the non-mirror databases and cleanup projects."""
 
-        global QGS_SERVER
-
-        try:
-            QgsConfigCache.instance().removeEntry(QGS_SERVER.project.qgis_project.fileName())
-            QGS_SERVER.project = None
-        except:
-            pass
+        # Remove all the projects loaded by the tests from the QGIS Server caches
+        for stats in ProjectCacheManager.stats():
+            if stats['cached']:
+                ProjectCacheInvalidator.invalidate(stats['path'])
 
         QGS_APPLICATION.exitQgis()
 
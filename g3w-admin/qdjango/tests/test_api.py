@@ -13,6 +13,7 @@ __copyright__ = 'Copyright 2020, Gis3w'
 
 
 import json
+from unittest import mock
 
 from django.conf import settings
 from django.http import SimpleCookie
@@ -37,7 +38,7 @@ from qdjango.api.layers.filters import FILTER_RELATIONONETOMANY_PARAM
 from qdjango.utils.data import QgisProject
 from qdjango.models import SessionTokenFilter, SessionTokenFilterLayer
 from core.tests.base import CoreTestBase
-from core.utils.qgisapi import get_qgs_project
+from core.utils.qgisapi import get_qgs_project, FeaturesBudget
 
 from .base import QdjangoTestBase, CURRENT_PATH, TEST_BASE_PATH, QGS310_WIDGET_FILE
 from qgis.core import QgsFeatureRequest
@@ -261,6 +262,52 @@ class TestSubsetStringRules(BaseConstraintsApiTests, QdjangoTestBase):
     _rule_class = ConstraintSubsetStringRule
     _rule_view_name = 'subsetstringrule'
 
+    def test_subset_string_restored_on_invalid_cursor(self):
+        """ Test that the constraint subset string is removed from the shared layer after an invalid cursor """
+
+        world = Layer.objects.get(name='world')
+        qgis_layer = get_qgs_project(world.project.qgis_file.path).mapLayer(world.qgs_layer_id)
+        subset_string = qgis_layer.subsetString()
+
+        self.assertTrue(self.client.login(username='admin01', password='admin01'))
+        url = reverse('core-vector-api', args=['data', 'qdjango', world.project.pk, world.qgs_layer_id])
+
+        for cursor in ('not a cursor', 'nan', '1e400'):
+            response = self.client.get(url, {'cursor': cursor, 'page_size': 1})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        # Valid cursors are paged with the constraint applied
+        response = self.client.get(url, {'cursor': '', 'page_size': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)['vector']['data']['features']), 1)
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        self.client.logout()
+
+    def test_subset_string_restored_on_budget_exceeded(self):
+        """ Test that the constraint subset string is removed from the shared layer after a 503 """
+
+        world = Layer.objects.get(name='world')
+        qgis_layer = get_qgs_project(world.project.qgis_file.path).mapLayer(world.qgs_layer_id)
+        subset_string = qgis_layer.subsetString()
+
+        self.assertTrue(self.client.login(username='admin01', password='admin01'))
+        url = reverse('core-vector-api', args=['data', 'qdjango', world.project.pk, world.qgs_layer_id])
+
+        with mock.patch('core.api.base.views.FeaturesBudget', lambda: FeaturesBudget(max_features=1)):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        # The constraint is applied to the next requests
+        response = self.client.get(url, {'field': 'NAME|eq|ITALY'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['vector']['count'], 0)
+        self.assertEqual(qgis_layer.subsetString(), subset_string)
+
+        self.client.logout()
+
 
 class TestExpressionRules(BaseConstraintsApiTests, QdjangoTestBase):
     """Test expression rules"""
@@ -766,8 +813,17 @@ class TestQdjangoLayersAPI(QdjangoTestBase):
                 'main_layer_e867d371_3388_4e2d_a214_95adbb56165c'],
             {'formatter': '0'})
 
+        # features are streamed
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
         # check for value relation
-        resp = json.loads(response.content)
+        resp = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(resp["vector"]["data"]["type"], "FeatureCollection")
+        self.assertTrue(resp["result"])
+        # all the features are fetched while streaming
+        self.assertNotIn("error", resp["vector"]["data"])
+        self.assertEqual(resp["vector"]["count"], len(resp["vector"]["data"]["features"]))
         properties = resp["vector"]["data"]["features"][0]["properties"]
         self.assertEqual(properties['type'], 'A')
         properties = resp["vector"]["data"]["features"][1]["properties"]
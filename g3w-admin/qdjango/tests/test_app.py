@@ -13,9 +13,21 @@ __date__ = '2020-12-30'
 __copyright__ = 'Copyright 2020, Gis3W'
 
 
+import os
+import tempfile
+import time
+from unittest import mock
+
+from io import StringIO
+
+from core.models import CacheGeneration
+from django.core.cache import caches
+from django.core.management import call_command
 from django.test import Client, override_settings
-from qdjango.apps import QGS_SERVER, get_qgs_project
+from qdjango.apps import (QGS_SERVER, ProjectCacheInvalidator, ProjectCacheManager,
+                          ProjectInvalidationBus, get_qgs_project)
 from qdjango.models import Project
+from qdjango.utils.prewarm import get_prewarm_projects, prewarm_projects
 from qgis.core import QgsProject
 
 from .base import (CURRENT_PATH, QGS310_WIDGET_FILE, TEST_BASE_PATH,
@@ -63,3 +75,129 @@ class AppTest(QdjangoTestBase):
         self.assertTrue(isinstance(qgs_project, QgsProject))
         for layer in list(qgs_project.mapLayers().values()):
             self.assertTrue(layer.isValid(), 'Layer %s is not valid!' % layer.id())
+
+    def test_project_cache_invalidator(self):
+        """test ProjectCacheInvalidator generations"""
+
+        with tempfile.NamedTemporaryFile(suffix='.qgs') as project_file:
+            path = project_file.name
+
+            ProjectCacheInvalidator.check_cache(path)
+            generation = ProjectCacheInvalidator._generations[path]
+            self.assertEqual(ProjectCacheInvalidator._cached_generations[path], generation)
+
+            # Unchanged file
+            ProjectCacheInvalidator.poll([path])
+            self.assertEqual(ProjectCacheInvalidator._generations[path], generation)
+
+            # Changed file: the generation is bumped by the watcher and
+            # the cached project is invalidated on the next request
+            mtime = time.time() + 10
+            os.utime(path, (mtime, mtime))
+            ProjectCacheInvalidator.poll([path])
+            self.assertEqual(ProjectCacheInvalidator._generations[path], generation + 1)
+            self.assertNotEqual(ProjectCacheInvalidator._cached_generations[path], generation + 1)
+
+            ProjectCacheInvalidator.check_cache(path)
+            self.assertEqual(ProjectCacheInvalidator._cached_generations[path], generation + 1)
+
+    def test_project_invalidation_bus(self):
+        """test ProjectInvalidationBus shared generations"""
+
+        path = self.qdjango_project.qgis_file.path
+        ProjectInvalidationBus.check_cache(path)
+        generation = ProjectInvalidationBus._cached_generations[path]
+
+        # Throttled: nothing changes
+        ProjectInvalidationBus.check_cache(path)
+        self.assertEqual(ProjectInvalidationBus._cached_generations[path], generation)
+
+        # Publishing forces a check on the next request
+        ProjectInvalidationBus.publish(path)
+        ProjectInvalidationBus.check_cache(path)
+        self.assertEqual(ProjectInvalidationBus._cached_generations[path], generation + 1)
+
+        # The project can be loaded again
+        self.assertTrue(isinstance(get_qgs_project(path), QgsProject))
+
+        # Stored in the database: not lost when the cache is cleared
+        caches['default'].clear()
+        self.assertEqual(CacheGeneration.get_value(ProjectInvalidationBus.key(path)), generation + 1)
+
+    def test_project_cache_manager(self):
+        """test ProjectCacheManager LRU policy and stats"""
+
+        path = self.qdjango_project.qgis_file.path
+        other_path = '{}{}{}'.format(CURRENT_PATH, TEST_BASE_PATH, 'geopackage_join.qgs')
+
+        get_qgs_project(path)
+        get_qgs_project(path)
+        self.assertTrue(ProjectCacheManager.is_cached(path))
+
+        with mock.patch('qdjango.apps.MAX_CACHED_PROJECTS', 1):
+
+            # Pinned projects are not evicted
+            with mock.patch('qdjango.apps.PINNED_PROJECTS', [os.path.basename(path)]):
+                get_qgs_project(other_path)
+                self.assertTrue(ProjectCacheManager.is_cached(path))
+                self.assertTrue(ProjectCacheManager.is_cached(other_path))
+
+            get_qgs_project(other_path)
+            self.assertFalse(ProjectCacheManager.is_cached(path))
+            self.assertTrue(ProjectCacheManager.is_cached(other_path))
+
+        stats = {s['path']: s for s in ProjectCacheManager.stats()}
+        self.assertFalse(stats[path]['cached'])
+        self.assertGreaterEqual(stats[path]['hits'], 1)
+        self.assertGreaterEqual(stats[other_path]['loads'], 1)
+        self.assertIsNotNone(stats[other_path]['load_time'])
+
+        # Evicted projects are loaded again
+        self.assertTrue(isinstance(get_qgs_project(path), QgsProject))
+        self.assertTrue(ProjectCacheManager.is_cached(path))
+
+        # Over the RSS limit: cache hits never evict, a load evicts one project
+        get_qgs_project(other_path)
+        with mock.patch('qdjango.apps.MAX_CACHED_PROJECTS_RSS', 1), \
+                mock.patch.object(ProjectCacheManager, '_rss', return_value=1024):
+            for __ in range(3):
+                get_qgs_project(path)
+                get_qgs_project(other_path)
+            self.assertTrue(ProjectCacheManager.is_cached(path))
+            self.assertTrue(ProjectCacheManager.is_cached(other_path))
+
+            ProjectCacheManager.forget(other_path)
+            get_qgs_project(other_path)
+            self.assertFalse(ProjectCacheManager.is_cached(path))
+            self.assertTrue(ProjectCacheManager.is_cached(other_path))
+
+        # Stats are logged
+        with self.assertLogs('qdjango.apps', level='INFO') as logs:
+            ProjectCacheManager.log_stats()
+        self.assertTrue(any(other_path in line for line in logs.output))
+
+    def test_prewarm_projects(self):
+        """test projects pre-warming"""
+
+        results = prewarm_projects([self.qdjango_project.pk])
+        self.assertEqual(len(results), 1)
+        project, elapsed, invalid_layers = results[0]
+        self.assertEqual(project, self.qdjango_project)
+        self.assertIsNotNone(invalid_layers)
+        self.assertTrue(ProjectCacheManager.is_cached(self.qdjango_project.qgis_file.path))
+
+        # Most requested projects: counted in memory, then in the database
+        path = self.qdjango_project.qgis_file.path
+        count = ProjectCacheManager.requests([path])[0]
+        with mock.patch('qdjango.apps.PROJECT_REQUESTS_FLUSH_INTERVAL', 3600):
+            get_qgs_project(path)
+            get_qgs_project(path)
+            self.assertEqual(ProjectCacheManager._requests.get(path), 2)
+        self.assertEqual(ProjectCacheManager.requests([path]), [count + 2])
+        self.assertEqual(ProjectCacheManager._requests, {})
+        self.assertEqual(len(get_prewarm_projects(1)), 1)
+        self.assertIn(self.qdjango_project, get_prewarm_projects('all'))
+
+        out = StringIO()
+        call_command('prewarm_projects', projects=[self.qdjango_project.pk], stdout=out)
+        self.assertIn('Project {} loaded'.format(self.qdjango_project.pk), out.getvalue())
@@ -18,13 +18,14 @@ from io import BytesIO
 
 from django.conf import settings
 from django.contrib.auth.models import Group as UserGroup
-from django.contrib.auth.models import User
+from django.contrib.auth.models import AnonymousUser, User
 from django.test import Client
 from django.urls import reverse
 from guardian.shortcuts import assign_perm, get_anonymous_user
 from qgis.core import QgsVectorLayer, QgsFeatureRequest, QgsExpression, Qgis
 from qgis.PyQt.QtCore import QTemporaryDir
 
+from core.models import CacheGeneration
 from qdjango.apps import QGS_SERVER, get_qgs_project
 from qdjango.models import (
     ConstraintSubsetStringRule,
@@ -37,6 +38,12 @@ from qdjango.models import (
     Layer,
     Project
 )
+from qdjango.server_context import (
+    ConstraintContext,
+    CONSTRAINTS_VERSION_KEY,
+    get_constraint_context,
+    get_constraints_version
+)
 from unittest import skipIf
 from .base import QdjangoTestBase
 
@@ -1464,6 +1471,55 @@ class SingleLayerExpressionConstraints(TestSingleLayerConstraintsBase):
         self.assertFalse(b'BERLIN' in response.content)
 
 
+class ConstraintContextTest(TestSingleLayerConstraintsBase):
+    """Test the compiled constraint context used by QGIS Server access control filters"""
+
+    def test_constraint_context(self):
+        """Test rule definitions and caching of the compiled context"""
+
+        admin01 = self.test_user1
+        world = self.world
+        constraint = SingleLayerConstraint(layer=world, active=True)
+        constraint.save()
+
+        ConstraintSubsetStringRule(
+            constraint=constraint, user=admin01, rule="NAME != 'ITALY'").save()
+        ConstraintExpressionRule(
+            constraint=constraint, group=self.viewer1_group, rule="NAME != 'FRANCE'").save()
+
+        context = ConstraintContext(admin01, self.qdjango_project)
+        self.assertEqual(context.layer(world.qgs_layer_id), world)
+        self.assertIsNone(context.layer('not_a_layer'))
+        self.assertEqual(context.subset_string_rule(world.pk),
+                         ConstraintSubsetStringRule.get_rule_definition_for_user(admin01, world.pk))
+        self.assertEqual(context.expression_rule(world.pk),
+                         ConstraintExpressionRule.get_rule_definition_for_user(admin01, world.pk))
+        self.assertEqual(context.geo_rule(world.pk), '')
+
+        # Anonymous user is never constrained
+        anonymous = ConstraintContext(AnonymousUser(), self.qdjango_project)
+        self.assertEqual(anonymous.subset_string_rule(world.pk), '')
+        self.assertEqual(anonymous.fingerprint, '')
+
+        # Cached until the rules change
+        version = get_constraints_version()
+        cached = get_constraint_context(admin01, self.qdjango_project)
+        self.assertIs(get_constraint_context(admin01, self.qdjango_project), cached)
+
+        constraint.active = False
+        constraint.save()
+        self.assertNotEqual(get_constraints_version(), version)
+
+        # The version is shared through the database by all the processes
+        self.assertEqual(CacheGeneration.get_value(CONSTRAINTS_VERSION_KEY), get_constraints_version())
+        self.assertIs(get_constraint_context(admin01, self.qdjango_project, version), cached)
+
+        uncached = get_constraint_context(admin01, self.qdjango_project)
+        self.assertIsNot(uncached, cached)
+        self.assertEqual(uncached.subset_string_rule(world.pk), '')
+        self.assertEqual(uncached.expression_rule(world.pk), '')
+
+
 class TestGeoConstraintsServerFilters(TestSingleLayerConstraintsBase):
     """For GeoConstraint filters"""
 
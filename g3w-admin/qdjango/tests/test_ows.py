@@ -15,15 +15,20 @@ import json
 import os
 from unittest import skip
 
-from core.models import G3WSpatialRefSys
+from core.models import CacheGeneration, G3WSpatialRefSys
 from core.models import Group as CoreGroup
+from django.contrib.auth.models import AnonymousUser, User
 from django.core.files import File
 from django.core.management import call_command
-from django.test import Client, override_settings
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
 from guardian.shortcuts import assign_perm, remove_perm
 from qdjango.apps import QGS_SERVER, get_qgs_project
 from qdjango.models import Project
+from qdjango.ows_cache import (PROJECT_GENERATION_KEY, LocMemLRUStorage, OWSResponseCache,
+                               normalize_bbox, normalize_ows_parameters)
+from qdjango.server_context import ServerRequestContext, get_server_request_context
+from qdjango.server_pool import QgsServerWorkerPool, get_server_pool
 from qgis.core import QgsProject
 
 from .base import (CURRENT_PATH, QGS310_WIDGET_FILE, TEST_BASE_PATH,
@@ -251,3 +256,117 @@ class OwsTest(QdjangoTestBase):
 
 
 
+
+    def test_server_request_context(self):
+        """Test the request context is bound only while QGIS Server handles the request"""
+
+        ows_url = reverse('OWS:ows', kwargs={'group_slug': self.qdjango_project.group.slug, 'project_type': 'qdjango',
+                                             'project_id': self.qdjango_project.id})
+
+        c = Client()
+        self.assertTrue(c.login(username='admin01', password='admin01'))
+        response = c.get(ows_url, {
+            'REQUEST': 'GetCapabilities',
+            'SERVICE': 'WMS',
+            'filtertoken': 'abc'
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(get_server_request_context())
+
+        # Fingerprint depends on user and filter token
+        admin01 = User.objects.get(username='admin01')
+        ctx = ServerRequestContext(admin01, self.qdjango_project, {'filtertoken': 'abc'})
+        self.assertEqual(ctx.filtertoken, 'abc')
+        self.assertEqual(ctx.fingerprint, ServerRequestContext(
+            admin01, self.qdjango_project, {'filtertoken': 'abc'}).fingerprint)
+        self.assertNotEqual(ctx.fingerprint, ServerRequestContext(
+            admin01, self.qdjango_project, {}).fingerprint)
+        # No constraints for admin01: same fingerprint as anonymous
+        self.assertEqual(ctx.fingerprint, ServerRequestContext(
+            AnonymousUser(), self.qdjango_project, {'filtertoken': 'abc'}).fingerprint)
+
+    def test_server_pool_affinity(self):
+        """Test QGIS Server pool routing by project"""
+
+        pool = QgsServerWorkerPool.__new__(QgsServerWorkerPool)
+        pool.size = 3
+        pool.project_workers = 1
+        pool._pending = [0] * 3
+        self.assertEqual(pool.worker_index(self.qdjango_project.pk),
+                         pool.worker_index(self.qdjango_project.pk))
+        self.assertEqual(pool.worker_index(4), 1)
+        self.assertEqual(pool.worker_index(6), 0)
+
+        # Several workers per project: the least busy one is used
+        pool.project_workers = 2
+        self.assertEqual(pool.worker_indexes(5), [2, 0])
+        self.assertEqual(pool.worker_index(5), 2)
+        pool._pending[2] = 1
+        self.assertEqual(pool.worker_index(5), 0)
+
+        # Pool is disabled by default
+        self.assertIsNone(get_server_pool())
+
+
+class OwsResponseCacheTest(TestCase):
+    """Test rendered OWS response cache"""
+
+    def test_normalize_ows_parameters(self):
+        """Test OWS parameters normalization"""
+
+        params = normalize_ows_parameters({
+            'request': 'getmap',
+            'LAYERS': 'b, a',
+            'BBOX': '0,0,10.0000000001,10',
+            'WIDTH': '100',
+            'HEIGHT': '100',
+            'g3wsuite_caching_token': '1234'
+        })
+        params = dict(params)
+        self.assertEqual(params['REQUEST'], 'GETMAP')
+        # Layer order is kept
+        self.assertEqual(params['LAYERS'], 'b,a')
+        self.assertNotIn('G3WSUITE_CACHING_TOKEN', params)
+        self.assertEqual(params['BBOX'], normalize_bbox('0,0,10,10', '100', '100', 0.01))
+
+        # Keys are sorted
+        self.assertEqual(normalize_ows_parameters({'B': '1', 'A': '2'}), [('A', '2'), ('B', '1')])
+
+    def test_locmem_lru_storage(self):
+        """Test size based eviction"""
+
+        storage = LocMemLRUStorage(max_size=10)
+        storage.set('a', b'12345')
+        storage.set('b', b'12345')
+        self.assertEqual(storage.get('a'), b'12345')
+        # b is now the least recently used
+        storage.set('c', b'12345')
+        self.assertIsNone(storage.get('b'))
+        self.assertEqual(storage.get('a'), b'12345')
+        self.assertEqual(storage.size, 10)
+
+    def test_response_cache(self):
+        """Test get/set and project invalidation"""
+
+        ows_cache = OWSResponseCache(backend='locmem', max_size=1024, max_entry_size=100)
+        q = {'REQUEST': 'GetMap', 'LAYERS': 'a'}
+        key = ows_cache.get_key(1, 'fp', q)
+        self.assertNotEqual(key, ows_cache.get_key(1, 'other_fp', q))
+        self.assertNotEqual(key, ows_cache.get_key(2, 'fp', q))
+
+        ows_cache.set(key, b'png', 200, {'Content-Type': 'image/png'})
+        self.assertEqual(ows_cache.get(key), (b'png', 200, {'Content-Type': 'image/png'}))
+
+        # Errors and big responses are not cached
+        error_key = ows_cache.get_key(1, 'fp', {'REQUEST': 'GetMap'})
+        ows_cache.set(error_key, b'error', 400, {})
+        self.assertIsNone(ows_cache.get(error_key))
+        ows_cache.set(error_key, b'x' * 101, 200, {})
+        self.assertIsNone(ows_cache.get(error_key))
+
+        OWSResponseCache.invalidate_project(1)
+        self.assertNotEqual(key, ows_cache.get_key(1, 'fp', q))
+        # The generation is shared by all the processes through the database
+        self.assertEqual(CacheGeneration.get_value(PROJECT_GENERATION_KEY.format(1)),
+                         OWSResponseCache.get_generation(1))
@@ -17,10 +17,13 @@ import json
 import os
 import re
 from io import StringIO
-from unittest import skip, skipIf
+from unittest import mock, skip, skipIf
 
 from core.models import G3WSpatialRefSys
 from core.models import Group as CoreGroup
+from core.utils.qgisapi import (_estimated_count, _expression_to_sql,
+                                _provider_count, _provider_unique_values,
+                                count_qgis_features, get_qgis_unique_values)
 from django.conf import settings
 from django.core.files import File
 from django.core.management import call_command
@@ -32,7 +35,8 @@ from qdjango.models import (ConstraintExpressionRule,
                             ConstraintSubsetStringRule, Layer, Project,
                             SessionTokenFilter, SessionTokenFilterLayer,
                             SingleLayerConstraint)
-from qgis.core import Qgis, QgsProject, QgsProviderRegistry, QgsVectorLayer
+from qgis.core import (Qgis, QgsExpression, QgsFeatureRequest, QgsProject,
+                       QgsProviderRegistry, QgsVectorLayer)
 from qgis.PyQt.QtCore import QTemporaryDir
 from qgis.PyQt.QtGui import QImage
 from rest_framework.test import APIClient
@@ -94,6 +98,8 @@ class OwsTestPostgres(QdjangoTestBase):
             "INSERT INTO multiple_pks VALUES ( 1, 1, '1-1', ST_GeomFromText('point(7 45)', 4326))")
         conn.executeSql(
             "INSERT INTO multiple_pks VALUES ( 1, 2, '1-2', ST_GeomFromText('point(8 46)', 4326))")
+        # Planner statistics for the estimated counts
+        conn.executeSql("ANALYZE multiple_pks")
 
         cls.layer_uri = conn_str + \
             " sslmode=disable key='pk1,pk2' estimatedmetadata=true srid=4326 type=Point checkPrimaryKeyUnicity='0' table=\"public\".\"multiple_pks\" (geom)"
@@ -296,3 +302,83 @@ class OwsTestPostgres(QdjangoTestBase):
         self.assertEqual(len(features), 2)
         self.assertEqual(features[0]['properties']['name'], '1-1')
         self.assertEqual(features[0]['id'], '1@@1')
+
+    def test_provider_count(self):
+        """Test filter expressions compiled to SQL and counted by PostGIS"""
+
+        qgis_layer = QgsVectorLayer(self.layer_uri, 'multiple_pks', 'postgres')
+        self.assertTrue(qgis_layer.isValid())
+
+        self.assertEqual(_expression_to_sql(qgis_layer, QgsExpression('"name" = \'1-1\' AND "pk2" > 0').rootNode()),
+                         '(("name" = E\'1-1\') AND ("pk2" > 0))')
+
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"name" = \'1-2\'')
+        self.assertEqual(_provider_count(qgis_layer, qgis_feature_request), 1)
+        self.assertEqual(qgis_layer.subsetString(), '')
+
+        # Not compiled: counted by QGIS
+        qgis_feature_request.setFilterExpression('upper("name") = \'1-2\'')
+        self.assertIsNone(_provider_count(qgis_layer, qgis_feature_request))
+        self.assertEqual(count_qgis_features(qgis_layer, qgis_feature_request), 1)
+
+        self.assertEqual(count_qgis_features(qgis_layer, attribute_filters={'name': '1-'}), 2)
+        self.assertEqual(count_qgis_features(qgis_layer, search_filter='1-1'), 1)
+
+        # Crafted filter values never reach the provider SQL
+        for crafted in ("x' OR TRUE --", "x\\' OR TRUE --", "x$q$' OR TRUE --"):
+            self.assertEqual(count_qgis_features(qgis_layer, attribute_filters={'name': crafted}), 0)
+            self.assertEqual(count_qgis_features(qgis_layer, search_filter=crafted), 0)
+            self.assertEqual(qgis_layer.subsetString(), '')
+
+    def test_approximate_count(self):
+        """Test PostGIS planner estimates with approximate_count"""
+
+        qgis_layer = QgsVectorLayer(self.layer_uri, 'multiple_pks', 'postgres')
+        self.assertTrue(qgis_layer.isValid())
+
+        with mock.patch('core.utils.qgisapi.APPROXIMATE_COUNT_THRESHOLD', 0):
+            self.assertEqual(_estimated_count(qgis_layer, QgsFeatureRequest()), 2)
+            self.assertEqual(count_qgis_features(qgis_layer, approximate=True), 2)
+
+            # Crafted search values are compiled to SQL literals: an injected OR TRUE would estimate all the rows
+            crafted = "x' OR TRUE --"
+            qgis_feature_request = QgsFeatureRequest()
+            qgis_feature_request.setFilterExpression(
+                '"name" ILIKE \'%' + crafted.replace('\'', '\\\'') + '%\'')
+            self.assertEqual(_estimated_count(qgis_layer, qgis_feature_request), 1)
+            self.assertEqual(count_qgis_features(qgis_layer, attribute_filters={'name': crafted}, approximate=True), 1)
+            # The search is not valid SQL for the bigint fields: no estimate, counted by QGIS
+            self.assertEqual(count_qgis_features(qgis_layer, search_filter=crafted, approximate=True), 0)
+
+            # Not compiled: no estimate
+            qgis_feature_request.setFilterExpression('upper("name") = \'1-2\'')
+            self.assertIsNone(_estimated_count(qgis_layer, qgis_feature_request))
+
+        # Under the threshold: exact count
+        self.assertEqual(count_qgis_features(qgis_layer, attribute_filters={'name': crafted}, approximate=True), 0)
+
+        response = self._testApiCall('core-vector-api', ['data', 'qdjango', str(self.qdjango_project.pk), 'multiple_pks_67787984_68b5_423c_bc5e_ce92d8d74d70'], {'search': 'x%27%20OR%20TRUE%20--', 'approximate_count': '1'})
+        jcontent = json.loads(response.content)
+        self.assertEqual(jcontent['vector']['count'], 0)
+
+    def test_provider_unique_values(self):
+        """Test unique values computed by PostGIS with the filters compiled to SQL"""
+
+        qgis_layer = QgsVectorLayer(self.layer_uri, 'multiple_pks', 'postgres')
+        self.assertTrue(qgis_layer.isValid())
+        name_index = qgis_layer.fields().indexOf('name')
+
+        qgis_feature_request = QgsFeatureRequest()
+        qgis_feature_request.setFilterExpression('"pk2" > 1')
+        self.assertEqual(_provider_unique_values(qgis_layer, name_index, qgis_feature_request, -1), {'1-2'})
+        self.assertEqual(get_qgis_unique_values(qgis_layer, 'name', qgis_feature_request), ['1-2'])
+        self.assertEqual(qgis_layer.subsetString(), '')
+
+        # Quotes in the filter values never reach the provider SQL
+        for crafted in ("x' OR TRUE --", "x\\' OR TRUE --", "x$q$' OR 1=1 --"):
+            injection_request = QgsFeatureRequest()
+            injection_request.setFilterExpression('"name" = {}'.format(QgsExpression.quotedValue(crafted)))
+            self.assertEqual(_provider_unique_values(qgis_layer, name_index, injection_request, -1), set())
+            self.assertEqual(get_qgis_unique_values(qgis_layer, 'name', injection_request), [])
+            self.assertEqual(qgis_layer.subsetString(), '')
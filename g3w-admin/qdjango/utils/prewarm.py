@@ -0,0 +1,80 @@
+# coding=utf-8
+""""Pre-warming of the QGIS Server project cache
+
+Loads a set of projects into the QGIS Server project cache of the current
+process, so that the first requests do not pay for the project parsing.
+The uWSGI workers pre-warm their own cache when they start (see base/wsgi.py),
+the management command only checks the load times and the layers.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+    it under the terms of the Mozilla Public License 2.0.
+
+"""
+
+__author__ = 'elpaso@itopen.it'
+__date__ = '2021-04-14'
+__copyright__ = 'Copyright 2021, Gis3W'
+
+import logging
+import time
+
+from qdjango.apps import ProjectCacheManager, get_qgs_project
+
+logger = logging.getLogger(__name__)
+
+
+def get_prewarm_projects(selection='all'):
+    """Returns the projects to pre-warm
+
+    :param selection: 'all' for all the active projects, an integer N for the N
+                      most requested active projects or a list of project ids
+    :type selection: str, int, list
+    :return: a list of Project
+    :rtype: list
+    """
+
+    from qdjango.models import Project
+
+    if isinstance(selection, (list, tuple)):
+        return list(Project.objects.filter(pk__in=selection))
+
+    projects = list(Project.objects.filter(is_active=True))
+
+    if selection == 'all':
+        return projects
+
+    # N most requested projects, the request counts of all the processes are stored in the database
+    counts = dict(zip([project.pk for project in projects],
+                      ProjectCacheManager.requests([project.qgis_file.path for project in projects])))
+    projects.sort(key=lambda project: counts[project.pk], reverse=True)
+    return projects[:int(selection)]
+
+
+def prewarm_projects(selection='all'):
+    """Loads the projects into the QGIS Server project cache of the current process,
+    project layers validity is checked by get_qgs_project as for any request
+
+    :param selection: see get_prewarm_projects
+    :type selection: str, int, list
+    :return: a list of (project, seconds spent to load it, list of invalid layer ids) tuples,
+             invalid layers is None if the project could not be loaded
+    :rtype: list
+    """
+
+    results = []
+    for project in get_prewarm_projects(selection):
+        start = time.time()
+        qgs_project = get_qgs_project(project.qgis_file.path)
+        elapsed = time.time() - start
+
+        if qgs_project is None:
+            logger.error('Pre-warm: project %s could not be loaded' % project.qgis_file.path)
+            results.append((project, elapsed, None))
+            continue
+
+        invalid_layers = [l.id() for l in qgs_project.mapLayers().values() if not l.isValid()]
+        logger.info('Pre-warm: project %s loaded in %.2fs, invalid layers: %s' % (
+            project.qgis_file.path, elapsed, len(invalid_layers)))
+        results.append((project, elapsed, invalid_layers))
+
+    return results
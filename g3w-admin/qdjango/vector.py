@@ -5,7 +5,7 @@ import zipfile
 
 from django.conf import settings
 from django.http import HttpResponse, HttpResponseForbidden
-from qgis.core import QgsVectorFileWriter, QgsFeatureRequest, QgsJsonUtils, Qgis, QgsFieldConstraints, QgsWkbTypes
+from qgis.core import QgsVectorFileWriter, QgsFeatureRequest, Qgis, QgsFieldConstraints, QgsWkbTypes
 
 from core.api.base.vector import MetadataVectorLayer
 from core.api.base.views import (MODE_CONFIG, MODE_DATA, MODE_SHP, MODE_XLS, MODE_GPX, MODE_CSV, MODE_FILTER_TOKEN,
@@ -15,7 +15,7 @@ from core.api.filters import (IntersectsBBoxFilter, OrderingFilter,
                               SearchFilter, SuggestFilterBackend, FieldFilterBackend)
 from core.api.permissions import ProjectPermission
 
-from core.utils.qgisapi import get_qgis_layer
+from core.utils.qgisapi import get_qgis_layer, get_qgis_unique_values, FeaturesBudget
 from core.utils.structure import mapLayerAttributesFromQgisLayer
 from core.utils.vector import BaseUserMediaHandler
 
@@ -25,12 +25,11 @@ from qdjango.api.constraints.filters import SingleLayerSubsetStringConstraintFil
 
 from qdjango.api.layers.filters import RelationOneToManyFilter, FidFilter, SingleLayerSessionTokenFilter
 
-from .models import Layer, SessionTokenFilter, SessionTokenFilterLayer
+from .models import Layer, SessionTokenFilter, SessionTokenFilterLayer, get_layer_data_generation
 from .utils.data import QGIS_LAYER_TYPE_NO_GEOM
 from .utils.edittype import MAPPING_EDITTYPE_QGISEDITTYPE
 
 
-import json
 import logging
 
 MODE_WIDGET = 'widget'
@@ -53,6 +52,12 @@ class QGISLayerVectorViewMixin(object):
         else:
             self.reproject = False
 
+    def get_layer_data_generation(self):
+        """
+        Return the data generation of the qdjango layer
+        """
+        return get_layer_data_generation(self.layer.pk)
+
     def get_layer_by_params(self, params):
 
         layer_id = params['layer_name']
@@ -266,20 +271,23 @@ class LayerVectorView(QGISLayerVectorViewMixin, BaseVectorOnModelApiView):
         if len(fields) == 0:
             raise APIException('The \'fields\' param is empty')
 
-        res = dict()
-        for field in fields:
-            uniques = self.metadata_layer.qgis_layer.uniqueValues(
-                self.metadata_layer.qgis_layer.fields().indexOf(field)
-            )
-            tores = []
-            for u in uniques:
-                try :
-                    tores.append(json.loads(QgsJsonUtils.encodeValue(u)))
-                except Exception as e:
-                    logger.error(f'Response vector widget unique: {e}')
-                    continue
-                    
-            res[field] = tores
+        # Apply the user's constraints and filters, store original subset string
+        qgis_layer = self.metadata_layer.qgis_layer
+        qgis_feature_request = QgsFeatureRequest()
+        original_subset_string = qgis_layer.subsetString()
+
+        try:
+            for backend in self.filter_backends:
+                backend().apply_filter(self.request, qgis_layer, qgis_feature_request, self)
+
+            res = dict()
+            for field in fields:
+                res[field] = get_qgis_unique_values(qgis_layer, field, qgis_feature_request,
+                                                    data_generation=self.get_layer_data_generation(),
+                                                    feedback=FeaturesBudget())
+        finally:
+            # Restore the original subset string
+            qgis_layer.setSubsetString(original_subset_string)
 
         return res
 
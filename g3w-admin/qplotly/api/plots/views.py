@@ -16,7 +16,7 @@ from qgis.core import \
     QgsCoordinateReferenceSystem
 from rest_framework.response import Response
 from core.api.base.views import G3WAPIView
-from core.utils.qgisapi import get_qgis_layer, get_qgs_project
+from core.utils.qgisapi import get_qgis_layer, get_qgs_project, FeaturesBudget
 from qdjango.models import Layer
 from qplotly.models import QplotlyWidget
 from qplotly.utils.qplotly_settings import QplotlySettings
@@ -73,7 +73,8 @@ class QplotlyTraceAPIView(G3WAPIView):
                     logger.error(f'Error on load qlotly settings for layer pk {clayer.pk}.')
                     continue
 
-                factory = QplotlyFactoringRelation(settings, request=request, layer=clayer)
+                factory = QplotlyFactoringRelation(settings, request=request, layer=clayer,
+                                                   feedback=FeaturesBudget())
                 factory.source_layer = csource_layer
 
                 # create expression
@@ -112,7 +113,8 @@ class QplotlyTraceAPIView(G3WAPIView):
 
         # instance a QplotlyFactory
         layer = Layer.objects.get(qgs_layer_id=qgs_layer_id, project_id=kwargs['project_id'])
-        factory = QplotlyFactoring(settings, visible_region=rect, request=request, layer=layer)
+        factory = QplotlyFactoring(settings, visible_region=rect, request=request, layer=layer,
+                                   feedback=FeaturesBudget())
 
 
         # is possible get the first layer
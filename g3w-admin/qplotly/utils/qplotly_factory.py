@@ -30,6 +30,7 @@ from qplotly.vendor.DataPlotly.core.plot_factory import (
 from qplotly.server_filters import ByFatherFeatursFilter
 
 from core.api.filters import IntersectsBBoxFilter
+from core.utils.qgisapi import FeaturesBudgetExceeded
 
 from qdjango.api.layers.filters import (
     SingleLayerSessionTokenFilter,
@@ -60,6 +61,9 @@ class QplotlyFactoring(PlotFactory):
         self.layer = kwargs['layer']
         del (kwargs['layer'])
 
+        # Optional FeaturesBudget for the features scan
+        self.feedback = kwargs.pop('feedback', None)
+
         super().__init__(*args, **kwargs)
 
     def build_trace(self):
@@ -72,6 +76,16 @@ class QplotlyFactoring(PlotFactory):
 
         self.layout = self._build_layout()
 
+    def _budget_features(self, features, original_subset_string):
+        """Iterate features within the budget of self.feedback, the original subset string
+        of the source layer is restored when the budget is exhausted"""
+
+        try:
+            yield from self.feedback.iterate(features)
+        except FeaturesBudgetExceeded:
+            self.source_layer.setSubsetString(original_subset_string)
+            raise
+
     def fetch_values_from_layer(self):
         """
         (Re)fetches plot values from the source layer.
@@ -176,6 +190,9 @@ class QplotlyFactoring(PlotFactory):
         else:
             it = self.source_layer.getFeatures(request)
 
+        if self.feedback is not None:
+            it = self._budget_features(it, original_subset_string)
+
         self.qgsrequest = request
 
         # Some plot types don't draw individual glyphs for each feature, but aggregate them instead.